@@ -83,6 +83,21 @@ def load_conf_from_file(conf_file_path, conf=__conf__):
 def get_logs_verbose(conf=__conf__):
     return conf.get_switch("Logs.Verbose", False)
 
+def get_logs_queue_size(conf=__conf__):
+    return max(1, conf.get_int("Logs.QueueSize", 1000))
+
+def get_logs_overflow_policy(conf=__conf__):
+    return conf.get("Logs.OverflowPolicy", "drop_verbose")
+
+def get_logs_rotate_size(conf=__conf__):
+    return conf.get_int("Logs.RotateSizeMB", 10) * 1024 * 1024
+
+def get_logs_rotate_count(conf=__conf__):
+    return conf.get_int("Logs.RotateCount", 5)
+
+def get_logs_json_file(conf=__conf__):
+    return conf.get("Logs.JsonFile", None)
+
 def get_lib_dir(conf=__conf__):
     return conf.get("Lib.Dir", "/var/lib/waagent")
 
@@ -95,6 +110,9 @@ def get_agent_pid_file_path(conf=__conf__):
 def get_ext_log_dir(conf=__conf__):
     return conf.get("Extension.LogDir", "/var/log/azure")
 
+def get_ext_enable_on_boot(conf=__conf__):
+    return conf.get("Extensions.EnableOnBoot", None)
+
 def get_openssl_cmd(conf=__conf__):
     return conf.get("OS.OpensslPath", "/usr/bin/openssl")
 
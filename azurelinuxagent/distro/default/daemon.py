@@ -21,26 +21,55 @@ import os
 import time
 import sys
 import traceback
+import threading
 import azurelinuxagent.conf as conf
 import azurelinuxagent.logger as logger
 from azurelinuxagent.future import ustr
 from azurelinuxagent.event import add_event, WALAEventOperation
-from azurelinuxagent.exception import ProtocolError
+from azurelinuxagent.exception import ExtensionError, ProtocolError
 from azurelinuxagent.metadata import AGENT_LONG_NAME, AGENT_VERSION, \
                                      DISTRO_NAME, DISTRO_VERSION, \
                                      DISTRO_FULL_NAME, PY_VERSION_MAJOR, \
                                      PY_VERSION_MINOR, PY_VERSION_MICRO
 import azurelinuxagent.event as event
 import azurelinuxagent.utils.fileutil as fileutil
+from azurelinuxagent.distro.default.scheduler import GoalStatePollScheduler, \
+                                                    Task, TASK_DONE, \
+                                                    STARTUP_SPREAD
+from azurelinuxagent.distro.default.statusReporter import StatusReporter
+
+#Interval to retry reporting status with cached goal state
+WARM_START_RETRY_INTERVAL = 5
+
+WARM_START_TASK = "WarmStart"
+EXT_HANDLERS_TASK = "ExtHandlers"
+EXT_STATUS_TASK = "ExtStatus"
+
+#Extension status is reported at the baseline interval even when goal state
+#polling backs off
+STATUS_REPORT_INTERVAL = 25
 
 
 class DaemonHandler(object):
     def __init__(self, distro):
         self.distro = distro
         self.running = True
+        self.poll_scheduler = None
+        self.status_reporter = None
+        #Tasks working on extensions never run at the same time
+        self.ext_lock = threading.Lock()
 
 
     def run(self):
+        #Slow appenders, e.g. serial console, don't block the daemon
+        logger.start_async(queue_size=conf.get_logs_queue_size(),
+                           overflow_policy=conf.get_logs_overflow_policy())
+        try:
+            self.run_daemon()
+        finally:
+            logger.stop_async()
+
+    def run_daemon(self):
         logger.info("{0} Version:{1}", AGENT_LONG_NAME, AGENT_VERSION)
         logger.info("OS: {0} {1}", DISTRO_NAME, DISTRO_VERSION)
         logger.info("Python: {0}.{1}.{2}", PY_VERSION_MAJOR, PY_VERSION_MINOR,
@@ -82,22 +111,127 @@ class DaemonHandler(object):
             if self.distro.scvmm_handler.run():
                 return
 
-        self.distro.provision_handler.run()
-        
-        if conf.get_resourcedisk_format():
-            self.distro.resource_disk_handler.run()
+        task_scheduler = self.distro.task_scheduler
+        task_scheduler.error_listener = self.on_task_error
+        task_scheduler.start()
+        try:
+            self.start_status_reporter()
+            self.start_warm_start()
+            try:
+                self.distro.provision_handler.run()
+            
+                if conf.get_resourcedisk_format():
+                    self.distro.resource_disk_handler.run()
+
+                try:
+                    protocol = self.distro.protocol_util.detect_protocol()
+                except ProtocolError as e:
+                    logger.error("Failed to detect protocol, exit", e)
+                    return
+            finally:
+                self.stop_warm_start()
+
+            self.init_task_timing(protocol)
+            
+            self.distro.event_handler.run()
+            self.distro.env_handler.run()
+            self.start_ext_handlers()
+
+            while self.running and task_scheduler.is_running():
+                task_scheduler.join(60)
+
+            #Failure of extension handling restarts the daemon
+            if task_scheduler.error is not None:
+                raise ExtensionError("Failed to handle extensions",
+                                     inner=task_scheduler.error)
+        finally:
+            task_scheduler.stop()
+
+    def on_task_error(self, task, err_msg):
+        #Failed critical task is reported when the daemon restarts
+        if task.critical:
+            return
+        add_event("WALA", is_success=False, message=ustr(err_msg),
+                  op=WALAEventOperation.UnhandledError)
 
+    def init_task_timing(self, protocol):
+        """
+        Derive the phase of periodic tasks from VM identity
+        """
         try:
-            protocol = self.distro.protocol_util.detect_protocol()
+            vminfo = protocol.get_vminfo()
+            vm_id = "{0}/{1}".format(vminfo.containerId,
+                                     vminfo.roleInstanceName)
+            self.distro.task_timing.set_vm_id(vm_id)
         except ProtocolError as e:
-            logger.error("Failed to detect protocol, exit", e)
+            logger.warn("Failed to get vm info: {0}", e)
+
+    def start_status_reporter(self):
+        """
+        Upload status in background, not blocking extension handling
+        """
+        self.status_reporter = StatusReporter(self.distro.task_scheduler)
+        self.status_reporter.start()
+        self.distro.ext_handlers_handler.status_reporter = self.status_reporter
+
+    def start_ext_handlers(self):
+        task_scheduler = self.distro.task_scheduler
+        task_timing = self.distro.task_timing
+        ext_handlers_handler = self.distro.ext_handlers_handler
+        self.poll_scheduler = GoalStatePollScheduler(rand=task_timing.random)
+
+        #Extension status changed between polls is reported right away
+        ext_handlers_handler.status_listener = self.on_ext_status_change
+        ext_handlers_handler.start_status_watcher()
+
+        #Agents started together don't poll in lock-step
+        delay = task_timing.get_phase_offset(STARTUP_SPREAD)
+        task_scheduler.add_task(Task(EXT_HANDLERS_TASK, self.run_ext_handlers,
+                                     delay=delay, offload=True,
+                                     lock=self.ext_lock, critical=True))
+        task_scheduler.add_task(Task(EXT_STATUS_TASK, self.report_ext_status,
+                                     interval=STATUS_REPORT_INTERVAL,
+                                     delay=STATUS_REPORT_INTERVAL,
+                                     offload=True, lock=self.ext_lock))
+
+    def run_ext_handlers(self):
+        """
+        Handle extensions. Return seconds till the next goal state poll.
+        """
+        ext_handlers_handler = self.distro.ext_handlers_handler
+        changed = ext_handlers_handler.run()
+        return self.poll_scheduler.next_interval(changed,
+                                                 ext_handlers_handler.transitioning)
+
+    def on_ext_status_change(self):
+        self.distro.task_scheduler.trigger(EXT_STATUS_TASK)
+
+    def report_ext_status(self):
+        self.distro.ext_handlers_handler.report_status()
+
+    def start_warm_start(self):
+        """
+        Report extension status with the cached goal state while protocol
+        is being detected.
+        """
+        try:
+            protocol = self.distro.protocol_util.get_cached_protocol()
+        except ProtocolError as e:
+            logger.info("Skip warm start: {0}", e)
             return
-        
-        self.distro.event_handler.run()
-        self.distro.env_handler.run()
-        
-        while self.running:
-            #Handle extensions
-            self.distro.ext_handlers_handler.run()
-            time.sleep(25)
 
+        if not self.distro.ext_handlers_handler.warm_start(protocol):
+            return
+        logger.info("Warm start with cached goal state")
+        task = Task(WARM_START_TASK, self.report_warm_start_status,
+                    interval=WARM_START_RETRY_INTERVAL, offload=True,
+                    lock=self.ext_lock)
+        self.distro.task_scheduler.add_task(task)
+
+    def stop_warm_start(self):
+        self.distro.task_scheduler.remove_task(WARM_START_TASK)
+
+    def report_warm_start_status(self):
+        if self.distro.ext_handlers_handler.report_status():
+            logger.info("Reported status with cached goal state")
+            return TASK_DONE
@@ -30,6 +30,8 @@ from azurelinuxagent.distro.default.provision import ProvisionHandler
 from azurelinuxagent.distro.default.resourceDisk import ResourceDiskHandler
 from azurelinuxagent.distro.default.extension import ExtHandlersHandler
 from azurelinuxagent.distro.default.deprovision import DeprovisionHandler
+from azurelinuxagent.distro.default.scheduler import TaskTiming, \
+                                                    TaskScheduler
 
 class DefaultDistro(object):
     """
@@ -37,6 +39,8 @@ class DefaultDistro(object):
     def __init__(self):
         self.osutil = DefaultOSUtil()
         self.protocol_util = ProtocolUtil(self)
+        self.task_timing = TaskTiming()
+        self.task_scheduler = TaskScheduler()
 
         self.init_handler = InitHandler(self)
         self.daemon_handler = DaemonHandler(self)
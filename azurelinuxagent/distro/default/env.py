@@ -19,10 +19,14 @@
 
 import os
 import socket
-import threading
-import time
 import azurelinuxagent.logger as logger
 import azurelinuxagent.conf as conf
+from azurelinuxagent.distro.default.scheduler import Task
+
+ENV_MONITOR_TASK = "EnvMonitor"
+
+#Interval of checking the environment, in seconds
+ENV_MONITOR_INTERVAL = 5
 
 class EnvHandler(object):
     """
@@ -37,7 +41,6 @@ class EnvHandler(object):
         self.stopped = True
         self.hostname = None
         self.dhcpid = None
-        self.server_thread=None
 
     def run(self):
         if not self.stopped:
@@ -49,24 +52,26 @@ class EnvHandler(object):
         self.distro.dhcp_handler.conf_routes()
         self.hostname = socket.gethostname()
         self.dhcpid = self.distro.osutil.get_dhcp_pid()
-        self.server_thread = threading.Thread(target = self.monitor)
-        self.server_thread.setDaemon(True)
-        self.server_thread.start()
+        #Runs commands and touches disks, so it's kept off the loop thread
+        task = Task(ENV_MONITOR_TASK, self.monitor,
+                    interval=self.get_monitor_interval, offload=True)
+        self.distro.task_scheduler.add_task(task)
 
     def monitor(self):
         """
         Monitor dhcp client pid and hostname.
         If dhcp clinet process re-start has occurred, reset routes.
         """
-        while not self.stopped:
-            self.distro.osutil.remove_rules_files()
-            timeout = conf.get_root_device_scsi_timeout()
-            if timeout is not None:
-                self.distro.osutil.set_scsi_disks_timeout(timeout)
-            if conf.get_monitor_hostname():
-                self.handle_hostname_update()
-            self.handle_dhclient_restart()
-            time.sleep(5)
+        self.distro.osutil.remove_rules_files()
+        timeout = conf.get_root_device_scsi_timeout()
+        if timeout is not None:
+            self.distro.osutil.set_scsi_disks_timeout(timeout)
+        if conf.get_monitor_hostname():
+            self.handle_hostname_update()
+        self.handle_dhclient_restart()
+
+    def get_monitor_interval(self):
+        return self.distro.task_timing.jitter(ENV_MONITOR_INTERVAL)
 
     def handle_hostname_update(self):
         curr_hostname = socket.gethostname()
@@ -99,6 +104,5 @@ class EnvHandler(object):
         Stop server comminucation and join the thread to main thread.
         """
         self.stopped = True
-        if self.server_thread is not None:
-            self.server_thread.join()
+        self.distro.task_scheduler.remove_task(ENV_MONITOR_TASK)
 
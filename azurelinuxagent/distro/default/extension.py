@@ -20,8 +20,10 @@ import os
 import zipfile
 import time
 import json
+import hashlib
 import subprocess
 import shutil
+import tempfile
 import azurelinuxagent.conf as conf
 import azurelinuxagent.logger as logger
 from azurelinuxagent.event import add_event, WALAEventOperation
@@ -34,8 +36,9 @@ from azurelinuxagent.protocol.restapi import ExtHandlerStatus, ExtensionStatus,
                                              get_properties, set_properties
 import azurelinuxagent.utils.fileutil as fileutil
 import azurelinuxagent.utils.restutil as restutil
-import azurelinuxagent.utils.shellutil as shellutil
-from azurelinuxagent.utils.textutil import Version
+from azurelinuxagent.utils.textutil import Version, parse_version
+from azurelinuxagent.distro.default.extensionState import ExtHandlerStateStore
+from azurelinuxagent.distro.default.extensionWatcher import ExtStatusWatcher
 
 #HandlerEnvironment.json schema version
 HANDLER_ENVIRONMENT_VERSION = 1.0
@@ -44,6 +47,8 @@ VALID_EXTENSION_STATUS = ['transitioning', 'error', 'success', 'warning']
 
 VALID_HANDLER_STATUS = ['Ready', 'NotReady', "Installing", "Unresponsive"]
 
+HANDLER_MANIFEST_FILE_NAME = "HandlerManifest.json"
+
 def validate_has_key(obj, key, fullname):
     if key not in obj:
         raise ExtensionError("Missing: {0}".format(fullname))
@@ -98,50 +103,338 @@ def parse_ext_status(ext_status, data):
     for substatus in substatus_list:
         ext_status.substatusList.append(parse_ext_substatus(substatus))
 
+def find_manifest(pkg):
+    """
+    Find HandlerManifest.json from the central directory of the zip.
+    The one closest to the root wins.
+    """
+    man_names = [x for x in pkg.namelist() \
+                 if os.path.basename(x) == HANDLER_MANIFEST_FILE_NAME]
+    if len(man_names) == 0:
+        return None
+    return sorted(man_names, key=lambda x: (x.count('/'), x))[0]
+
+def unpack_ext_pkg(pkg, target_dir):
+    """
+    Extract zip file to target_dir and apply file modes stored in the zip.
+    Files are always executable by the owner, as extensions expect.
+    """
+    for info in pkg.infolist():
+        path = pkg.extract(info, target_dir)
+        if info.filename.endswith('/'):
+            continue
+        mode = 0
+        #Modes are only stored by zip tools on unix
+        if info.create_system == 3:
+            mode = (info.external_attr >> 16) & 0o777
+        if mode == 0:
+            mode = 0o644
+        os.chmod(path, mode | 0o100)
+
+def copy_ext_handler_files(src_dir, target_dir):
+    """
+    Copy files of the handler that are not in its new package, e.g. status,
+    config, mrseq and the others written by the extension, to its new dir
+    """
+    for name in os.listdir(src_dir):
+        src_path = os.path.join(src_dir, name)
+        target_path = os.path.join(target_dir, name)
+        if os.path.islink(src_path):
+            if not os.path.lexists(target_path):
+                os.symlink(os.readlink(src_path), target_path)
+        elif os.path.isdir(src_path):
+            if not os.path.exists(target_path):
+                shutil.copytree(src_path, target_path, symlinks=True)
+            elif os.path.isdir(target_path):
+                copy_ext_handler_files(src_path, target_path)
+        elif not os.path.lexists(target_path):
+            shutil.copy2(src_path, target_path)
+
+class ExtHandlerPackageIndex(object):
+    """
+    Index of the packages in an extension manifest. Packages are grouped by
+    "<major>." and "<major>.<minor>." prefix with the newest one of each
+    group precomputed, so that picking a version is a dict lookup.
+    """
+    def __init__(self, pkg_list):
+        self.exact = {}
+        self.by_major = {}
+        self.by_minor = {}
+        for pkg in pkg_list.versions:
+            if pkg.version is None:
+                continue
+            key = parse_version(pkg.version)
+            self.exact[pkg.version] = (key, pkg)
+            version_frag = pkg.version.split('.')
+            if len(version_frag) >= 2:
+                self._add_newest(self.by_major, version_frag[0], key, pkg)
+            if len(version_frag) >= 3:
+                self._add_newest(self.by_minor, tuple(version_frag[0:2]),
+                                 key, pkg)
+
+    def _add_newest(self, group, group_key, key, pkg):
+        newest = group.get(group_key)
+        if newest is None or key > newest[0]:
+            group[group_key] = (key, pkg)
+
+    def get_newest(self, version, auto_upgrade=False):
+        """
+        Return the newest package of the same major version if auto_upgrade,
+        else the newest hot-fix of the same major.minor version.
+        """
+        version_frag = version.split('.')
+        if auto_upgrade:
+            candidates = [self.by_major.get(version_frag[0])]
+        else:
+            candidates = [self.by_minor.get(tuple(version_frag[0:2]))]
+        candidates.append(self.exact.get(version))
+        candidates = [x for x in candidates if x is not None]
+        if len(candidates) == 0:
+            return None
+        return max(candidates, key=lambda x: x[0])[1]
+
+def get_ext_handler_digest(ext_handler):
+    """
+    Digest of everything in the goal state about the handler: state,
+    version, upgrade policy and the settings of its extensions.
+    """
+    data = json.dumps(get_properties(ext_handler), sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+def get_pkg_list_key(pkg_list):
+    return tuple([x.version for x in pkg_list.versions])
+
 class ExtHandlerState(object):
     NotInstalled = "NotInstalled"
     Installed = "Installed"
     Enabled = "Enabled"
 
+class ExtHandlerInstanceRegistry(object):
+    """
+    Keep one ExtHandlerInstance per handler name and version, so that the
+    status loop doesn't rebuild loggers, log dirs and paths on every pass.
+    """
+    def __init__(self, state_store, status_watcher):
+        self.instances = {}
+        self.state_store = state_store
+        self.status_watcher = status_watcher
+
+    def get(self, ext_handler, protocol):
+        key = (ext_handler.name, ext_handler.properties.version)
+        ext_handler_i = self.instances.get(key)
+        if ext_handler_i is None:
+            ext_handler_i = ExtHandlerInstance(ext_handler, protocol, 
+                                               self.state_store,
+                                               self.status_watcher)
+            self.instances[key] = ext_handler_i
+        else:
+            #Same handler and version from a newer goal state
+            ext_handler_i.ext_handler = ext_handler
+            ext_handler_i.protocol = protocol
+        return ext_handler_i
+
+    def add(self, ext_handler_i):
+        """
+        Register instance under its current version. The version could be
+        changed by decide_version after the instance is created.
+        """
+        for key in [k for k, v in self.instances.items() \
+                    if v is ext_handler_i]:
+            del self.instances[key]
+        key = (ext_handler_i.ext_handler.name, ext_handler_i.get_version())
+        self.instances[key] = ext_handler_i
+
+    def retain(self, ext_handlers):
+        """
+        Drop instances that are not referred by the current goal state
+        """
+        keys = set()
+        if ext_handlers is not None:
+            for ext_handler in ext_handlers.extHandlers:
+                keys.add((ext_handler.name, ext_handler.properties.version))
+        for key in list(self.instances.keys()):
+            if key not in keys:
+                self.instances.pop(key).close_logger()
+
 class ExtHandlersHandler(object):
     def __init__(self, distro):
         self.distro = distro
         self.ext_handlers = None
         self.last_etag = None
+        #Handler name -> (digest, decided version) of handlers that have
+        #been handled successfully with the last goal state
+        self.handled = {}
+        self.goal_state_loaded = False
         self.log_report = False
+        #True if any handler was installing or transitioning at last report
+        self.transitioning = False
+        self.state_store = ExtHandlerStateStore()
+        #Called when extension status is changed
+        self.status_listener = None
+        #Uploads status in background if set, otherwise status is uploaded
+        #right away
+        self.status_reporter = None
+        self.status_watcher = ExtStatusWatcher(self.on_status_change)
+        self.registry = ExtHandlerInstanceRegistry(self.state_store, 
+                                                   self.status_watcher)
+
+    def start_status_watcher(self):
+        self.status_watcher.start()
+
+    def on_status_change(self):
+        if self.status_listener is not None:
+            self.status_listener()
+
+    def report_status(self):
+        """
+        Report status with the last ext handler config, without checking 
+        for new goal state. Return True if status is reported.
+        """
+        if self.ext_handlers is None:
+            return False
+        logger.verb("Ext handler status changed, report status")
+        return self.report_ext_handlers_status(self.ext_handlers)
+
+    def load_goal_state(self):
+        """
+        Restore the last handled goal state, so that a restart with the same
+        goal state goes straight to status reporting.
+        """
+        self.goal_state_loaded = True
+        goal_state = self.state_store.get_goal_state()
+        self.last_etag = goal_state.get("etag")
+        self.handled = {}
+        for name, handled in goal_state.get("handled", {}).items():
+            self.handled[name] = tuple(handled)
+
+        enable_on_boot = conf.get_ext_enable_on_boot()
+        last_boot_id = goal_state.get("boot_id")
+        if enable_on_boot is None or last_boot_id is None or \
+                last_boot_id == self.distro.osutil.get_boot_id():
+            return
+
+        names = [x.strip() for x in enable_on_boot.split(',')]
+        for name in list(self.handled.keys()):
+            if "*" in names or name in names:
+                logger.info("Enable ext handler on boot: {0}", name)
+                del self.handled[name]
+                #Handle the goal state again for the removed handlers
+                self.last_etag = None
+
+    def save_goal_state(self):
+        handled = {}
+        for name, digest_version in self.handled.items():
+            handled[name] = list(digest_version)
+        self.state_store.set_goal_state({
+            "etag": self.last_etag,
+            "handled": handled,
+            "boot_id": self.distro.osutil.get_boot_id()
+        })
+        self.state_store.flush()
+
+    def restore_versions(self, ext_handlers):
+        """
+        Use the versions decided when the goal state was handled, e.g.
+        after agent restart.
+        """
+        for ext_handler in ext_handlers.extHandlers:
+            handled = self.handled.get(ext_handler.name)
+            if handled is not None:
+                ext_handler.properties.version = handled[1]
+
+    def warm_start(self, protocol):
+        """
+        Load the cached goal state, so that status can be reported before
+        protocol is detected. It's only done if the cached goal state has
+        been handled. The handlers are reconciled by run() once a fresh goal
+        state arrives.
+
+        Return True if the cached goal state is loaded.
+        """
+        if not self.goal_state_loaded:
+            self.load_goal_state()
+        try:
+            ext_handlers, etag = protocol.get_cached_ext_handlers()
+        except (ProtocolError, NotImplementedError) as e:
+            logger.info("No cached ext handler config: {0}", e)
+            return False
+
+        if self.last_etag is None or self.last_etag != etag:
+            logger.info("Cached ext handler config is not handled: {0}", etag)
+            return False
+
+        self.restore_versions(ext_handlers)
+        self.protocol = protocol
+        self.ext_handlers = ext_handlers
+        return True
 
     def run(self):
+        """
+        Return True if a new goal state is handled
+        """
+        if not self.goal_state_loaded:
+            self.load_goal_state()
+
         ext_handlers, etag = None, None
         try:
             self.protocol = self.distro.protocol_util.get_protocol()
             ext_handlers, etag = self.protocol.get_ext_handlers()
         except ProtocolError as e:
             add_event(name="WALA", is_success=False, message=ustr(e))
-            return
+            return False
+        self.ext_handlers = ext_handlers
 
+        changed = False
         if self.last_etag is not None and self.last_etag == etag:
             logger.verb("No change to ext handler config:{0}, skip", etag)
             self.log_report = False
+            self.restore_versions(ext_handlers)
         else:
+            changed = True
+            logger.set_context(incarnation=etag)
             logger.info("Handle new ext handler config")
             self.log_report = True #Log status report success on new config
             self.handle_ext_handlers(ext_handlers)
+            self.registry.retain(ext_handlers)
             self.last_etag = etag
+            self.save_goal_state()
 
         self.report_ext_handlers_status(ext_handlers)
+        return changed
    
     def handle_ext_handlers(self, ext_handlers):
         if ext_handlers.extHandlers is None or \
                 len(ext_handlers.extHandlers) == 0:
             logger.info("No ext handler config found")
+            self.handled = {}
             return
 
+        handled = {}
         for ext_handler in ext_handlers.extHandlers:
+            #Digest must be taken before decide_version changes the version
+            digest = get_ext_handler_digest(ext_handler)
+            last = self.handled.get(ext_handler.name)
+            if last is not None and last[0] == digest:
+                logger.verb("No change to ext handler:{0}, skip",
+                            ext_handler.name)
+                #Keep using the version decided before
+                ext_handler.properties.version = last[1]
+                handled[ext_handler.name] = last
+                continue
+
             #TODO handle install in sequence, enable in parallel
-            self.handle_ext_handler(ext_handler)
+            if self.handle_ext_handler(ext_handler):
+                handled[ext_handler.name] = (digest,
+                                             ext_handler.properties.version)
+            self.state_store.flush()
+        self.handled = handled
     
     def handle_ext_handler(self, ext_handler):
-        ext_handler_i = ExtHandlerInstance(ext_handler, self.protocol)
+        """
+        Return True if the handler is in expected state
+        """
+        ext_handler_i = self.registry.get(ext_handler, self.protocol)
+        success = True
         try:
             state = ext_handler.properties.state
             ext_handler_i.logger.info("Expected handler state: {0}", state)
@@ -155,8 +448,12 @@ class ExtHandlersHandler(object):
                 message = u"Unknown ext handler state:{0}".format(state)
                 raise ExtensionError(message)
         except ExtensionError as e:
+            success = False
             ext_handler_i.set_handler_status(message=ustr(e), code=-1)
             ext_handler_i.report_event(message=ustr(e), is_success=False)
+        #Version might be changed by decide_version
+        self.registry.add(ext_handler_i)
+        return success
     
     def handle_enable(self, ext_handler_i):
 
@@ -206,33 +503,44 @@ class ExtHandlersHandler(object):
         ext_handler_i.rm_ext_handler_dir()
     
     def report_ext_handlers_status(self, ext_handlers):
-        """Go thru handler_state dir, collect and report status"""
+        """
+        Go thru handler state, collect and report status.
+        Return True if status is reported, or posted to status reporter.
+        """
         vm_status = VMStatus()
         vm_status.vmAgent.version = AGENT_VERSION
         vm_status.vmAgent.status = "Ready"
         vm_status.vmAgent.message = "Guest Agent is running"
 
+        self.transitioning = False
         if ext_handlers is not None:
             for ext_handler in ext_handlers.extHandlers:
                 try:
                     self.report_ext_handler_status(vm_status, ext_handler)
                 except ExtensionError as e:
                     add_event(name="WALA", is_success=False, message=ustr(e))
+        self.state_store.flush()
         
         logger.verb("Report vm agent status")
+
+        if self.status_reporter is not None:
+            self.status_reporter.post(self.protocol, vm_status)
+            return True
         
         try:
             self.protocol.report_vm_status(vm_status)
         except ProtocolError as e:
             message = "Failed to report vm agent status: {0}".format(e)
             add_event(name="WALA", is_success=False, message=message)
+            return False
 
         if self.log_report:
             logger.info("Successfully reported vm agent status")
+        return True
 
 
     def report_ext_handler_status(self, vm_status, ext_handler):
-        ext_handler_i = ExtHandlerInstance(ext_handler, self.protocol)
+        ext_handler_i = self.registry.get(ext_handler, self.protocol)
         
         handler_status = ext_handler_i.get_handler_status() 
         if handler_status is None:
@@ -253,26 +561,69 @@ class ExtHandlersHandler(object):
             except ExtensionError as e:
                 ext_handler_i.set_handler_status(message=ustr(e), code=-1)
 
+        if handler_status.status == "Installing" or \
+                ext_handler_i.transitioning:
+            self.transitioning = True
         vm_status.vmAgent.extensionHandlers.append(handler_status)
         
 class ExtHandlerInstance(object):
-    def __init__(self, ext_handler, protocol):
+    def __init__(self, ext_handler, protocol, state_store, status_watcher):
         self.ext_handler = ext_handler
         self.protocol = protocol
+        self.state_store = state_store
+        self.status_watcher = status_watcher
         self.operation = None
         self.pkg = None
+        self.pkg_index = None
+        self.pkg_index_key = None
+        self.transitioning = False
+        self.init_paths()
 
-        prefix = "[{0}]".format(self.get_full_name())
+    def init_paths(self):
+        """
+        Paths and logger only depend on name and version. Compute them once
+        and only again when the version is changed.
+        """
+        self.version = self.ext_handler.properties.version
+        self.full_name = "{0}-{1}".format(self.ext_handler.name, self.version)
+        self.base_dir = os.path.join(conf.get_lib_dir(), self.full_name)
+        self.log_dir = os.path.join(conf.get_ext_log_dir(), 
+                                    self.ext_handler.name, self.version)
+        self.handler_state_dir = os.path.join(conf.get_lib_dir(), 
+                                              "handler_state", self.full_name)
+        self.manifest = None
+
+        prefix = "[{0}]".format(self.full_name)
         self.logger = logger.Logger(logger.DEFAULT_LOGGER, prefix)
+        self.logger.set_context(handler=self.ext_handler.name,
+                                version=self.version)
         
         try:
             fileutil.mkdir(self.get_log_dir(), mode=0o744)
         except IOError as e:
             self.logger.error(u"Failed to create extension log dir: {0}", e)
 
-        log_file = os.path.join(self.get_log_dir(), "CommandExecution.log")
+        self.log_file = os.path.join(self.get_log_dir(),
+                                     "CommandExecution.log")
         self.logger.add_appender(logger.AppenderType.FILE,
-                                 logger.LogLevel.INFO, log_file)
+                                 logger.LogLevel.INFO, self.log_file,
+                                 max_size=conf.get_logs_rotate_size(),
+                                 backup_count=conf.get_logs_rotate_count())
+
+    def get_version(self):
+        return self.version
+
+    def set_version(self, version):
+        self.ext_handler.properties.version = version
+        if version != self.version:
+            self.close_logger()
+            self.init_paths()
+
+    def close_logger(self):
+        """
+        Release the log file of this version, it's opened again if logged to
+        """
+        logger.close_file_appenders(self.log_file)
 
     def decide_version(self):
         """
@@ -294,23 +645,18 @@ class ExtHandlerInstance(object):
         if len(version_frag) < 2:
             raise ExtensionError("Wrong version format: {0}".format(version))
 
-        version_prefix = None
-        if update_policy is not None and update_policy == 'auto':
-            version_prefix = "{0}.".format(version_frag[0])
-        else:
-            version_prefix = "{0}.{1}.".format(version_frag[0], version_frag[1])
-        
-        packages = [x for x in pkg_list.versions \
-                    if x.version.startswith(version_prefix) or \
-                       x.version == version]
-        
-        packages = sorted(packages, key=lambda x: Version(x.version), 
-                          reverse=True)
+        #Manifest is usually not changed between goal states
+        pkg_list_key = get_pkg_list_key(pkg_list)
+        if self.pkg_index is None or self.pkg_index_key != pkg_list_key:
+            self.pkg_index = ExtHandlerPackageIndex(pkg_list)
+            self.pkg_index_key = pkg_list_key
 
-        if len(packages) <= 0:
+        auto_upgrade = update_policy is not None and update_policy == 'auto'
+        pkg = self.pkg_index.get_newest(version, auto_upgrade=auto_upgrade)
+        if pkg is None:
             raise ExtensionError("Failed to find and valid extension package")
-        self.pkg = packages[0]
-        self.ext_handler.properties.version = packages[0].version
+        self.pkg = pkg
+        self.set_version(pkg.version)
         self.logger.info("Use version: {0}", self.pkg.version)
 
     def version_gt(self, other):
@@ -322,19 +668,16 @@ class ExtHandlerInstance(object):
         lastest_version = None
         ext_handler_name = self.ext_handler.name
 
-        for dir_name in os.listdir(conf.get_lib_dir()):
-            path = os.path.join(conf.get_lib_dir(), dir_name)
-            if os.path.isdir(path) and dir_name.startswith(ext_handler_name):
-                seperator = dir_name.rfind('-')
-                if seperator < 0:
-                    continue
-                installed_name = dir_name[0: seperator]
-                installed_version = dir_name[seperator + 1:] 
-                if installed_name != ext_handler_name:
-                    continue
-                if lastest_version is None or \
-                        Version(lastest_version) < Version(installed_version):
-                   lastest_version = installed_version
+        versions = self.state_store.get_installed_versions(ext_handler_name)
+        while len(versions) > 0:
+            version = versions.pop()
+            path = os.path.join(conf.get_lib_dir(), 
+                                "{0}-{1}".format(ext_handler_name, version))
+            if os.path.isdir(path):
+                lastest_version = version
+                break
+            #Removed without going thru the agent, fix the inventory
+            self.state_store.remove_installed(ext_handler_name, version)
 
         if lastest_version is None:
             return None
@@ -343,7 +686,8 @@ class ExtHandlerInstance(object):
         old_ext_handler = ExtHandler()
         set_properties("ExtHandler", old_ext_handler, data)
         old_ext_handler.properties.version = lastest_version
-        return ExtHandlerInstance(old_ext_handler, self.protocol)
+        return ExtHandlerInstance(old_ext_handler, self.protocol, 
+                                  self.state_store, self.status_watcher)
     
     def copy_status_files(self, old_ext_handler_i):
         self.logger.info("Copy status files from old plugin to new")
@@ -365,6 +709,7 @@ class ExtHandlerInstance(object):
     
     def set_operation(self, op):
         self.operation = op
+        self.logger.set_context(operation=op)
 
     def report_event(self, message="", is_success=True):
         version = self.ext_handler.properties.version
@@ -392,36 +737,59 @@ class ExtHandlerInstance(object):
                                 os.path.basename(uri.uri) + ".zip")
         try:
             fileutil.write_file(pkg_file, bytearray(package), asbin=True)
-            zipfile.ZipFile(pkg_file).extractall(self.get_base_dir())
-        except IOError as e:
+            pkg = zipfile.ZipFile(pkg_file)
+        except (IOError, zipfile.BadZipfile) as e:
             raise ExtensionError(u"Failed to write and unzip plugin", e)
 
-        chmod = "find {0} -type f | xargs chmod u+x".format(self.get_base_dir())
-        shellutil.run(chmod)
-        self.report_event(message="Download succeeded")
-
-        self.logger.info("Initialize extension directory")
-        #Save HandlerManifest.json
-        man_file = fileutil.search_file(self.get_base_dir(),
-                                        'HandlerManifest.json')
-
-        if man_file is None:
+        man_name = find_manifest(pkg)
+        if man_name is None:
             raise ExtensionError("HandlerManifest.json not found")
-        
-        try:
-            man = fileutil.read_file(man_file, remove_bom=True)
-            fileutil.write_file(self.get_manifest_file(), man)
-        except IOError as e:
-            raise ExtensionError(u"Failed to save HandlerManifest.json", e)
 
-        #Create status and config dir
+        #Unpack into a temp dir and rename it, so that a partially
+        #extracted handler is never visible
+        tmp_dir = None
+        old_dir = None
         try:
-            status_dir = self.get_status_dir()
-            fileutil.mkdir(status_dir, mode=0o700)
-            conf_dir = self.get_conf_dir()
-            fileutil.mkdir(conf_dir, mode=0o700)
-        except IOError as e:
-            raise ExtensionError(u"Failed to create status or config dir", e)
+            tmp_dir = tempfile.mkdtemp(dir=conf.get_lib_dir(),
+                                       prefix=".{0}.".format(self.full_name))
+            unpack_ext_pkg(pkg, tmp_dir)
+
+            self.logger.info("Initialize extension directory")
+            #Save HandlerManifest.json
+            man = fileutil.read_file(os.path.join(tmp_dir, man_name),
+                                     remove_bom=True)
+            fileutil.write_file(os.path.join(tmp_dir,
+                                             HANDLER_MANIFEST_FILE_NAME), man)
+
+            #Create status and config dir
+            fileutil.mkdir(os.path.join(tmp_dir, "status"), mode=0o700)
+            fileutil.mkdir(os.path.join(tmp_dir, "config"), mode=0o700)
+
+            base_dir = self.get_base_dir()
+            if os.path.isdir(base_dir):
+                self.logger.info("Replace ext handler dir: {0}", base_dir)
+                copy_ext_handler_files(base_dir, tmp_dir)
+                #Move the old dir aside, so that there's always one of them
+                #in place
+                old_dir = tempfile.mkdtemp(dir=conf.get_lib_dir(),
+                                           prefix=".{0}.old.".format(
+                                               self.full_name))
+                os.rmdir(old_dir)
+                os.rename(base_dir, old_dir)
+            os.rename(tmp_dir, base_dir)
+            tmp_dir = None
+        except (IOError, OSError, zipfile.BadZipfile, RuntimeError) as e:
+            #RuntimeError is raised by zipfile for encrypted files
+            raise ExtensionError(u"Failed to unpack plugin", e)
+        finally:
+            pkg.close()
+            for dir_name in [tmp_dir, old_dir]:
+                if dir_name is not None and os.path.isdir(dir_name):
+                    shutil.rmtree(dir_name, ignore_errors=True)
+
+        self.manifest = None
+        self.state_store.add_installed(self.ext_handler.name, self.version)
+        self.report_event(message="Download succeeded")
 
         #Save HandlerEnvironment.json
         self.create_handler_env()
@@ -463,6 +831,10 @@ class ExtHandlerInstance(object):
             self.report_event(message=ustr(e), is_success=False)
     
     def rm_ext_handler_dir(self):
+        self.manifest = None
+        self.state_store.remove_handler(self.get_full_name())
+        self.state_store.remove_installed(self.ext_handler.name, self.version)
+        self.status_watcher.unwatch(self.get_base_dir())
         try:
             handler_state_dir = self.get_handler_state_dir()
             if os.path.isdir(handler_state_dir):
@@ -475,6 +847,7 @@ class ExtHandlerInstance(object):
         except IOError as e:
             message = "Failed to rm ext handler dir: {0}".format(e)
             self.report_event(message=message, is_success=False)
+        self.close_logger()
 
     def update(self):
         self.logger.info("Update extension.")
@@ -493,8 +866,11 @@ class ExtHandlerInstance(object):
         self.set_handler_state(ExtHandlerState.Installed)
 
     def get_largest_seq_no(self):
+        return self.status_watcher.get_dir_value(self.get_conf_dir(),
+                                                 self.scan_largest_seq_no)
+
+    def scan_largest_seq_no(self, conf_dir):
         seq_no = -1
-        conf_dir = self.get_conf_dir()
         for item in os.listdir(conf_dir):
             item_path = os.path.join(conf_dir, item)
             if os.path.isfile(item_path):
@@ -517,13 +893,13 @@ class ExtHandlerInstance(object):
             return None
 
         status_dir = self.get_status_dir()
+        self.status_watcher.watch(status_dir, notify=True)
         ext_status_file = "{0}.status".format(seq_no)
         ext_status_file = os.path.join(status_dir, ext_status_file)
 
         ext_status = ExtensionStatus(seq_no=seq_no)
         try:
-            data_str = fileutil.read_file(ext_status_file)
-            data = json.loads(data_str)
+            data = self.status_watcher.read_json(ext_status_file)
             parse_ext_status(ext_status, data)
         except IOError as e:
             ext_status.message = u"Failed to get status file {0}".format(e)
@@ -538,10 +914,13 @@ class ExtHandlerInstance(object):
     
     def report_ext_status(self):
         active_exts = []
+        self.transitioning = False
         for ext in self.ext_handler.properties.extensions:
             ext_status = self.collect_ext_status(ext)
             if ext_status is None:
                 continue
+            if ext_status.status == "transitioning":
+                self.transitioning = True
             try:
                 self.protocol.report_ext_status(self.ext_handler.name, ext.name, 
                                                 ext_status)
@@ -581,6 +960,7 @@ class ExtHandlerInstance(object):
    
     def launch_command(self, cmd, timeout=300):
         self.logger.info("Launch command:{0}", cmd)
+        start = time.time()
         base_dir = self.get_base_dir()
         try:
             devnull = open(os.devnull, 'w')
@@ -602,9 +982,14 @@ class ExtHandlerInstance(object):
         if ret == None or ret != 0:
             raise ExtensionError("Non-zero exit code: {0}, {1}".format(ret, cmd))
 
+        duration = time.time() - start
+        self.logger.with_context(duration=duration).info(
+            "Command succeeded in {0:.1f}s: {1}", duration, cmd)
         self.report_event(message="Launch command succeeded: {0}".format(cmd))
 
     def load_manifest(self):
+        if self.manifest is not None:
+            return self.manifest
         man_file = self.get_manifest_file()
         try:
             data = json.loads(fileutil.read_file(man_file))
@@ -613,7 +998,8 @@ class ExtHandlerInstance(object):
         except ValueError as e:
             raise ExtensionError('Malformed manifest file.')
 
-        return HandlerManifest(data[0])
+        self.manifest = HandlerManifest(data[0])
+        return self.manifest
 
     def update_settings_file(self, settings_file, settings):
         settings_file = os.path.join(self.get_conf_dir(), settings_file)
@@ -663,78 +1049,46 @@ class ExtHandlerInstance(object):
             raise ExtensionError(u"Failed to save handler environment", e)
     
     def get_handler_state_dir(self):
-        return os.path.join(conf.get_lib_dir(), "handler_state", 
-                            self.get_full_name())
+        return self.handler_state_dir
 
     def set_handler_state(self, handler_state):
-        state_dir = self.get_handler_state_dir()
-        if not os.path.exists(state_dir):
-            try:
-                fileutil.mkdir(state_dir, 0o700)
-            except IOError as e:
-                self.logger.error("Failed to create state dir: {0}", e)
-        
-        try:
-            state_file = os.path.join(state_dir, "state")
-            fileutil.write_file(state_file, handler_state)
-        except IOError as e:
-            self.logger.error("Failed to set state: {0}", e)
+        self.state_store.set_handler_state(self.get_full_name(), handler_state)
     
     def get_handler_state(self):
-        state_dir = self.get_handler_state_dir()
-        state_file = os.path.join(state_dir, "state")
-        if not os.path.isfile(state_file):
-            return ExtHandlerState.NotInstalled
-
-        try:
-            return fileutil.read_file(state_file)
-        except IOError as e:
-            self.logger.error("Failed to get state: {0}", e)
+        state = self.state_store.get_handler_state(self.get_full_name())
+        if state is None:
             return ExtHandlerState.NotInstalled
+        return state
     
     def set_handler_status(self, status="NotReady", message="", 
                            code=0):
-        state_dir = self.get_handler_state_dir()
-        if not os.path.exists(state_dir):
-            try:
-                fileutil.mkdir(state_dir, 0o700)
-            except IOError as e:
-                self.logger.error("Failed to create state dir: {0}", e)
-        
         handler_status = ExtHandlerStatus()
         handler_status.name = self.ext_handler.name
         handler_status.version = self.ext_handler.properties.version
         handler_status.message = message
         handler_status.code = code
         handler_status.status = status
-        status_file = os.path.join(state_dir, "status")
-
-        try:
-            fileutil.write_file(status_file, 
-                                json.dumps(get_properties(handler_status)))
-        except (IOError, ValueError, ProtocolError) as e:
-            self.logger.error("Failed to save handler status: {0}", e)
+        data = get_properties(handler_status)
+        self.state_store.set_handler_status(self.get_full_name(), data)
         
     def get_handler_status(self):
-        state_dir = self.get_handler_state_dir()
-        status_file = os.path.join(state_dir, "status")
-        if not os.path.isfile(status_file):
+        data = self.state_store.get_handler_status(self.get_full_name())
+        if data is None:
             return None
         
         try:
-            data = json.loads(fileutil.read_file(status_file))
+            #Always return a new object, caller will append extension status
             handler_status = ExtHandlerStatus() 
             set_properties("ExtHandlerStatus", handler_status, data)
             return handler_status
-        except (IOError, ValueError) as e:
+        except ProtocolError as e:
             self.logger.error("Failed to get handler status: {0}", e)
 
     def get_full_name(self):
-        return "{0}-{1}".format(self.ext_handler.name, 
-                                self.ext_handler.properties.version)
+        return self.full_name
    
     def get_base_dir(self):
-        return os.path.join(conf.get_lib_dir(), self.get_full_name())
+        return self.base_dir
 
     def get_status_dir(self):
         return os.path.join(self.get_base_dir(), "status")
@@ -752,8 +1106,7 @@ class ExtHandlerInstance(object):
         return os.path.join(self.get_base_dir(), 'HandlerEnvironment.json')
 
     def get_log_dir(self):
-        return os.path.join(conf.get_ext_log_dir(), self.ext_handler.name,
-                            self.ext_handler.properties.version)
+        return self.log_dir
 
 class HandlerEnvironment(object):
     def __init__(self, data):
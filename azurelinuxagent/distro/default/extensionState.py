@@ -0,0 +1,296 @@
+# Microsoft Azure Linux Agent
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.4+ and Openssl 1.0+
+#
+import os
+import re
+import json
+import threading
+import azurelinuxagent.conf as conf
+import azurelinuxagent.logger as logger
+import azurelinuxagent.utils.fileutil as fileutil
+from azurelinuxagent.utils.textutil import Version
+
+HANDLER_STATE_FILE_NAME = "HandlerState.json"
+
+#Per handler state dir used by previous versions of the agent
+LEGACY_HANDLER_STATE_DIR_NAME = "handler_state"
+
+HANDLER_VERSION_RE = re.compile(r'^\d+(\.\d+)*$')
+
+def scan_installed_handlers(lib_dir):
+    """
+    Find installed ext handlers by the "<name>-<version>" dirs under lib dir.
+    Hidden temp and backup dirs of updates are skipped.
+    Return dict of name -> list of versions
+    """
+    installed = {}
+    for dir_name in os.listdir(lib_dir):
+        if dir_name.startswith('.'):
+            continue
+        path = os.path.join(lib_dir, dir_name)
+        if not os.path.isdir(path):
+            continue
+        seperator = dir_name.rfind('-')
+        if seperator <= 0:
+            continue
+        name = dir_name[0: seperator]
+        version = dir_name[seperator + 1:]
+        if HANDLER_VERSION_RE.match(version) is None:
+            continue
+        installed.setdefault(name, []).append(version)
+    return installed
+
+class ExtHandlerStateStore(object):
+    """
+    In-memory state of all ext handlers, keyed by handler full name.
+
+    The whole store is loaded once from a single snapshot file under lib dir.
+    Changes are only written back by flush(), and only if something changed.
+    The snapshot is replaced atomically, so a crash never leaves a partial
+    state behind.
+
+    The store also keeps the inventory of installed handler versions, so 
+    that finding the installed version doesn't need to scan lib dir, and
+    the last handled goal state.
+    """
+    def __init__(self):
+        self.handlers = None
+        self.installed = None
+        self.goal_state = None
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    def get_snapshot_file(self):
+        return os.path.join(conf.get_lib_dir(), HANDLER_STATE_FILE_NAME)
+
+    def get_legacy_dir(self):
+        return os.path.join(conf.get_lib_dir(), LEGACY_HANDLER_STATE_DIR_NAME)
+
+    def load(self):
+        self.lock.acquire()
+        try:
+            if self.handlers is not None:
+                return
+            self.handlers = {}
+            snapshot_file = self.get_snapshot_file()
+            if os.path.isfile(snapshot_file):
+                try:
+                    data = json.loads(fileutil.read_file(snapshot_file))
+                    handlers = data["handlers"]
+                    goal_state = data.get("goal_state")
+                except (IOError, ValueError, KeyError, TypeError,
+                        AttributeError) as e:
+                    logger.warn("Failed to load handler state: {0}", e)
+                else:
+                    self.handlers = handlers
+                    self.goal_state = goal_state
+                    #Only the inventory is rebuilt from lib dir if corrupt
+                    try:
+                        self.load_installed(data.get("installed"))
+                    except (ValueError, TypeError, AttributeError) as e:
+                        logger.warn("Failed to load installed ext handler "
+                                    "inventory: {0}", e)
+                        self.installed = None
+                    return
+            self.load_legacy()
+        finally:
+            self.lock.release()
+
+    def load_legacy(self):
+        """
+        Import handler_state/<name>/{state,status} left by previous agent
+        """
+        legacy_dir = self.get_legacy_dir()
+        if not os.path.isdir(legacy_dir):
+            return
+        for full_name in os.listdir(legacy_dir):
+            state_dir = os.path.join(legacy_dir, full_name)
+            if not os.path.isdir(state_dir):
+                continue
+            handler = {}
+            try:
+                state_file = os.path.join(state_dir, "state")
+                if os.path.isfile(state_file):
+                    handler["state"] = fileutil.read_file(state_file)
+                status_file = os.path.join(state_dir, "status")
+                if os.path.isfile(status_file):
+                    handler["status"] = json.loads(fileutil.read_file(status_file))
+            except (IOError, ValueError) as e:
+                logger.warn("Failed to import handler state: {0}, {1}",
+                            full_name, e)
+            if len(handler) > 0:
+                self.handlers[full_name] = handler
+                self.dirty = True
+
+    def load_installed(self, data):
+        if data is None:
+            self.installed = None
+            return
+        installed = {}
+        for name, versions in data.items():
+            installed[name] = sorted(versions, key=Version)
+        self.installed = installed
+
+    def get_installed(self):
+        """
+        Return the inventory. It is rebuilt from lib dir if missing.
+        """
+        self.load()
+        if self.installed is None:
+            logger.info("Rebuild installed ext handler inventory")
+            installed = {}
+            try:
+                installed = scan_installed_handlers(conf.get_lib_dir())
+            except OSError as e:
+                logger.warn("Failed to scan ext handlers: {0}", e)
+            self.load_installed(installed)
+            self.dirty = True
+        return self.installed
+
+    def get_installed_versions(self, name):
+        """
+        Return installed versions of the handler, sorted by version.
+        """
+        self.lock.acquire()
+        try:
+            return list(self.get_installed().get(name, []))
+        finally:
+            self.lock.release()
+
+    def add_installed(self, name, version):
+        self.lock.acquire()
+        try:
+            versions = self.get_installed().setdefault(name, [])
+            if version not in versions:
+                versions.append(version)
+                versions.sort(key=Version)
+                self.dirty = True
+        finally:
+            self.lock.release()
+
+    def remove_installed(self, name, version):
+        self.lock.acquire()
+        try:
+            installed = self.get_installed()
+            versions = installed.get(name)
+            if versions is None or version not in versions:
+                return
+            versions.remove(version)
+            if len(versions) == 0:
+                del installed[name]
+            self.dirty = True
+        finally:
+            self.lock.release()
+
+    def get_goal_state(self):
+        """
+        Return dict of the last handled goal state. Caller should not
+        modify it.
+        """
+        self.lock.acquire()
+        try:
+            self.load()
+            if self.goal_state is None:
+                return {}
+            return self.goal_state
+        finally:
+            self.lock.release()
+
+    def set_goal_state(self, goal_state):
+        self.lock.acquire()
+        try:
+            self.load()
+            if self.goal_state != goal_state:
+                self.goal_state = goal_state
+                self.dirty = True
+        finally:
+            self.lock.release()
+
+    def _get_handler(self, full_name, create=False):
+        self.load()
+        handler = self.handlers.get(full_name)
+        if handler is None and create:
+            handler = {}
+            self.handlers[full_name] = handler
+        return handler
+
+    def _set(self, full_name, key, value):
+        self.lock.acquire()
+        try:
+            handler = self._get_handler(full_name, create=True)
+            if handler.get(key) != value:
+                handler[key] = value
+                self.dirty = True
+        finally:
+            self.lock.release()
+
+    def _get(self, full_name, key):
+        self.lock.acquire()
+        try:
+            handler = self._get_handler(full_name)
+            if handler is None:
+                return None
+            return handler.get(key)
+        finally:
+            self.lock.release()
+
+    def get_handler_state(self, full_name):
+        return self._get(full_name, "state")
+
+    def set_handler_state(self, full_name, state):
+        self._set(full_name, "state", state)
+
+    def get_handler_status(self, full_name):
+        """
+        Return the dict of handler status. Caller should not modify it.
+        """
+        return self._get(full_name, "status")
+
+    def set_handler_status(self, full_name, status):
+        self._set(full_name, "status", status)
+
+    def remove_handler(self, full_name):
+        self.lock.acquire()
+        try:
+            self.load()
+            if full_name in self.handlers:
+                del self.handlers[full_name]
+                self.dirty = True
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """
+        Persist the store if it has been changed since last flush
+        """
+        self.lock.acquire()
+        try:
+            if not self.dirty or self.handlers is None:
+                return
+            data = json.dumps({
+                "handlers": self.handlers,
+                "installed": self.installed,
+                "goal_state": self.goal_state
+            })
+            try:
+                fileutil.write_file_atomic(self.get_snapshot_file(), data)
+                self.dirty = False
+            except (IOError, OSError) as e:
+                logger.error("Failed to save handler state: {0}", e)
+        finally:
+            self.lock.release()
@@ -0,0 +1,295 @@
+# Microsoft Azure Linux Agent
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.4+ and Openssl 1.0+
+#
+import os
+import json
+import time
+import select
+import threading
+import azurelinuxagent.logger as logger
+import azurelinuxagent.utils.fileutil as fileutil
+from azurelinuxagent.utils.inotifyutil import Inotify, IN_Q_OVERFLOW, \
+                                              IN_IGNORED
+
+#Wait for extension to finish writing status before reporting it
+DEBOUNCE_INTERVAL = 1
+
+#Interval of stat polling when inotify is not available
+POLL_INTERVAL = 2
+
+#Timestamps closer than this to now could be changed again within the
+#same tick on file systems with coarse timestamps. Don't trust them.
+RACY_INTERVAL = 2
+
+def _get_stamp(path):
+    try:
+        stat = os.stat(path)
+        return (stat.st_mtime, stat.st_size, stat.st_ino)
+    except OSError:
+        return None
+
+def _is_racy(stamp):
+    return stamp is not None and stamp[0] >= time.time() - RACY_INTERVAL
+
+class WatchedDir(object):
+    def __init__(self, path, notify):
+        self.path = path
+        self.notify = notify
+        self.wd = None
+        self.dirty = True
+        self.stamp = None
+        self.value = None
+
+class ExtStatusWatcher(object):
+    """
+    Watch config and status dirs of ext handlers and cache what the agent
+    reads from them, i.e. the largest settings sequence number and the
+    parsed status files.
+
+    Changes are detected with inotify when it's available. Otherwise the
+    cache is validated by stat on each access. When started, a background
+    thread calls on_change shortly after an extension updates its status.
+    """
+    def __init__(self, on_change=None):
+        self.on_change = on_change
+        self.inotify = None
+        self.dirs = {}
+        self.wds = {}
+        self.files = {}
+        self.lock = threading.RLock()
+        self.stopped = True
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.pending = False
+        self.last_change = None
+
+    def get_inotify(self):
+        if self.inotify is None:
+            self.inotify = Inotify()
+            if not self.inotify.is_available():
+                logger.info("Inotify is not available, fall back to polling")
+        return self.inotify
+
+    def watch(self, path, notify=False):
+        """
+        Watch a directory. If notify is True, changes under it will trigger
+        on_change.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.dirs.get(path)
+            if entry is None:
+                entry = WatchedDir(path, notify)
+                self.dirs[path] = entry
+            entry.notify = entry.notify or notify
+            inotify = self.get_inotify()
+            if entry.wd is None and inotify.is_available() and \
+                    os.path.isdir(path):
+                entry.wd = inotify.add_watch(path)
+                if entry.wd is not None:
+                    self.wds[entry.wd] = entry
+            return entry
+        finally:
+            self.lock.release()
+
+    def unwatch(self, base_dir):
+        """
+        Stop watching all the directories under base_dir
+        """
+        self.lock.acquire()
+        try:
+            prefix = os.path.join(base_dir, "")
+            for path in list(self.dirs.keys()):
+                if path == base_dir or path.startswith(prefix):
+                    entry = self.dirs.pop(path)
+                    if entry.wd is not None:
+                        self.wds.pop(entry.wd, None)
+                        self.get_inotify().rm_watch(entry.wd)
+            for path in list(self.files.keys()):
+                if path.startswith(prefix):
+                    del self.files[path]
+        finally:
+            self.lock.release()
+
+    def process_events(self):
+        """
+        Apply pending inotify events to the cache.
+        Return True if any dir with notify flag is changed.
+        """
+        if self.inotify is None or not self.inotify.is_available():
+            return False
+        changed = False
+        self.lock.acquire()
+        try:
+            for wd, mask, name in self.inotify.read_events():
+                if mask & IN_Q_OVERFLOW:
+                    #Events are lost, invalidate everything
+                    for entry in self.dirs.values():
+                        entry.dirty = True
+                        changed = changed or entry.notify
+                    self.files = {}
+                    continue
+                entry = self.wds.get(wd)
+                if entry is None:
+                    continue
+                if mask & IN_IGNORED:
+                    #Dir is removed, fall back to stat until watched again
+                    del self.wds[wd]
+                    entry.wd = None
+                entry.dirty = True
+                if name:
+                    self.files.pop(os.path.join(entry.path, name), None)
+                changed = changed or entry.notify
+            self.pending = self.pending or changed
+        finally:
+            self.lock.release()
+        return changed
+
+    def is_changed(self, entry):
+        if entry.wd is not None:
+            return entry.dirty
+        stamp = _get_stamp(entry.path)
+        if stamp is None or stamp != entry.stamp or _is_racy(stamp):
+            entry.stamp = stamp
+            return True
+        return entry.dirty
+
+    def get_dir_value(self, path, compute):
+        """
+        Return compute(path). The value is cached until the dir is changed.
+        """
+        self.process_events()
+        self.lock.acquire()
+        try:
+            entry = self.watch(path)
+            if self.is_changed(entry) or entry.value is None:
+                entry.dirty = False
+                entry.value = compute(path)
+            return entry.value
+        finally:
+            self.lock.release()
+
+    def read_json(self, path):
+        """
+        Return parsed json content of the file. Parsing is skipped if the file
+        is not changed since last read. Raise IOError or ValueError.
+        """
+        self.process_events()
+        self.lock.acquire()
+        try:
+            watched = self.dirs.get(os.path.dirname(path))
+            cached = self.files.get(path)
+            if watched is not None and watched.wd is not None:
+                stamp = None
+                valid = cached is not None
+            else:
+                stamp = _get_stamp(path)
+                valid = cached is not None and stamp is not None and \
+                        cached[0] == stamp and not _is_racy(stamp)
+            if valid:
+                return cached[1]
+            data = json.loads(fileutil.read_file(path))
+            self.files[path] = (stamp, data)
+            return data
+        finally:
+            self.lock.release()
+
+    def poll(self):
+        """
+        Stat polling fallback. Return True if any dir with notify flag or
+        any cached file under it has been changed.
+        """
+        changed = False
+        self.lock.acquire()
+        try:
+            for entry in list(self.dirs.values()):
+                if not entry.notify or entry.wd is not None:
+                    continue
+                stamp = _get_stamp(entry.path)
+                if stamp != entry.stamp:
+                    entry.stamp = stamp
+                    entry.dirty = True
+                    changed = True
+            for path, cached in list(self.files.items()):
+                entry = self.dirs.get(os.path.dirname(path))
+                if entry is None or not entry.notify or entry.wd is not None:
+                    continue
+                if _get_stamp(path) != cached[0]:
+                    del self.files[path]
+                    changed = True
+            self.pending = self.pending or changed
+        finally:
+            self.lock.release()
+        return changed
+
+    def start(self):
+        if not self.stopped:
+            return
+        self.stopped = False
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.monitor)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped = True
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def wait(self, timeout):
+        inotify = self.get_inotify()
+        if inotify.is_available():
+            try:
+                select.select([inotify.fileno()], [], [], timeout)
+            except (select.error, OSError):
+                self.stop_event.wait(timeout)
+            self.process_events()
+        else:
+            self.stop_event.wait(timeout)
+            self.poll()
+
+    def monitor(self):
+        while not self.stopped:
+            timeout = POLL_INTERVAL
+            if self.last_change is not None:
+                timeout = max(0, self.last_change + DEBOUNCE_INTERVAL -
+                                 time.time())
+            try:
+                self.wait(timeout)
+            except Exception as e:
+                logger.warn("Failed to watch ext handler status: {0}", e)
+                self.stop_event.wait(POLL_INTERVAL)
+
+            self.lock.acquire()
+            try:
+                if self.pending:
+                    self.pending = False
+                    #A burst of changes is reported once, a second after
+                    #the first change.
+                    if self.last_change is None:
+                        self.last_change = time.time()
+            finally:
+                self.lock.release()
+
+            if self.last_change is not None and \
+                    time.time() - self.last_change >= DEBOUNCE_INTERVAL:
+                self.last_change = None
+                if self.on_change is not None:
+                    self.on_change()
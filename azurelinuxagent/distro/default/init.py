@@ -40,9 +40,18 @@ class InitHandler(object):
         verbose = verbose or conf.get_logs_verbose()
         level = logger.LogLevel.VERBOSE if verbose else logger.LogLevel.INFO
         logger.add_logger_appender(logger.AppenderType.FILE, level,
-                                 path="/var/log/waagent.log")
+                                 path="/var/log/waagent.log",
+                                 max_size=conf.get_logs_rotate_size(),
+                                 backup_count=conf.get_logs_rotate_count())
         logger.add_logger_appender(logger.AppenderType.CONSOLE, level,
                                  path="/dev/console")
+        json_file = conf.get_logs_json_file()
+        if json_file is not None:
+            logger.add_logger_appender(logger.AppenderType.JSON_FILE, level,
+                                 path=json_file,
+                                 max_size=conf.get_logs_rotate_size(),
+                                 backup_count=conf.get_logs_rotate_count())
+        logger.set_context(component="WALA")
 
         #Init event reporter
         event_dir = os.path.join(conf.get_lib_dir(), "events")
@@ -22,11 +22,14 @@ import atexit
 import json
 import time
 import datetime
-import threading
 import platform
 import azurelinuxagent.logger as logger
 import azurelinuxagent.conf as conf
-from azurelinuxagent.event import WALAEventOperation, add_event
+import azurelinuxagent.metrics as metrics
+from azurelinuxagent.event import WALAEventOperation, add_event, \
+                                  get_event_spool, flush_events, \
+                                  set_flush_listener, \
+                                  is_event_record, parse_event_record
 from azurelinuxagent.exception import EventError, ProtocolError, OSUtilError
 from azurelinuxagent.future import ustr
 from azurelinuxagent.utils.textutil import parse_doc, findall, find, getattrib
@@ -36,7 +39,29 @@ from azurelinuxagent.protocol.restapi import TelemetryEventParam, \
                                              set_properties, get_properties
 from azurelinuxagent.metadata import DISTRO_NAME, DISTRO_VERSION, \
                                      DISTRO_CODE_NAME, AGENT_LONG_VERSION
+from azurelinuxagent.distro.default.scheduler import Task
 
+MONITOR_TASK = "Monitor"
+
+#Interval of sending events, in seconds
+EVENT_INTERVAL = 60
+
+HEARTBEAT_PERIOD = 12 * 60 * 60
+
+#Interval of publishing a summary of agent metrics
+METRICS_PERIOD = 60 * 60
+
+#Max size of spooled events sent in one batch
+EVENT_BATCH_SIZE = 32 * 1024
+
+#Failed batches are retried with exponential backoff
+EVENT_RETRY_INTERVAL = 15
+EVENT_RETRY_MAX_INTERVAL = 15 * 60
+
+#Attempts to send a batch of spooled events before it's split in half, or
+#if it's a single event, dropped. So an event the server never accepts
+#doesn't hold back the ones after it.
+EVENT_BATCH_MAX_ATTEMPTS = 5
 
 def parse_event(data_str):
     try:
@@ -80,12 +105,37 @@ def parse_json_event(data_str):
 class MonitorHandler(object):
     def __init__(self, distro):
         self.distro = distro
+        self.osinfo = []
         self.sysinfo = []
+        self.sysinfo_initialized = False
+        self.vminfo_key = None
+        self.last_heartbeat = None
+        self.heartbeat_period = None
+        self.last_metrics_report = datetime.datetime.now()
+        self.send_failures = 0
+        #Failed attempts of the first unsent batch, and the size of batches
+        #till the spool is drained
+        self.batch_attempts = 0
+        self.batch_size = EVENT_BATCH_SIZE
   
     def run(self):
-        event_thread = threading.Thread(target = self.daemon)
-        event_thread.setDaemon(True)
-        event_thread.start()
+        #Agents started together don't send events in lock-step
+        delay = self.distro.task_timing.get_phase_offset(EVENT_INTERVAL)
+        task = Task(MONITOR_TASK, self.send_events,
+                    interval=self.get_event_interval, delay=delay,
+                    offload=True)
+        self.distro.task_scheduler.add_task(task)
+        #Bursts of events are sent right away
+        set_flush_listener(self.wake)
+
+    def wake(self):
+        """
+        Send events now, unless sending is failing and backing off
+        """
+        if self.send_failures > 0:
+            return
+        metrics.inc_counter("event.early_flush")
+        self.distro.task_scheduler.trigger(MONITOR_TASK)
 
     def init_sysinfo(self):
         osversion = "{0}:{1}-{2}-{3}:{4}".format(platform.system(),
@@ -95,32 +145,48 @@ class MonitorHandler(object):
                                                  platform.release())
         
 
-        self.sysinfo.append(TelemetryEventParam("OSVersion", osversion))
-        self.sysinfo.append(TelemetryEventParam("GAVersion", AGENT_LONG_VERSION))
+        self.osinfo.append(TelemetryEventParam("OSVersion", osversion))
+        self.osinfo.append(TelemetryEventParam("GAVersion", AGENT_LONG_VERSION))
     
         try:
             ram = self.distro.osutil.get_total_mem()
             processors = self.distro.osutil.get_processor_cores()
-            self.sysinfo.append(TelemetryEventParam("RAM", ram))
-            self.sysinfo.append(TelemetryEventParam("Processors", processors))
+            self.osinfo.append(TelemetryEventParam("RAM", ram))
+            self.osinfo.append(TelemetryEventParam("Processors", processors))
         except OSUtilError as e:
             logger.warn("Failed to get system info: {0}", e)
+        self.sysinfo = list(self.osinfo)
 
+    def update_sysinfo(self):
+        """
+        Rebuild system info when vm info is changed. It's sent as common
+        parameters of the events, which protocol encodes only once.
+        """
         try:
             protocol = self.distro.protocol_util.get_protocol()
             vminfo = protocol.get_vminfo()
-            self.sysinfo.append(TelemetryEventParam("VMName", 
-                                                    vminfo.vmName)) 
-            self.sysinfo.append(TelemetryEventParam("TenantName", 
-                                                    vminfo.tenantName)) 
-            self.sysinfo.append(TelemetryEventParam("RoleName", 
-                                                    vminfo.roleName)) 
-            self.sysinfo.append(TelemetryEventParam("RoleInstanceName", 
-                                                    vminfo.roleInstanceName)) 
-            self.sysinfo.append(TelemetryEventParam("ContainerId", 
-                                                    vminfo.containerId)) 
         except ProtocolError as e:
             logger.warn("Failed to get system info: {0}", e)
+            return
+        vminfo_key = (vminfo.vmName, vminfo.tenantName, vminfo.roleName,
+                      vminfo.roleInstanceName, vminfo.containerId)
+        if vminfo_key == self.vminfo_key:
+            return
+        self.vminfo_key = vminfo_key
+        sysinfo = list(self.osinfo)
+        sysinfo.append(TelemetryEventParam("VMName", vminfo.vmName))
+        sysinfo.append(TelemetryEventParam("TenantName", vminfo.tenantName))
+        sysinfo.append(TelemetryEventParam("RoleName", vminfo.roleName))
+        sysinfo.append(TelemetryEventParam("RoleInstanceName",
+                                           vminfo.roleInstanceName))
+        sysinfo.append(TelemetryEventParam("ContainerId",
+                                           vminfo.containerId))
+        self.sysinfo = sysinfo
+
+    def new_event_list(self):
+        event_list = TelemetryEventList()
+        event_list.common_params.extend(self.sysinfo)
+        return event_list
 
     def collect_event(self, evt_file_name):
         try:
@@ -129,16 +195,99 @@ class MonitorHandler(object):
             #if fail to open or delete the file, throw exception
                 data_str = evt_file.read().decode("utf-8",'ignore')
             logger.verb("Processed event file: {0}", evt_file_name)
-            os.remove(evt_file_name)
             return data_str
         except IOError as e:
             msg = "Failed to process {0}, {1}".format(evt_file_name, e)
             raise EventError(msg)
 
-    def collect_and_send_events(self):
-        event_list = TelemetryEventList()
+    def add_event_data(self, event_list, data_str):
+        try:
+            if is_event_record(data_str):
+                event_list.encoded_events.append(parse_event_record(data_str))
+            else:
+                event_list.events.append(parse_event(data_str))
+        except (ValueError, ProtocolError) as e:
+            metrics.inc_counter("event.dropped")
+            logger.warn("Failed to decode event file: {0}", e)
+
+    def send_event_list(self, protocol, event_list):
+        """
+        Return True if the events are sent
+        """
+        count = len(event_list.events) + len(event_list.encoded_events)
+        if count == 0:
+            return True
+        try:
+            dropped = protocol.report_event(event_list)
+        except ProtocolError as e:
+            logger.warn("Failed to send events: {0}", e)
+            return False
+        if dropped is None:
+            dropped = 0
+        if dropped > 0:
+            metrics.inc_counter("event.dropped", dropped)
+        metrics.inc_counter("event.delivered", count - dropped)
+        return True
+
+    def send_spooled_events(self, protocol, spool):
+        """
+        Send spooled events in batches. A batch is only removed from the
+        spool after it's sent, or dropped after EVENT_BATCH_MAX_ATTEMPTS.
+        Return False if any batch is not sent and will be retried.
+        """
+        cursor = None
+        while True:
+            records, next_cursor = spool.read(max_bytes=self.batch_size,
+                                              cursor=cursor)
+            if len(records) == 0:
+                if cursor is not None and next_cursor != cursor:
+                    #Corrupted records are skipped
+                    spool.commit(next_cursor)
+                self.batch_size = EVENT_BATCH_SIZE
+                return True
+            event_list = self.new_event_list()
+            for record in records:
+                self.add_event_data(event_list,
+                                    record.decode("utf-8", 'ignore'))
+            if self.send_event_list(protocol, event_list):
+                self.batch_attempts = 0
+            elif not self.on_batch_failed(records):
+                return False
+            spool.commit(next_cursor)
+            cursor = next_cursor
+
+    def on_batch_failed(self, records):
+        """
+        Return True if the batch is dropped, False if it's to be retried
+        """
+        self.batch_attempts += 1
+        if self.batch_attempts < EVENT_BATCH_MAX_ATTEMPTS:
+            return False
+        self.batch_attempts = 0
+        if len(records) > 1:
+            size = 0
+            for record in records:
+                size += len(record)
+            self.batch_size = max(1, size // 2)
+            logger.warn("Failed to send {0} events, split the batch",
+                        len(records))
+            return False
+        metrics.inc_counter("event.dropped")
+        logger.warn("Failed to send event {0} times, drop it",
+                    EVENT_BATCH_MAX_ATTEMPTS)
+        return True
+
+    def send_legacy_events(self, protocol):
+        """
+        Send event files left by previous versions of the agent. Return
+        False if they are not sent.
+        """
         event_dir = os.path.join(conf.get_lib_dir(), "events")
-        event_files = os.listdir(event_dir)
+        event_files = []
+        if os.path.isdir(event_dir):
+            event_files = os.listdir(event_dir)
+        event_list = self.new_event_list()
+        collected = []
         for event_file in event_files:
             if not event_file.endswith(".tld"):
                 continue
@@ -148,35 +297,103 @@ class MonitorHandler(object):
             except EventError as e:
                 logger.error("{0}", e)
                 continue
+            self.add_event_data(event_list, data_str)
+            collected.append(event_file_path)
 
+        if not self.send_event_list(protocol, event_list):
+            return False
+        for event_file_path in collected:
             try:
-                event = parse_event(data_str)
-                event.parameters.extend(self.sysinfo)
-                event_list.events.append(event)
-            except (ValueError, ProtocolError) as e:
-                logger.warn("Failed to decode event file: {0}", e)
-                continue
+                os.remove(event_file_path)
+            except OSError as e:
+                logger.error("Failed to remove {0}, {1}", event_file_path, e)
+        return True
 
-        if len(event_list.events) == 0:
-            return
-        
+    def update_spool_metrics(self, spool):
+        metrics.set_gauge("event.spool_depth", spool.get_pending_size())
+        oldest = spool.get_oldest_time()
+        age = 0
+        if oldest is not None:
+            age = max(0, time.time() - oldest)
+        metrics.set_gauge("event.oldest_age", age)
+
+    def collect_and_send_events(self):
+        """
+        Send all the events, at least once. Return False if any of them is
+        not sent, and will be retried.
+        """
+        spool = get_event_spool()
         try:
             protocol = self.distro.protocol_util.get_protocol()
-            protocol.report_event(event_list)
-        except ProtocolError as e:
-            logger.error("{0}", e)
+            sent = True
+            if spool is not None:
+                sent = self.send_spooled_events(protocol, spool)
+            return sent and self.send_legacy_events(protocol)
+        finally:
+            if spool is not None:
+                self.update_spool_metrics(spool)
+
+    def get_metrics_summary(self):
+        """
+        Return the agent metrics as a dict, histograms without buckets
+        """
+        data = metrics.get_metrics()
+        for name, histogram in data["histograms"].items():
+            data["histograms"][name] = {
+                "count": histogram["count"],
+                "sum": histogram["sum"],
+                "min": histogram["min"],
+                "max": histogram["max"]
+            }
+        return data
+
+    def report_metrics(self):
+        summary = json.dumps(self.get_metrics_summary(), sort_keys=True)
+        logger.info("Agent metrics: {0}", summary)
+        add_event(op=WALAEventOperation.Metrics, name="WALA", is_success=True,
+                  message=summary)
+
+    def get_retry_interval(self):
+        interval = EVENT_RETRY_INTERVAL * (2 ** min(self.send_failures - 1,
+                                                    16))
+        interval = min(interval, EVENT_RETRY_MAX_INTERVAL)
+        return self.distro.task_timing.jitter(interval)
     
-    def daemon(self):
-        self.init_sysinfo()
-        last_heartbeat = datetime.datetime.min
-        period = datetime.timedelta(hours = 12)
-        while(True):
-            if (datetime.datetime.now()-last_heartbeat) > period:
-                last_heartbeat = datetime.datetime.now()
-                add_event(op=WALAEventOperation.HeartBeat, name="WALA",
-                          is_success=True)
-            try:
-                self.collect_and_send_events()
-            except Exception as e:
-                logger.warn("Failed to send events: {0}", e)
-            time.sleep(60)
+    def send_events(self):
+        """
+        Send heartbeat and the events collected since last run. Return
+        seconds till retry if events are not sent.
+        """
+        if not self.sysinfo_initialized:
+            self.init_sysinfo()
+            self.sysinfo_initialized = True
+        self.update_sysinfo()
+
+        now = datetime.datetime.now()
+        if self.last_heartbeat is None or \
+                now - self.last_heartbeat > self.heartbeat_period:
+            self.last_heartbeat = now
+            period = self.distro.task_timing.jitter(HEARTBEAT_PERIOD)
+            self.heartbeat_period = datetime.timedelta(seconds=period)
+            add_event(op=WALAEventOperation.HeartBeat, name="WALA",
+                      is_success=True)
+        if now - self.last_metrics_report > \
+                datetime.timedelta(seconds=METRICS_PERIOD):
+            self.last_metrics_report = now
+            self.report_metrics()
+        try:
+            flush_events()
+            sent = self.collect_and_send_events()
+        except Exception as e:
+            logger.warn("Failed to send events: {0}", e)
+            sent = False
+
+        if sent:
+            self.send_failures = 0
+            return None
+        self.send_failures += 1
+        metrics.inc_counter("event.send_failures")
+        return self.get_retry_interval()
+
+    def get_event_interval(self):
+        return self.distro.task_timing.jitter(EVENT_INTERVAL)
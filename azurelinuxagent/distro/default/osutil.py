@@ -607,6 +607,15 @@ class DefaultOSUtil(object):
             return int(ret[1])
         else:
             raise OSUtilError("Failed to get procerssor cores")
+
+    def get_boot_id(self):
+        """
+        Return id of current boot, or None if not supported.
+        """
+        try:
+            return fileutil.read_file("/proc/sys/kernel/random/boot_id").strip()
+        except IOError:
+            return None
     
     def set_admin_access_to_ip(self, dest_ip):
         #This allows root to access dest_ip
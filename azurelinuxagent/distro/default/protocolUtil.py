@@ -226,6 +226,23 @@ class ProtocolUtil(object):
             self.lock.release()
         return self.protocol
 
+    def get_cached_protocol(self):
+        """
+        Get wire protocol instance with the endpoint saved by the last
+        detection, without probing. It can only read the goal state cached
+        on disk and report status, before protocol is detected.
+
+        :returns protocol instance
+        """
+        tag_file_path = os.path.join(conf.get_lib_dir(), TAG_FILE_NAME)
+        if os.path.isfile(tag_file_path):
+            raise ProtocolError("Metadata protocol has no cached goal state")
+        try:
+            endpoint = self._get_wireserver_endpoint()
+        except OSUtilError as e:
+            raise ProtocolError(ustr(e))
+        return WireProtocol(endpoint)
+
     def get_protocol(self):
         """
         Get protocol instance based on previous detecting result.
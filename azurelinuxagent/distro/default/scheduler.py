@@ -0,0 +1,445 @@
+# Microsoft Azure Linux Agent
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.4+ and Openssl 1.0+
+#
+
+import time
+import heapq
+import socket
+import random
+import hashlib
+import threading
+import traceback
+import azurelinuxagent.logger as logger
+import azurelinuxagent.metrics as metrics
+
+#Poll interval right after goal state is changed or while handlers are
+#transitioning
+FAST_POLL_INTERVAL = 3
+
+#How long to keep polling fast after goal state is changed
+FAST_POLL_WINDOW = 120
+
+#Ceiling of poll interval when idle
+MAX_POLL_INTERVAL = 120
+
+#Random spread of each interval, as a fraction of it
+POLL_JITTER = 0.1
+
+#Window over which agents started together spread their first requests
+STARTUP_SPREAD = 10
+
+class TaskTiming(object):
+    """
+    Per-VM timing of periodic tasks. Agents on VMs started together would
+    otherwise hit wire server in lock-step, so each VM gets a stable phase
+    offset derived from its identity, e.g. container id and role instance
+    id, and each interval gets bounded random jitter.
+    """
+    def __init__(self, vm_id=None, jitter=POLL_JITTER):
+        self.jitter_ratio = jitter
+        self.vm_id = None
+        self.phase = 0
+        self.rand = random.Random()
+        if vm_id is None:
+            vm_id = socket.gethostname()
+        self.set_vm_id(vm_id)
+
+    def set_vm_id(self, vm_id):
+        if vm_id == self.vm_id:
+            return
+        self.vm_id = vm_id
+        digest = hashlib.sha256(vm_id.encode('utf-8')).hexdigest()
+        #Phase is a fraction in [0, 1)
+        self.phase = int(digest[0:8], 16) / float(0x100000000)
+        self.rand = random.Random(int(digest[8:16], 16))
+
+    def get_phase_offset(self, period):
+        """
+        Stable offset within period for this VM
+        """
+        return self.phase * period
+
+    def random(self):
+        return self.rand.random()
+
+    def jitter(self, interval, ratio=None):
+        """
+        Return interval spread at random by up to ratio of it
+        """
+        if ratio is None:
+            ratio = self.jitter_ratio
+        return interval * (1 + ratio * (2 * self.rand.random() - 1))
+
+class GoalStatePollScheduler(object):
+    """
+    Decide when to poll for the next goal state. Poll fast for a while
+    after goal state is changed or while handlers are transitioning, and
+    back off exponentially up to a ceiling when idle.
+
+    Metrics:
+        goal_state.poll_interval     Effective interval of the next poll
+        goal_state.reaction_latency  Time from the last poll before a goal
+                                     state change till it's handled, i.e. the
+                                     upper bound of the time to react to it
+    """
+    def __init__(self, min_interval=FAST_POLL_INTERVAL,
+                 max_interval=MAX_POLL_INTERVAL, fast_window=FAST_POLL_WINDOW,
+                 jitter=POLL_JITTER, rand=random.random):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.fast_window = fast_window
+        self.jitter = jitter
+        self.rand = rand
+        self.base_interval = min_interval
+        self.fast_until = 0
+        self.last_poll = None
+        self.interval = None
+        self.reaction_latency = None
+
+    def next_interval(self, changed, busy, now=None):
+        """
+        Call after each poll. changed is True if a new goal state is
+        handled, busy is True if any handler is transitioning.
+        Return seconds to wait before the next poll.
+        """
+        if now is None:
+            now = time.time()
+
+        if changed:
+            self.fast_until = now + self.fast_window
+            if self.last_poll is not None:
+                self.reaction_latency = now - self.last_poll
+                metrics.observe("goal_state.reaction_latency",
+                                self.reaction_latency)
+                logger.verb("Goal state handled {0:.1f}s after last poll",
+                            self.reaction_latency)
+
+        if changed or busy or now < self.fast_until:
+            self.base_interval = self.min_interval
+        else:
+            self.base_interval = min(self.base_interval * 2, self.max_interval)
+
+        spread = self.base_interval * self.jitter * (2 * self.rand() - 1)
+        #Capped after the jitter, so that the ceiling is never exceeded
+        self.interval = min(max(self.min_interval,
+                                self.base_interval + spread),
+                            self.max_interval)
+        metrics.set_gauge("goal_state.poll_interval", self.interval)
+
+        self.last_poll = now
+        return self.interval
+
+#Tasks due within this window are run in the same wakeup
+COALESCE_WINDOW = 1
+
+#Number of threads running blocking tasks, i.e. extension handling, status
+#upload and telemetry
+OFFLOAD_WORKERS = 3
+
+#Seconds till a task whose lock is held is tried again
+LOCK_RETRY_INTERVAL = 1
+
+#Returned by a task function to remove the task
+TASK_DONE = "TaskDone"
+
+class Task(object):
+    """
+    Task run by TaskScheduler.
+
+    interval is seconds between runs, or a function returning it. If it's
+    None, the task only runs when triggered. The task function could also
+    return seconds till its next run, or TASK_DONE. Tasks with offload set
+    are blocking and run in the offload pool. Tasks sharing a lock never
+    run at the same time, a task whose lock is held is tried again later
+    instead of waiting for it. An exception escaping a critical task stops the
+    scheduler, so that its owner could restart.
+    """
+    def __init__(self, name, func, interval=None, delay=0, offload=False,
+                 lock=None, critical=False):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.delay = delay
+        self.offload = offload
+        self.lock = lock
+        self.critical = critical
+        self.entry = None
+        self.running = False
+        self.triggered = False
+        self.removed = False
+
+    def get_interval(self):
+        if callable(self.interval):
+            return self.interval()
+        return self.interval
+
+class TaskScheduler(object):
+    """
+    Run all periodic background tasks of the agent from one loop thread.
+
+    Tasks are kept in a heap ordered by due time. The loop sleeps until the
+    earliest task is due and runs all the tasks due within the coalesce
+    window at once. Blocking tasks are handed to a small pool of offload
+    threads, so they don't delay the others.
+
+    Exceptions escaping a task are passed to error_listener, if it's set,
+    with the task and the traceback. The traceback of a failed critical task
+    is kept in error.
+
+    Metrics per task:
+        scheduler.<name>.delay     Time from due till the task starts
+        scheduler.<name>.duration  Run time of the task
+        scheduler.<name>.failures  Count of exceptions escaping the task
+    """
+    def __init__(self, workers=OFFLOAD_WORKERS, coalesce=COALESCE_WINDOW):
+        self.workers = workers
+        self.coalesce = coalesce
+        self.cond = threading.Condition()
+        self.heap = []
+        self.tasks = {}
+        self.jobs = []
+        self.seq = 0
+        self.stopped = True
+        self.threads = []
+        self.loop_thread = None
+        self.error_listener = None
+        self.error = None
+
+    def start(self):
+        self.cond.acquire()
+        try:
+            if not self.stopped:
+                return
+            self.stopped = False
+            self.error = None
+        finally:
+            self.cond.release()
+
+        self.loop_thread = threading.Thread(target=self.loop)
+        self.loop_thread.setDaemon(True)
+        self.threads = [self.loop_thread]
+        for i in range(0, self.workers):
+            worker = threading.Thread(target=self.work)
+            worker.setDaemon(True)
+            self.threads.append(worker)
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        """
+        Remove all the tasks and wait for the running ones to finish.
+        """
+        self.cond.acquire()
+        try:
+            self.stopped = True
+            for task in self.tasks.values():
+                task.removed = True
+            self.tasks = {}
+            self.heap = []
+            self.jobs = []
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+        for thread in self.threads:
+            if thread is not threading.current_thread():
+                thread.join()
+        self.threads = []
+        self.loop_thread = None
+
+    def is_running(self):
+        return not self.stopped and self.loop_thread is not None and \
+               self.loop_thread.is_alive()
+
+    def join(self, timeout=None):
+        if self.loop_thread is not None:
+            self.loop_thread.join(timeout)
+
+    def _push(self, task, due):
+        self.seq += 1
+        task.entry = (due, self.seq)
+        heapq.heappush(self.heap, (due, self.seq, task))
+        self.cond.notify_all()
+
+    def add_task(self, task):
+        self.cond.acquire()
+        try:
+            old_task = self.tasks.get(task.name)
+            if old_task is not None:
+                old_task.removed = True
+            self.tasks[task.name] = task
+            self._push(task, time.time() + task.delay)
+        finally:
+            self.cond.release()
+
+    def remove_task(self, name, wait=True):
+        """
+        Remove the task. If wait is True, wait for its running to finish.
+        """
+        self.cond.acquire()
+        try:
+            task = self.tasks.pop(name, None)
+            if task is None:
+                return
+            task.removed = True
+            while wait and task.running and \
+                    threading.current_thread() not in self.threads:
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+    def trigger(self, name):
+        """
+        Run the task as soon as possible
+        """
+        self.cond.acquire()
+        try:
+            task = self.tasks.get(name)
+            if task is None:
+                return
+            if task.running:
+                task.triggered = True
+            else:
+                self._push(task, time.time())
+        finally:
+            self.cond.release()
+
+    def _pop_due(self):
+        """
+        Return tasks due within coalesce window, or seconds to wait.
+        """
+        now = time.time()
+        due_tasks = []
+        while len(self.heap) > 0 and self.heap[0][0] <= now + self.coalesce:
+            due, seq, task = heapq.heappop(self.heap)
+            #Skip removed tasks and entries replaced by a newer one
+            if task.removed or task.entry != (due, seq) or task.running:
+                continue
+            task.entry = None
+            task.running = True
+            due_tasks.append((task, due))
+        if len(due_tasks) > 0:
+            return due_tasks
+        if len(self.heap) > 0:
+            return self.heap[0][0] - now
+        return None
+
+    def loop(self):
+        while True:
+            self.cond.acquire()
+            try:
+                if self.stopped:
+                    return
+                due_tasks = self._pop_due()
+                if not isinstance(due_tasks, list):
+                    self.cond.wait(due_tasks)
+                    continue
+                for task, due in due_tasks:
+                    if task.offload:
+                        self.jobs.append((task, due))
+                        self.cond.notify_all()
+            finally:
+                self.cond.release()
+
+            for task, due in due_tasks:
+                if not task.offload:
+                    self.execute(task, due)
+
+    def work(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while not self.stopped and len(self.jobs) == 0:
+                    self.cond.wait()
+                if self.stopped:
+                    return
+                task, due = self.jobs.pop(0)
+            finally:
+                self.cond.release()
+            self.execute(task, due)
+
+    def on_error(self, task, err_msg):
+        metrics.inc_counter("scheduler.{0}.failures".format(task.name))
+        if self.error_listener is not None:
+            try:
+                self.error_listener(task, err_msg)
+            except Exception as e:
+                logger.warn("Failed to report error of task {0}: {1}",
+                            task.name, e)
+        if not task.critical:
+            return
+        #Wake up the owner waiting in join(), the tasks are kept till stop()
+        self.cond.acquire()
+        try:
+            self.error = err_msg
+            self.stopped = True
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    def execute(self, task, due):
+        #Not waited for, so that it doesn't hold up a worker or the loop
+        if task.lock is not None and not task.lock.acquire(False):
+            self.cond.acquire()
+            try:
+                task.running = False
+                if not task.removed:
+                    self._push(task, time.time() + LOCK_RETRY_INTERVAL)
+                self.cond.notify_all()
+            finally:
+                self.cond.release()
+            return
+        start = time.time()
+        metrics.observe("scheduler.{0}.delay".format(task.name),
+                        max(0, start - due))
+        result = None
+        err_msg = None
+        try:
+            try:
+                result = task.func()
+            except Exception:
+                err_msg = traceback.format_exc()
+                logger.warn("Task {0} failed: {1}", task.name, err_msg)
+        finally:
+            if task.lock is not None:
+                task.lock.release()
+        if err_msg is not None:
+            self.on_error(task, err_msg)
+        now = time.time()
+        metrics.observe("scheduler.{0}.duration".format(task.name),
+                        now - start)
+
+        self.cond.acquire()
+        try:
+            task.running = False
+            if result == TASK_DONE:
+                task.removed = True
+                if self.tasks.get(task.name) is task:
+                    del self.tasks[task.name]
+            elif not task.removed:
+                if task.triggered:
+                    task.triggered = False
+                    self._push(task, now)
+                elif result is not None:
+                    self._push(task, now + result)
+                else:
+                    interval = task.get_interval()
+                    if interval is not None:
+                        self._push(task, now + interval)
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
@@ -0,0 +1,117 @@
+# Microsoft Azure Linux Agent
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.4+ and Openssl 1.0+
+#
+
+import time
+import threading
+import azurelinuxagent.logger as logger
+import azurelinuxagent.metrics as metrics
+from azurelinuxagent.future import ustr
+from azurelinuxagent.event import add_event
+from azurelinuxagent.exception import ProtocolError
+from azurelinuxagent.distro.default.scheduler import Task
+
+STATUS_UPLOAD_TASK = "StatusUpload"
+
+#Interval to retry a failed upload, unless newer status is posted
+STATUS_RETRY_INTERVAL = 15
+
+class StatusReporter(object):
+    """
+    Upload vm status in background, so that a slow storage endpoint never
+    delays extension handling.
+
+    Status is posted to a single slot mailbox. A newer status replaces the
+    one not uploaded yet, so a burst of reports ends up in one upload of
+    the latest status. The report, with extension status, is taken from
+    the protocol at posting, so the upload never sees status of a later or
+    unfinished pass.
+
+    Metrics:
+        status.upload_latency  Time taken by an upload
+        status.queue_age       Time from posting a status till its upload
+        status.coalesced       Count of statuses replaced before uploaded
+        status.upload_failures Count of failed uploads
+    """
+    def __init__(self, task_scheduler):
+        self.task_scheduler = task_scheduler
+        self.lock = threading.Lock()
+        self.pending = None
+
+    def start(self):
+        self.task_scheduler.add_task(Task(STATUS_UPLOAD_TASK, self.upload,
+                                          offload=True))
+
+    def stop(self):
+        self.task_scheduler.remove_task(STATUS_UPLOAD_TASK)
+
+    def post(self, protocol, vm_status):
+        report = protocol.get_vm_status_report(vm_status)
+        self.lock.acquire()
+        try:
+            if self.pending is not None:
+                metrics.inc_counter("status.coalesced")
+            self.pending = (protocol, report, time.time())
+        finally:
+            self.lock.release()
+        self.task_scheduler.trigger(STATUS_UPLOAD_TASK)
+
+    def take(self):
+        self.lock.acquire()
+        try:
+            pending = self.pending
+            self.pending = None
+            return pending
+        finally:
+            self.lock.release()
+
+    def put_back(self, pending):
+        """
+        Keep failed status for retry, unless newer one is posted
+        """
+        self.lock.acquire()
+        try:
+            if self.pending is None:
+                self.pending = pending
+                return True
+            return False
+        finally:
+            self.lock.release()
+
+    def upload(self):
+        """
+        Upload the latest status. Return seconds till retry if failed.
+        """
+        pending = self.take()
+        if pending is None:
+            return None
+        protocol, report, posted = pending
+        start = time.time()
+        metrics.observe("status.queue_age", start - posted)
+        try:
+            protocol.upload_vm_status_report(report)
+            logger.verb("Successfully reported vm agent status")
+        except ProtocolError as e:
+            metrics.inc_counter("status.upload_failures")
+            message = "Failed to report vm agent status: {0}".format(e)
+            add_event(name="WALA", is_success=False, message=ustr(message))
+            if self.put_back(pending):
+                return STATUS_RETRY_INTERVAL
+        finally:
+            metrics.observe("status.upload_latency", time.time() - start)
+        return None
@@ -16,20 +16,23 @@
 #
 
 import os
+import re
 import sys
 import traceback
 import atexit
-import json
 import time
 import datetime
 import threading
 import platform
 import azurelinuxagent.logger as logger
+import azurelinuxagent.metrics as metrics
 from azurelinuxagent.exception import EventError, ProtocolError
 from azurelinuxagent.future import ustr
+from azurelinuxagent.utils.spoolutil import Spool
 from azurelinuxagent.protocol.restapi import TelemetryEventParam, \
                                              TelemetryEventList, \
                                              TelemetryEvent, \
+                                             event_params_to_v1, \
                                              set_properties, get_properties
 from azurelinuxagent.metadata import DISTRO_NAME, DISTRO_VERSION, \
                                      DISTRO_CODE_NAME, AGENT_VERSION
@@ -47,32 +50,294 @@ class WALAEventOperation:
     Update = "Update"
     ActivateResourceDisk="ActivateResourceDisk"
     UnhandledError="UnhandledError"
+    EventSuppressed="EventSuppressed"
+    Metrics="Metrics"
+
+#Spooled events are encoded as wire protocol parameters, after a line of
+#this prefix, event id and provider id. So they are sent without parsing.
+EVENT_RECORD_PREFIX = "v1 "
+
+def encode_event_record(event):
+    return "{0}{1} {2}\n{3}".format(EVENT_RECORD_PREFIX, event.eventId,
+                                    event.providerId,
+                                    event_params_to_v1(event.parameters))
+
+def parse_event_record(data_str):
+    """
+    Return (event id, provider id, encoded parameters) of the record
+    """
+    header, params = data_str.split("\n", 1)
+    event_id, provider_id = header[len(EVENT_RECORD_PREFIX):].split(" ")
+    return event_id, provider_id, params
+
+def is_event_record(data_str):
+    return data_str.startswith(EVENT_RECORD_PREFIX)
+
+#Same events within the window are written once, then reported with a count
+EVENT_AGGREGATION_WINDOW = 5 * 60
+
+#Max count of distinct events being aggregated
+MAX_AGGREGATED_EVENTS = 1000
+
+#Rate limit of events from each source, i.e. event name and operation:
+#bursts of up to EVENT_BURST events, and EVENT_RATE events per second after
+#that
+EVENT_RATE = 0.1
+EVENT_BURST = 50
+
+#Operations never rate limited, they are rare and must not be lost
+RATE_LIMIT_EXEMPT_OPS = [WALAEventOperation.HeartBeat,
+                         WALAEventOperation.Provision]
+
+def get_message_template(message):
+    """
+    Strip numbers from message, so that messages differing in e.g. error
+    codes and counts are taken as the same
+    """
+    return re.sub(r"\d+", "#", ustr(message))
+
+def format_time(timestamp):
+    return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(timestamp))
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = now
+
+    def consume(self, now):
+        """
+        Return True if a token is available, and take it
+        """
+        self.tokens = min(self.burst,
+                          self.tokens + max(0, now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class AggregatedEvent(object):
+    def __init__(self, kwargs, now):
+        self.kwargs = kwargs
+        self.count = 0
+        self.first = now
+        self.last = now
+
+    def add(self, now):
+        self.count += 1
+        self.last = now
+
+    def get_params(self):
+        """
+        Return the count and time range as event parameters
+        """
+        return [TelemetryEventParam("Count", self.count),
+                TelemetryEventParam("FirstTime", format_time(self.first)),
+                TelemetryEventParam("LastTime", format_time(self.last))]
+
+class EventAggregator(object):
+    """
+    Keep repeated and excessive events out of the spool.
+
+    The first of the events with the same name, operation, result and
+    message template is written, the ones following it within the window
+    are only counted. When the window ends, one event is written with the
+    count and the time of the first and last of them. Events from a source
+    over its rate limit are dropped and reported by count. The count and
+    times are also written as the Count, FirstTime and LastTime parameters.
+    """
+    def __init__(self, window=EVENT_AGGREGATION_WINDOW, rate=EVENT_RATE,
+                 burst=EVENT_BURST):
+        self.window = window
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.next_expiry = None
+        self.buckets = {}
+        self.suppressed = {}
+
+    def accept(self, kwargs, now):
+        """
+        Return True if the event should be written
+        """
+        key = (kwargs["name"], kwargs["op"], kwargs["is_success"],
+               get_message_template(kwargs["message"]))
+        self.lock.acquire()
+        try:
+            aggregated = self.pending.get(key)
+            if aggregated is not None:
+                aggregated.add(now)
+                return False
+
+            source = (kwargs["name"], kwargs["op"])
+            if kwargs["op"] not in RATE_LIMIT_EXEMPT_OPS:
+                bucket = self.buckets.get(source)
+                if bucket is None:
+                    bucket = TokenBucket(self.rate, self.burst, now)
+                    self.buckets[source] = bucket
+                if not bucket.consume(now):
+                    suppressed = self.suppressed.get(source)
+                    if suppressed is None:
+                        suppressed = AggregatedEvent(kwargs, now)
+                        self.suppressed[source] = suppressed
+                    suppressed.add(now)
+                    metrics.inc_counter("event.suppressed")
+                    return False
+
+            if len(self.pending) < MAX_AGGREGATED_EVENTS:
+                self.pending[key] = AggregatedEvent(kwargs, now)
+                if self.next_expiry is None:
+                    self.next_expiry = now + self.window
+            return True
+        finally:
+            self.lock.release()
+
+    def flush(self, now, force=False):
+        """
+        Return list of kwargs of the summary events to write
+        """
+        self.lock.acquire()
+        try:
+            summaries = []
+            if not force and (self.next_expiry is None or \
+                              now < self.next_expiry):
+                return summaries
+            self.next_expiry = None
+            for key, aggregated in list(self.pending.items()):
+                if not force and now < aggregated.first + self.window:
+                    if self.next_expiry is None or \
+                            aggregated.first + self.window < self.next_expiry:
+                        self.next_expiry = aggregated.first + self.window
+                    continue
+                del self.pending[key]
+                if aggregated.count == 0:
+                    continue
+                metrics.inc_counter("event.coalesced", aggregated.count)
+                kwargs = dict(aggregated.kwargs)
+                kwargs["message"] = ("{0} [repeated {1} times from {2} to "
+                                     "{3}]").format(kwargs["message"],
+                                                    aggregated.count,
+                                                    format_time(aggregated.first),
+                                                    format_time(aggregated.last))
+                kwargs["params"] = aggregated.get_params()
+                summaries.append(kwargs)
+
+            for source, suppressed in self.suppressed.items():
+                name, op = source
+                message = ("Suppressed {0} events over rate limit"
+                           "").format(suppressed.count)
+                params = suppressed.get_params()
+                params.append(TelemetryEventParam("SuppressedOperation", op))
+                summaries.append({
+                    "name": name,
+                    "op": WALAEventOperation.EventSuppressed,
+                    "is_success": False,
+                    "duration": 0,
+                    "version": "1.0",
+                    "message": message,
+                    "evt_type": "",
+                    "is_internal": False,
+                    "params": params
+                })
+            self.suppressed = {}
+            return summaries
+        finally:
+            self.lock.release()
+
+#The flush listener, i.e. the monitor, is woken to send events once this
+#many bytes are spooled, the first of them is this old, or the spool is half
+#full, instead of waiting for its timer
+EVENT_FLUSH_SIZE = 16 * 1024
+EVENT_FLUSH_AGE = 10
 
 class EventLogger(object):
     def __init__(self):
         self.event_dir = None
+        self.spool = None
+        self.aggregator = EventAggregator()
+        self.flush_listener = None
+        self.lock = threading.Lock()
+        self.unflushed_size = 0
+        self.unflushed_since = None
 
-    def save_event(self, data):
+    def get_spool(self):
+        """
+        Return the spool of events under event dir
+        """
         if self.event_dir is None:
+            return None
+        if self.spool is None or self.spool.path != self.event_dir:
+            self.spool = Spool(self.event_dir)
+        return self.spool
+
+    def save_event(self, data):
+        spool = self.get_spool()
+        if spool is None:
             logger.warn("Event reporter is not initialized.")
             return
 
-        if not os.path.exists(self.event_dir):
-            os.mkdir(self.event_dir)
-            os.chmod(self.event_dir, 0o700)
-        if len(os.listdir(self.event_dir)) > 1000:
-            raise EventError("Too many files under: {0}".format(self.event_dir))
+        try:
+            saved = spool.append(data.encode("utf-8"))
+        except (IOError, OSError) as e:
+            raise EventError("Failed to write events to file:{0}".format(e))
+        if not saved:
+            raise EventError("Event spool is full: {0}".format(self.event_dir))
+        self.notify_flush(spool, len(data))
 
-        filename = os.path.join(self.event_dir, ustr(int(time.time()*1000000)))
+    def notify_flush(self, spool, size):
+        """
+        Wake the flush listener if enough events are waiting to be sent
+        """
+        if self.flush_listener is None:
+            return
+        now = time.time()
+        pressure = spool.get_size() * 2 >= spool.max_size
+        self.lock.acquire()
         try:
-            with open(filename+".tmp",'wb+') as hfile:
-                hfile.write(data.encode("utf-8"))
-            os.rename(filename+".tmp", filename+".tld")
-        except IOError as e:
-            raise EventError("Failed to write events to file:{0}", e)
+            self.unflushed_size += size
+            if self.unflushed_since is None:
+                self.unflushed_since = now
+            if not pressure and self.unflushed_size < EVENT_FLUSH_SIZE and \
+                    now - self.unflushed_since < EVENT_FLUSH_AGE:
+                return
+            self.unflushed_size = 0
+            self.unflushed_since = None
+        finally:
+            self.lock.release()
+        self.flush_listener()
 
     def add_event(self, name, op="", is_success=True, duration=0, version="1.0",
                   message="", evt_type="", is_internal=False):
+        kwargs = {
+            "name": name,
+            "op": op,
+            "is_success": is_success,
+            "duration": duration,
+            "version": version,
+            "message": message,
+            "evt_type": evt_type,
+            "is_internal": is_internal
+        }
+        now = time.time()
+        self.flush_events(now)
+        if self.aggregator.accept(kwargs, now):
+            self.write_event(**kwargs)
+
+    def flush_events(self, now=None, force=False):
+        """
+        Write summaries of the aggregated and suppressed events
+        """
+        if now is None:
+            now = time.time()
+        for kwargs in self.aggregator.flush(now, force=force):
+            self.write_event(**kwargs)
+
+    def write_event(self, name, op="", is_success=True, duration=0,
+                    version="1.0", message="", evt_type="", is_internal=False,
+                    params=None):
         event = TelemetryEvent(1, "69B669B9-4AF8-4C50-BDC4-6006FA76E975")
         event.parameters.append(TelemetryEventParam('Name', name))
         event.parameters.append(TelemetryEventParam('Version', version))
@@ -83,11 +348,13 @@ class EventLogger(object):
         event.parameters.append(TelemetryEventParam('Message', message))
         event.parameters.append(TelemetryEventParam('Duration', duration))
         event.parameters.append(TelemetryEventParam('ExtensionType', evt_type))
+        if params is not None:
+            event.parameters.extend(params)
 
-        data = get_properties(event)
         try:
-            self.save_event(json.dumps(data))
+            self.save_event(encode_event_record(event))
         except EventError as e:
+            metrics.inc_counter("event.dropped")
             logger.error("{0}", e)
 
 __event_logger__ = EventLogger()
@@ -108,6 +375,17 @@ def add_event(name, op="", is_success=True, duration=0, version="1.0",
 def init_event_logger(event_dir, reporter=__event_logger__):
     reporter.event_dir = event_dir
 
+def flush_events(force=False, reporter=__event_logger__):
+    if reporter.event_dir is None:
+        return
+    reporter.flush_events(force=force)
+
+def set_flush_listener(listener, reporter=__event_logger__):
+    reporter.flush_listener = listener
+
+def get_event_spool(reporter=__event_logger__):
+    return reporter.get_spool()
+
 def dump_unhandled_err(name):
     if hasattr(sys, 'last_type') and hasattr(sys, 'last_value') and \
             hasattr(sys, 'last_traceback'):
@@ -121,4 +399,8 @@ def dump_unhandled_err(name):
                   op=WALAEventOperation.UnhandledError)
 
 def enable_unhandled_err_dump(name):
+    #Registered first to run last, after the others are logged
+    atexit.register(logger.shutdown)
     atexit.register(dump_unhandled_err, name)
+    #Write summaries of aggregated events before exit
+    atexit.register(flush_events, force=True)
@@ -22,18 +22,96 @@ Log utils
 """
 import os
 import sys
+import json
+import time
+import gzip
+import shutil
+import threading
+import collections
 from azurelinuxagent.future import ustr
 from datetime import datetime
 
+#Buffered log lines are flushed at least this often, in seconds
+LOG_FLUSH_INTERVAL = 1
+
+#Max count of log lines waiting for the writer thread
+LOG_QUEUE_SIZE = 1000
+
 class Logger(object):
     """
     Logger class
     """
+    #Bumped on any change of context, so that cached ones are built again
+    context_generation = 0
+    context_lock = threading.Lock()
+
     def __init__(self, logger=None, prefix=None):
         self.appenders = []
         if logger is not None:
             self.appenders.extend(logger.appenders)
+        self.parent = logger
         self.prefix = prefix
+        self.context = {}
+        self.context_cache = None
+        self.level = None
+        self.update_level()
+
+    def set_context(self, **kwargs):
+        """
+        Set fields of structured log records, e.g. component, handler,
+        version, operation, duration and incarnation. Fields of the parent
+        logger are inherited. None removes the field.
+        """
+        Logger.context_lock.acquire()
+        try:
+            for name, value in kwargs.items():
+                if value is None:
+                    self.context.pop(name, None)
+                else:
+                    self.context[name] = value
+            Logger.context_generation += 1
+        finally:
+            Logger.context_lock.release()
+
+    def with_context(self, **kwargs):
+        """
+        Return a child logger with more context, e.g. for a single record
+        """
+        child = Logger(self, self.prefix)
+        child.set_context(**kwargs)
+        return child
+
+    def get_context(self):
+        context = {}
+        if self.parent is not None:
+            context.update(self.parent.get_context())
+        context.update(self.context)
+        return context
+
+    def get_context_json(self):
+        """
+        Return the context encoded as JSON fields, it's cached till the
+        context of any logger is changed.
+        """
+        generation = Logger.context_generation
+        cached = self.context_cache
+        if cached is not None and cached[0] == generation:
+            return cached[1]
+        context_json = json.dumps(self.get_context(), sort_keys=True)[1:-1]
+        self.context_cache = (generation, context_json)
+        return context_json
+
+    def update_level(self):
+        """
+        Messages below the lowest level of the appenders are never formatted
+        """
+        levels = [appender.level for appender in self.appenders]
+        self.level = None
+        if len(levels) > 0:
+            self.level = min(levels)
+
+    def is_enabled(self, level):
+        return self.level is not None and self.level <= level
 
     def verb(self, msg_format, *args):
         self.log(LogLevel.VERBOSE, msg_format, *args)
@@ -48,6 +126,8 @@ class Logger(object):
         self.log(LogLevel.ERROR, msg_format, *args)
 
     def log(self, level, msg_format, *args):
+        if not self.is_enabled(level):
+            return
         #if msg_format is not unicode convert it to unicode
         if type(msg_format) is not ustr:
             msg_format = ustr(msg_format, errors="backslashreplace")
@@ -55,7 +135,29 @@ class Logger(object):
             msg = msg_format.format(*args)
         else:
             msg = msg_format
-        time = datetime.now().strftime(u'%Y/%m/%d %H:%M:%S.%f')
+        now = datetime.now()
+        log_item = None
+        json_item = None
+        writes = []
+        for appender in self.appenders:
+            if appender.level > level:
+                continue
+            if isinstance(appender, JsonFileAppender):
+                if json_item is None:
+                    json_item = self.format_json(now, level, msg)
+                writes.append((appender, json_item))
+            else:
+                if log_item is None:
+                    log_item = self.format_text(now, level, msg)
+                writes.append((appender, log_item))
+
+        if LOG_WRITER.put(writes, level):
+            return
+        for appender, item in writes:
+            appender.write(level, item)
+
+    def format_text(self, now, level, msg):
+        time = now.strftime(u'%Y/%m/%d %H:%M:%S.%f')
         level_str = LogLevel.STRINGS[level]
         if self.prefix is not None:
             log_item = u"{0} {1} {2} {3}\n".format(time, level_str, self.prefix,
@@ -63,42 +165,358 @@ class Logger(object):
         else:
             log_item = u"{0} {1} {2}\n".format(time, level_str, msg)
 
-        log_item = ustr(log_item.encode('ascii', "backslashreplace"), 
-                        encoding="ascii")
-        for appender in self.appenders:
-            appender.write(level, log_item)
+        return ustr(log_item.encode('ascii', "backslashreplace"), 
+                    encoding="ascii")
+
+    def format_json(self, now, level, msg):
+        timestamp = now.strftime(u'%Y-%m-%dT%H:%M:%S.%f')
+        fields = [
+            u'"timestamp": "{0}"'.format(timestamp),
+            u'"level": "{0}"'.format(LogLevel.STRINGS[level])
+        ]
+        context_json = self.get_context_json()
+        if len(context_json) > 0:
+            fields.append(context_json)
+        fields.append(u'"message": {0}'.format(json.dumps(msg)))
+        return u"{" + u", ".join(fields) + u"}\n"
 
-    def add_appender(self, appender_type, level, path):
-        appender = _create_logger_appender(appender_type, level, path)
+    def add_appender(self, appender_type, level, path, max_size=0,
+                     backup_count=0):
+        appender = _create_logger_appender(appender_type, level, path,
+                                           max_size=max_size,
+                                           backup_count=backup_count)
         self.appenders.append(appender)
+        self.update_level()
+
+    def flush(self):
+        for appender in self.appenders:
+            appender.flush()
 
 class ConsoleAppender(object):
+    """
+    Console is kept open, and opened again after a failed write
+    """
     def __init__(self, level, path):
         self.level = LogLevel.INFO
         if level >= LogLevel.INFO:
             self.level = level
         self.path = path
+        self.console = None
+        self.lock = threading.Lock()
 
     def write(self, level, msg):
-        if self.level <= level:
+        if self.level > level:
+            return
+        self.lock.acquire()
+        try:
             try:
-                with open(self.path, "w") as console:
-                    console.write(msg)
+                if self.console is None:
+                    self.console = open(self.path, "w")
+                self.console.write(msg)
+                self.console.flush()
+            except IOError:
+                self.close()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        if self.console is not None:
+            try:
+                self.console.close()
             except IOError:
                 pass
+        self.console = None
+
+    def flush(self):
+        pass
+
+def get_rotated_path(path, index):
+    return "{0}.{1}.gz".format(path, index)
+
+def compress_file(path):
+    """
+    Compress the file to path.gz and remove it. Return True if it's done.
+    Runs in background, so errors are not logged, the file is kept
+    uncompressed instead.
+    """
+    tmp_path = path + ".gz.tmp"
+    try:
+        src = open(path, "rb")
+        try:
+            dst = gzip.open(tmp_path, "wb")
+            try:
+                shutil.copyfileobj(src, dst)
+            finally:
+                dst.close()
+        finally:
+            src.close()
+        os.rename(tmp_path, path + ".gz")
+        os.remove(path)
+        return True
+    except (IOError, OSError):
+        try:
+            if os.path.isfile(tmp_path):
+                os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
 
 class FileAppender(object):
-    def __init__(self, level, path):
+    """
+    Log file is kept open and written through a buffer. The buffer is
+    flushed right away for lines of flush_level or above, and at least every
+    LOG_FLUSH_INTERVAL seconds for the others. The file is opened again once
+    it's found rotated or removed at a flush.
+
+    If max_size is set, the file is rotated once it's larger. It's renamed
+    to a unique path.1.<timestamp> right away, and compressed in background
+    to path.1.gz, with older ones shifted up to path.<backup_count>.gz.
+    Rotated files are compressed one by one in order, without blocking
+    writes. If compression fails, the rotated file is kept as it is, and
+    counted against backup_count. Rotated files left by a failed or
+    interrupted compression are compressed again once the file is opened.
+    """
+    def __init__(self, level, path, flush_level=None, max_size=0,
+                 backup_count=0):
         self.level = level
         self.path = path
+        self.flush_level = flush_level
+        if flush_level is None:
+            self.flush_level = LogLevel.INFO
+        self.max_size = max_size
+        self.backup_count = backup_count
+        self.log_file = None
+        self.size = 0
+        self.last_flush = 0
+        #Rotated files waiting to be compressed, and the thread doing it
+        self.rotated = []
+        self.compressor = None
+        self.compress_lock = threading.Lock()
+        self.swept = False
+        self.lock = threading.RLock()
+
+    def open(self):
+        self.log_file = open(self.path, "a")
+        self.size = os.fstat(self.log_file.fileno()).st_size
+        if not self.swept:
+            self.swept = True
+            self.sweep()
 
     def write(self, level, msg):
-        if self.level <= level:
+        if self.level > level:
+            return
+        self.lock.acquire()
+        try:
             try:
-                with open(self.path, "a+") as log_file:
-                    log_file.write(msg)
-            except IOError:
+                if self.log_file is None:
+                    self.open()
+                self.log_file.write(msg)
+                self.size += len(msg)
+                now = time.time()
+                if level >= self.flush_level or \
+                        now - self.last_flush >= LOG_FLUSH_INTERVAL:
+                    self._flush(now)
+                if self.max_size > 0 and self.size >= self.max_size:
+                    self.rotate()
+            except (IOError, OSError):
+                self.close()
+        finally:
+            self.lock.release()
+        #Outside of the lock, as it may close other appenders
+        if self.log_file is not None:
+            _touch_file_appender(self)
+
+    def rotate(self):
+        self.close()
+        if self.backup_count == 0:
+            os.remove(self.path)
+            return
+        rotated_path = "{0}.1.{1:d}".format(self.path,
+                                            int(time.time() * 1000000))
+        self.compress_lock.acquire()
+        try:
+            #Renamed under the lock, so that it's not pruned as left over
+            os.rename(self.path, rotated_path)
+            self.queue_compress([rotated_path])
+        finally:
+            self.compress_lock.release()
+
+    def queue_compress(self, rotated_paths):
+        """
+        Queue rotated files to compress, called with compress_lock held
+        """
+        self.rotated.extend(rotated_paths)
+        if self.compressor is None:
+            self.compressor = threading.Thread(target=self.compress)
+            self.compressor.setDaemon(True)
+            self.compressor.start()
+
+    def list_left_over(self):
+        """
+        Rotated files not compressed, the oldest first. Temporary files of
+        an interrupted compression are removed.
+        """
+        dir_name, name = os.path.split(self.path)
+        prefix = name + ".1."
+        left_over = []
+        try:
+            entries = os.listdir(dir_name or os.curdir)
+        except OSError:
+            return left_over
+        for entry in entries:
+            if not entry.startswith(prefix):
+                continue
+            suffix = entry[len(prefix):]
+            timestamp = suffix.split(".", 1)[0]
+            if not timestamp.isdigit():
+                continue
+            rotated_path = os.path.join(dir_name, prefix + timestamp)
+            if rotated_path in self.rotated:
+                continue
+            try:
+                if suffix == timestamp + ".gz.tmp":
+                    os.remove(os.path.join(dir_name, entry))
+                elif suffix == timestamp or suffix == timestamp + ".gz":
+                    if (int(timestamp), rotated_path) not in left_over:
+                        left_over.append((int(timestamp), rotated_path))
+            except OSError:
                 pass
+        left_over.sort()
+        return [rotated_path for timestamp, rotated_path in left_over]
+
+    def sweep(self):
+        """
+        Compress the rotated files left by a failed or interrupted
+        compression, e.g. when the agent was stopped
+        """
+        self.compress_lock.acquire()
+        try:
+            left_over = self.list_left_over()
+            if self.backup_count == 0:
+                for rotated_path in left_over:
+                    for left_over_path in [rotated_path, rotated_path + ".gz"]:
+                        try:
+                            if os.path.isfile(left_over_path):
+                                os.remove(left_over_path)
+                        except OSError:
+                            pass
+            elif len(left_over) > 0:
+                self.queue_compress(left_over)
+        finally:
+            self.compress_lock.release()
+
+    def prune(self):
+        """
+        Remove the oldest backups beyond backup_count, counting the rotated
+        files kept uncompressed
+        """
+        self.compress_lock.acquire()
+        try:
+            backups = [x for x in self.list_left_over()
+                       if os.path.isfile(x)]
+        finally:
+            self.compress_lock.release()
+        for index in range(1, self.backup_count + 1):
+            rotated_path = get_rotated_path(self.path, index)
+            if os.path.isfile(rotated_path):
+                backups.append(rotated_path)
+        if len(backups) <= self.backup_count:
+            return
+        backups.sort(key=lambda x: (os.path.getmtime(x), x))
+        for rotated_path in backups[:len(backups) - self.backup_count]:
+            os.remove(rotated_path)
+
+    def compress(self):
+        while True:
+            self.compress_lock.acquire()
+            try:
+                if len(self.rotated) == 0:
+                    self.compressor = None
+                    return
+                rotated_path = self.rotated[0]
+            finally:
+                self.compress_lock.release()
+            try:
+                #Compressed already if interrupted before renamed
+                if not os.path.isfile(rotated_path) or \
+                        compress_file(rotated_path):
+                    self.shift_backups()
+                    os.rename(rotated_path + ".gz",
+                              get_rotated_path(self.path, 1))
+            except (IOError, OSError):
+                pass
+            #Kept queued till done, so that it's not swept or pruned
+            self.compress_lock.acquire()
+            try:
+                self.rotated.pop(0)
+            finally:
+                self.compress_lock.release()
+            try:
+                self.prune()
+            except (IOError, OSError):
+                pass
+
+    def shift_backups(self):
+        for index in range(self.backup_count, 0, -1):
+            rotated_path = get_rotated_path(self.path, index)
+            if not os.path.isfile(rotated_path):
+                continue
+            if index == self.backup_count:
+                os.remove(rotated_path)
+            else:
+                os.rename(rotated_path, get_rotated_path(self.path, index + 1))
+
+    def wait_compressed(self):
+        self.compress_lock.acquire()
+        try:
+            compressor = self.compressor
+        finally:
+            self.compress_lock.release()
+        if compressor is not None:
+            compressor.join()
+
+    def is_rotated(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        fstat = os.fstat(self.log_file.fileno())
+        return stat.st_ino != fstat.st_ino or stat.st_dev != fstat.st_dev
+
+    def _flush(self, now):
+        self.log_file.flush()
+        self.last_flush = now
+        if self.is_rotated():
+            self.close()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            if self.log_file is not None:
+                try:
+                    self._flush(time.time())
+                except (IOError, OSError):
+                    self.close()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.log_file is not None:
+                try:
+                    self.log_file.close()
+                except (IOError, OSError):
+                    pass
+            self.log_file = None
+        finally:
+            self.lock.release()
+
+class JsonFileAppender(FileAppender):
+    """
+    Write JSON lines of structured records, with the context of the logger
+    """
+    pass
 
 class StdoutAppender(object):
     def __init__(self, level):
@@ -111,9 +529,198 @@ class StdoutAppender(object):
             except IOError:
                 pass
 
+    def flush(self):
+        try:
+            sys.stdout.flush()
+        except IOError:
+            pass
+
+class OverflowPolicy(object):
+    #Drop verbose lines when the queue is full, and wait for the others
+    DROP_VERBOSE = "drop_verbose"
+    #Wait for room for all the lines
+    BLOCK = "block"
+    #Drop all the lines that don't fit
+    DROP = "drop"
+
+    ALL = [DROP_VERBOSE, BLOCK, DROP]
+
+class LogWriter(object):
+    """
+    Write log lines from a background thread, so that slow appenders, e.g.
+    serial console, don't block the callers. Lines wait in a bounded queue,
+    and overflow_policy decides what to do when it's full. Appenders are
+    flushed when the queue is drained and every LOG_FLUSH_INTERVAL seconds.
+
+    Until the writer is started, and after it's stopped, lines are written
+    by the callers.
+    """
+    def __init__(self):
+        self.queue = collections.deque()
+        self.queue_size = LOG_QUEUE_SIZE
+        self.overflow_policy = OverflowPolicy.DROP_VERBOSE
+        self.cond = threading.Condition()
+        self.thread = None
+        self.running = False
+        self.busy = False
+        self.dropped = 0
+
+    def start(self, queue_size=LOG_QUEUE_SIZE,
+              overflow_policy=OverflowPolicy.DROP_VERBOSE):
+        if overflow_policy not in OverflowPolicy.ALL:
+            DEFAULT_LOGGER.warn("Unknown log overflow policy: {0}, use {1}",
+                                overflow_policy, OverflowPolicy.DROP_VERBOSE)
+            overflow_policy = OverflowPolicy.DROP_VERBOSE
+        self.cond.acquire()
+        try:
+            if self.running:
+                return
+            #The queue must hold at least a line, or callers wait forever
+            self.queue_size = max(1, queue_size)
+            self.overflow_policy = overflow_policy
+            self.running = True
+            self.thread = threading.Thread(target=self.run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+        finally:
+            self.cond.release()
+
+    def stop(self):
+        """
+        Write out the queued lines and stop the thread
+        """
+        self.cond.acquire()
+        try:
+            if not self.running:
+                return
+            self.running = False
+            self.cond.notify_all()
+            thread = self.thread
+            self.thread = None
+        finally:
+            self.cond.release()
+        if thread is not threading.current_thread():
+            thread.join()
+
+    def should_drop(self, level):
+        if self.overflow_policy == OverflowPolicy.DROP:
+            return True
+        if self.overflow_policy == OverflowPolicy.BLOCK:
+            return False
+        return level <= LogLevel.VERBOSE
+
+    def put(self, writes, level):
+        """
+        Queue the line, as list of appenders and what to write to each.
+        Return False if the writer is not running, and the caller should
+        write it.
+        """
+        self.cond.acquire()
+        try:
+            if not self.running or \
+                    self.thread is threading.current_thread():
+                return False
+            while len(self.queue) >= self.queue_size:
+                if self.should_drop(level):
+                    self.dropped += 1
+                    return True
+                self.cond.wait()
+                if not self.running:
+                    return False
+            self.queue.append((writes, level))
+            self.cond.notify_all()
+            return True
+        finally:
+            self.cond.release()
+
+    def take(self, timeout=None):
+        """
+        Wait for queued lines and take all of them. Return None when
+        stopped and drained, or an empty list if timeout is over.
+        """
+        self.cond.acquire()
+        try:
+            self.busy = False
+            self.cond.notify_all()
+            if len(self.queue) == 0 and self.running:
+                self.cond.wait(timeout)
+            if len(self.queue) == 0 and not self.running:
+                return None
+            items = list(self.queue)
+            self.queue.clear()
+            self.busy = len(items) > 0
+            self.cond.notify_all()
+            return items
+        finally:
+            self.cond.release()
+
+    def run(self):
+        used_appenders = set()
+        #Appenders are only flushed after lines are written to them
+        unflushed = False
+        while True:
+            timeout = None
+            if unflushed:
+                timeout = LOG_FLUSH_INTERVAL
+            items = self.take(timeout)
+            if items is None:
+                break
+            for writes, level in items:
+                for appender, msg in writes:
+                    appender.write(level, msg)
+                    used_appenders.add(appender)
+                unflushed = True
+            dropped = self.take_dropped()
+            if dropped > 0:
+                self.write_dropped(used_appenders, dropped)
+            if unflushed and (len(items) == 0 or len(self.queue) == 0):
+                for appender in used_appenders:
+                    appender.flush()
+                unflushed = False
+        for appender in used_appenders:
+            appender.flush()
+
+    def write_dropped(self, appenders, dropped):
+        """
+        Write the count of dropped lines as a record in the format of each
+        appender
+        """
+        now = datetime.now()
+        msg = u"Dropped {0} log lines".format(dropped)
+        log_item = DEFAULT_LOGGER.format_text(now, LogLevel.WARNING, msg)
+        json_item = DEFAULT_LOGGER.format_json(now, LogLevel.WARNING, msg)
+        for appender in appenders:
+            if isinstance(appender, JsonFileAppender):
+                appender.write(LogLevel.WARNING, json_item)
+            else:
+                appender.write(LogLevel.WARNING, log_item)
+
+    def take_dropped(self):
+        self.cond.acquire()
+        try:
+            dropped = self.dropped
+            self.dropped = 0
+            return dropped
+        finally:
+            self.cond.release()
+
+    def wait_drained(self):
+        """
+        Wait till all the queued lines are written
+        """
+        self.cond.acquire()
+        try:
+            while self.running and (len(self.queue) > 0 or self.busy) and \
+                    self.thread is not threading.current_thread():
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
 #Initialize logger instance
 DEFAULT_LOGGER = Logger()
 
+LOG_WRITER = LogWriter()
+
 class LogLevel(object):
     VERBOSE = 0
     INFO = 1
@@ -130,9 +737,33 @@ class AppenderType(object):
     FILE = 0
     CONSOLE = 1
     STDOUT = 2
+    JSON_FILE = 3
+
+def add_logger_appender(appender_type, level=LogLevel.INFO, path=None,
+                        max_size=0, backup_count=0):
+    DEFAULT_LOGGER.add_appender(appender_type, level, path,
+                                max_size=max_size, backup_count=backup_count)
+
+def start_async(queue_size=LOG_QUEUE_SIZE,
+                overflow_policy=OverflowPolicy.DROP_VERBOSE):
+    LOG_WRITER.start(queue_size=queue_size, overflow_policy=overflow_policy)
+
+def stop_async():
+    LOG_WRITER.stop()
+
+def flush():
+    LOG_WRITER.wait_drained()
+    DEFAULT_LOGGER.flush()
+
+def shutdown():
+    """
+    Write out all the lines before exit
+    """
+    LOG_WRITER.stop()
+    DEFAULT_LOGGER.flush()
 
-def add_logger_appender(appender_type, level=LogLevel.INFO, path=None):
-    DEFAULT_LOGGER.add_appender(appender_type, level, path)
+def set_context(**kwargs):
+    DEFAULT_LOGGER.set_context(**kwargs)
 
 def verb(msg_format, *args):
     DEFAULT_LOGGER.verb(msg_format, *args)
@@ -149,11 +780,81 @@ def error(msg_format, *args):
 def log(level, msg_format, *args):
     DEFAULT_LOGGER.log(level, msg_format, args)
 
-def _create_logger_appender(appender_type, level=LogLevel.INFO, path=None):
+#Loggers writing the same file share its appender, so that it's kept open
+#and rotated in one place. It's kept till its owner is dropped.
+FILE_APPENDERS = {}
+FILE_APPENDERS_LOCK = threading.Lock()
+
+#Max count of open log files. The least recently written ones are closed
+#beyond it, they're opened again by the same appender when written to.
+MAX_FILE_APPENDERS = 64
+
+#Appenders with the file open, the least recently written first
+OPEN_FILE_APPENDERS = []
+
+def _get_file_appender(appender_cls, level, path, max_size=0,
+                       backup_count=0):
+    FILE_APPENDERS_LOCK.acquire()
+    try:
+        key = (appender_cls, path, level)
+        appender = FILE_APPENDERS.get(key)
+        if appender is None:
+            appender = appender_cls(level, path, max_size=max_size,
+                                    backup_count=backup_count)
+            FILE_APPENDERS[key] = appender
+        return appender
+    finally:
+        FILE_APPENDERS_LOCK.release()
+
+def _touch_file_appender(appender):
+    """
+    Mark the appender as the most recently written one, and close the file
+    of the least recently written ones beyond MAX_FILE_APPENDERS
+    """
+    evicted = []
+    FILE_APPENDERS_LOCK.acquire()
+    try:
+        if appender in OPEN_FILE_APPENDERS:
+            OPEN_FILE_APPENDERS.remove(appender)
+        OPEN_FILE_APPENDERS.append(appender)
+        while len(OPEN_FILE_APPENDERS) > MAX_FILE_APPENDERS:
+            evicted.append(OPEN_FILE_APPENDERS.pop(0))
+    finally:
+        FILE_APPENDERS_LOCK.release()
+    for evicted_appender in evicted:
+        evicted_appender.close()
+
+def close_file_appenders(path):
+    """
+    Close and drop the cached appenders of the file, e.g. when its owner
+    is dropped
+    """
+    closed = []
+    FILE_APPENDERS_LOCK.acquire()
+    try:
+        for key in list(FILE_APPENDERS.keys()):
+            if key[1] == path:
+                appender = FILE_APPENDERS.pop(key)
+                if appender in OPEN_FILE_APPENDERS:
+                    OPEN_FILE_APPENDERS.remove(appender)
+                closed.append(appender)
+    finally:
+        FILE_APPENDERS_LOCK.release()
+    for appender in closed:
+        appender.close()
+
+def _create_logger_appender(appender_type, level=LogLevel.INFO, path=None,
+                            max_size=0, backup_count=0):
     if appender_type == AppenderType.CONSOLE:
         return ConsoleAppender(level, path)
     elif appender_type == AppenderType.FILE:
-        return FileAppender(level, path)
+        return _get_file_appender(FileAppender, level, path,
+                                  max_size=max_size,
+                                  backup_count=backup_count)
+    elif appender_type == AppenderType.JSON_FILE:
+        return _get_file_appender(JsonFileAppender, level, path,
+                                  max_size=max_size,
+                                  backup_count=backup_count)
     elif appender_type == AppenderType.STDOUT:
         return StdoutAppender(level)
     else:
@@ -0,0 +1,133 @@
+# Microsoft Azure Linux Agent
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.4+ and Openssl 1.0+
+#
+
+"""
+In-process metrics of the agent: gauges, counters and histograms
+"""
+
+import threading
+
+#Upper bounds of histogram buckets, in seconds
+DEFAULT_BUCKETS = [0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300]
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        #The last one counts values larger than all the bounds
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i in range(0, len(self.buckets)):
+            if value <= self.buckets[i]:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def get_properties(self):
+        return {
+            "buckets": list(self.buckets),
+            "counts": list(self.counts),
+            "count": self.count,
+            "sum": self.total,
+            "min": self.min,
+            "max": self.max
+        }
+
+class Metrics(object):
+    def __init__(self):
+        self.gauges = {}
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def set_gauge(self, name, value):
+        self.lock.acquire()
+        try:
+            self.gauges[name] = value
+        finally:
+            self.lock.release()
+
+    def inc_counter(self, name, value=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] = self.counters.get(name, 0) + value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, value, buckets=DEFAULT_BUCKETS):
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = Histogram(buckets)
+                self.histograms[name] = histogram
+            histogram.observe(value)
+        finally:
+            self.lock.release()
+
+    def get_metrics(self):
+        """
+        Return a snapshot of all the metrics as a dict
+        """
+        self.lock.acquire()
+        try:
+            histograms = {}
+            for name, histogram in self.histograms.items():
+                histograms[name] = histogram.get_properties()
+            return {
+                "gauges": dict(self.gauges),
+                "counters": dict(self.counters),
+                "histograms": histograms
+            }
+        finally:
+            self.lock.release()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.gauges = {}
+            self.counters = {}
+            self.histograms = {}
+        finally:
+            self.lock.release()
+
+__metrics__ = Metrics()
+
+def set_gauge(name, value, metrics=__metrics__):
+    metrics.set_gauge(name, value)
+
+def inc_counter(name, value=1, metrics=__metrics__):
+    metrics.inc_counter(name, value)
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, metrics=__metrics__):
+    metrics.observe(name, value, buckets=buckets)
+
+def get_metrics(metrics=__metrics__):
+    return metrics.get_metrics()
@@ -21,6 +21,7 @@ import copy
 import re
 import json
 import xml.dom.minidom
+import xml.sax.saxutils as saxutils
 import azurelinuxagent.logger as logger
 from azurelinuxagent.exception import ProtocolError, HttpError
 from azurelinuxagent.future import ustr
@@ -207,9 +208,36 @@ class TelemetryEvent(DataContract):
         self.providerId = providerId
         self.parameters = DataContractList(TelemetryEventParam)
 
+#Telemetry type of event parameters by python type. Types not in it, e.g.
+#long on python 2, are sent without a type as before.
+EVENT_PARAM_TYPES = {
+    int: 'mt:uint64',
+    str: 'mt:wstr',
+    ustr: 'mt:wstr',
+    bool: 'mt:bool',
+    float: 'mt:float64'
+}
+
+def event_param_to_v1(param):
+    param_format = '<Param Name="{0}" Value={1} T="{2}" />'
+    attr_type = EVENT_PARAM_TYPES.get(type(param.value), "")
+    return param_format.format(param.name, saxutils.quoteattr(ustr(param.value)),
+                               attr_type)
+
+def event_params_to_v1(params):
+    """
+    Encode event parameters, both to spool events and to send them
+    """
+    return "".join([event_param_to_v1(param) for param in params])
+
 class TelemetryEventList(DataContract):
     def __init__(self):
         self.events = DataContractList(TelemetryEvent)
+        #Parameters of all the events, e.g. system info
+        self.common_params = DataContractList(TelemetryEventParam)
+        #Events with parameters already encoded by the protocol, as tuples of
+        #(eventId, providerId, encoded parameters)
+        self.encoded_events = []
 
 class Protocol(DataContract):
 
@@ -225,6 +253,9 @@ class Protocol(DataContract):
     def get_ext_handlers(self):
         raise NotImplementedError()
 
+    def get_cached_ext_handlers(self):
+        raise NotImplementedError()
+
     def get_ext_handler_pkgs(self, extension):
         raise NotImplementedError()
 
@@ -242,6 +273,17 @@ class Protocol(DataContract):
     def report_vm_status(self, vm_status):
         raise NotImplementedError()
 
+    def get_vm_status_report(self, vm_status):
+        """
+        Return what report_vm_status would upload, with extension status as
+        of now. It's not changed by later reports, so it could be uploaded
+        later by upload_vm_status_report.
+        """
+        return vm_status
+
+    def upload_vm_status_report(self, report):
+        self.report_vm_status(report)
+
     def report_ext_status(self, ext_handler_name, ext_name, ext_status):
         raise NotImplementedError()
 
@@ -20,6 +20,7 @@ import os
 import json
 import re
 import time
+import threading
 import traceback
 import xml.sax.saxutils as saxutils
 import azurelinuxagent.conf as conf
@@ -61,6 +62,15 @@ ENDPOINT_FINE_NAME = "WireServer"
 SHORT_WAITING_INTERVAL = 1 # 1 second
 LONG_WAITING_INTERVAL = 15 # 15 seconds
 
+#Max size of status blob. Substatus messages are truncated to fit in.
+STATUS_BLOB_MAX_SIZE = 128 * 1024 # 128KB
+TRUNCATED_MSG_SUFFIX = "..."
+
+#Extension status timestamp in cached status fragments, replaced on build
+TIMESTAMP_PLACEHOLDER = "@timestampUTC@"
+TIMESTAMP_PLACEHOLDER_FIELD = '"timestampUTC": "{0}"'.format(
+                              TIMESTAMP_PLACEHOLDER)
+
 class WireProtocolResourceGone(ProtocolError):
     pass
 
@@ -86,8 +96,9 @@ class WireProtocol(Protocol):
         self.client.update_goal_state(forced=True)
 
     def get_vminfo(self):
-        goal_state = self.client.get_goal_state()
-        hosting_env = self.client.get_hosting_env()
+        snapshot = self.client.get_snapshot("goal_state", "hosting_env")
+        goal_state = snapshot.goal_state
+        hosting_env = snapshot.hosting_env
 
         vminfo = VMInfo()
         vminfo.subscriptionId = None
@@ -106,10 +117,18 @@ class WireProtocol(Protocol):
         logger.verb("Get extension handler config")
         #Update goal state to get latest extensions config
         self.client.update_goal_state()
-        goal_state = self.client.get_goal_state()
-        ext_conf = self.client.get_ext_conf()
+        snapshot = self.client.get_snapshot("goal_state", "ext_conf")
         #In wire protocol, incarnation is equivalent to ETag 
-        return ext_conf.ext_handlers, goal_state.incarnation
+        return snapshot.ext_conf.ext_handlers, snapshot.goal_state.incarnation
+
+    def get_cached_ext_handlers(self):
+        """
+        Get extension handler config of the last goal state saved on disk,
+        without contacting wire server.
+        """
+        logger.verb("Get cached extension handler config")
+        snapshot = self.client.get_snapshot("goal_state", "ext_conf")
+        return snapshot.ext_conf.ext_handlers, snapshot.goal_state.incarnation
 
     def get_ext_handler_pkgs(self, ext_handler):
         logger.verb("Get extension handler package")
@@ -133,13 +152,20 @@ class WireProtocol(Protocol):
         self.client.status_blob.set_vm_status(vm_status)
         self.client.upload_status_blob()
 
+    def get_vm_status_report(self, vm_status):
+        validata_param("vm_status", vm_status, VMStatus)
+        return self.client.status_blob.build(vm_status)
+
+    def upload_vm_status_report(self, report):
+        self.client.upload_status_blob(report)
+
     def report_ext_status(self, ext_handler_name, ext_name, ext_status):
         validata_param("ext_status", ext_status, ExtensionStatus)
         self.client.status_blob.set_ext_status(ext_handler_name, ext_status)
 
     def report_event(self, events):
         validata_param("events", events, TelemetryEventList)
-        self.client.report_event(events)
+        return self.client.report_event(events)
 
 def _build_role_properties(container_id, role_instance_id, thumbprint):
     xml = (u"<?xml version=\"1.0\" encoding=\"utf-8\"?>"
@@ -210,7 +236,15 @@ def ga_status_to_v1(ga_status):
     }
     return v1_ga_status
 
-def ext_substatus_to_v1(sub_status_list):
+def truncate_msg(message, max_msg_len):
+    if message is None or max_msg_len is None:
+        return message
+    message = ustr(message)
+    if len(message) <= max_msg_len:
+        return message
+    return message[0: max_msg_len] + TRUNCATED_MSG_SUFFIX
+
+def ext_substatus_to_v1(sub_status_list, max_msg_len=None):
     status_list = []
     for substatus in sub_status_list:
         status = {
@@ -219,17 +253,17 @@ def ext_substatus_to_v1(sub_status_list):
             "code": substatus.code,
             "formattedMessage":{
                 "lang": "en-US",
-                "message": substatus.message
+                "message": truncate_msg(substatus.message, max_msg_len)
             }
         }
         status_list.append(status)
     return status_list
 
-def ext_status_to_v1(ext_name, ext_status):
+def ext_status_to_v1(ext_name, ext_status, max_msg_len=None):
     if ext_status is None:
         return None
     timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
-    v1_sub_status = ext_substatus_to_v1(ext_status.substatusList)
+    v1_sub_status = ext_substatus_to_v1(ext_status.substatusList, max_msg_len)
     v1_ext_status = {
         "status":{
             "name": ext_name,
@@ -249,7 +283,8 @@ def ext_status_to_v1(ext_name, ext_status):
         v1_ext_status['substatus'] = v1_sub_status
     return v1_ext_status
     
-def ext_handler_status_to_v1(handler_status, ext_statuses, timestamp):
+def ext_handler_status_to_v1(handler_status, ext_statuses, timestamp,
+                             max_msg_len=None):
     v1_handler_status = {
         'handlerVersion' : handler_status.version,
         'handlerName' : handler_status.name,
@@ -266,7 +301,7 @@ def ext_handler_status_to_v1(handler_status, ext_statuses, timestamp):
         #Currently, no more than one extension per handler
         ext_name = handler_status.extensions[0]
         ext_status = ext_statuses.get(ext_name)
-        v1_ext_status = ext_status_to_v1(ext_name, ext_status)
+        v1_ext_status = ext_status_to_v1(ext_name, ext_status, max_msg_len)
         if ext_status is not None and v1_ext_status is not None:
             v1_handler_status["runtimeSettingsStatus"] = {
                 'settingsStatus' : v1_ext_status,
@@ -296,12 +331,156 @@ def vm_status_to_v1(vm_status, ext_statuses):
     }
     return v1_vm_status
 
+def get_handler_ext_status(handler_status, ext_statuses):
+    if len(handler_status.extensions) == 0:
+        return None
+    return ext_statuses.get(handler_status.extensions[0])
+
+def get_handler_status_key(handler_status, ext_status):
+    """
+    Return the inputs of v1 handler status, to tell if it's changed
+    """
+    key = [handler_status.name, handler_status.version,
+           handler_status.status, handler_status.code,
+           handler_status.message, list(handler_status.extensions)]
+    if ext_status is not None:
+        key.extend([ext_status.configurationAppliedTime,
+                    ext_status.operation, ext_status.status,
+                    ext_status.sequenceNumber, ext_status.code,
+                    ext_status.message])
+        for substatus in ext_status.substatusList:
+            key.append((substatus.name, substatus.status, substatus.code,
+                        substatus.message))
+    return key
+
+class StatusBuilder(object):
+    """
+    Build status blob in v1 format incrementally.
+
+    The json of each handler status is cached along with its inputs, and
+    only rebuilt when they change. It's cached without the timestamp of the
+    extension status. The blob is spliced together from the cached fragments
+    with fresh timestamps. If it's larger than max_size,
+    substatus messages are truncated to the same length, the largest one
+    that makes the blob fit in.
+    """
+    def __init__(self, max_size=STATUS_BLOB_MAX_SIZE):
+        self.max_size = max_size
+        self.fragments = {}
+
+    def build_handler_status(self, handler_status, ext_statuses, timestamp,
+                             max_msg_len=None):
+        ext_status = get_handler_ext_status(handler_status, ext_statuses)
+        key = get_handler_status_key(handler_status, ext_status)
+        cache_key = (handler_status.name, max_msg_len is None)
+        cached = self.fragments.get(cache_key)
+        if cached is None or cached[0] != key or cached[1] != max_msg_len:
+            v1_handler_status = ext_handler_status_to_v1(handler_status,
+                                                         ext_statuses, None,
+                                                         max_msg_len)
+            #Quotes in messages are escaped, so the placeholder field only
+            #matches the timestamp of the extension status
+            runtime_status = v1_handler_status.get("runtimeSettingsStatus")
+            if runtime_status is not None:
+                settings_status = runtime_status["settingsStatus"]
+                settings_status["timestampUTC"] = TIMESTAMP_PLACEHOLDER
+            fragment = json.dumps(v1_handler_status)
+            parts = fragment.split(TIMESTAMP_PLACEHOLDER_FIELD, 1)
+            cached = (key, max_msg_len, parts)
+            self.fragments[cache_key] = cached
+        timestamp_field = '"timestampUTC": {0}'.format(json.dumps(timestamp))
+        return timestamp_field.join(cached[2])
+
+    def splice(self, timestamp, v1_ga_status, fragments):
+        return ('{{"version": "1.0", "timestampUTC": {0}, '
+                '"aggregateStatus": {{"guestAgentStatus": {1}, '
+                '"handlerAggregateStatus": [{2}]}}}}'
+                '').format(json.dumps(timestamp), v1_ga_status,
+                           ", ".join(fragments))
+
+    def build(self, vm_status, ext_statuses):
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        v1_ga_status = json.dumps(ga_status_to_v1(vm_status.vmAgent))
+        handlers = vm_status.vmAgent.extensionHandlers
+
+        fragments = []
+        for handler_status in handlers:
+            fragments.append(self.build_handler_status(handler_status,
+                                                       ext_statuses,
+                                                       timestamp))
+        data = self.splice(timestamp, v1_ga_status, fragments)
+        if len(data) > self.max_size:
+            truncated = self.truncate(timestamp, v1_ga_status, handlers,
+                                      ext_statuses, len(data))
+            if truncated is not None:
+                data = truncated
+            if len(data) > self.max_size:
+                logger.warn("Status blob is too large: {0}", len(data))
+
+        #Drop fragments of removed handlers
+        names = [handler_status.name for handler_status in handlers]
+        for cache_key in list(self.fragments.keys()):
+            if cache_key[0] not in names:
+                del self.fragments[cache_key]
+        return data
+
+    def get_max_msg_len(self, msg_lens, size):
+        """
+        Estimate the largest message length that makes the blob fit in
+        """
+        low = 0
+        high = max(msg_lens)
+        while low < high:
+            mid = (low + high + 1) // 2
+            saved = 0
+            for msg_len in msg_lens:
+                if msg_len > mid:
+                    saved += msg_len - mid - len(TRUNCATED_MSG_SUFFIX)
+            if size - saved <= self.max_size:
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    def truncate(self, timestamp, v1_ga_status, handlers, ext_statuses, size):
+        """
+        Return the blob with substatus messages truncated, or None if there
+        is no message to truncate.
+        """
+        msg_lens = []
+        for handler_status in handlers:
+            ext_status = get_handler_ext_status(handler_status, ext_statuses)
+            if ext_status is None:
+                continue
+            for substatus in ext_status.substatusList:
+                if substatus.message is not None:
+                    msg_lens.append(len(ustr(substatus.message)))
+        if len(msg_lens) == 0:
+            return None
+
+        max_msg_len = self.get_max_msg_len(msg_lens, size)
+        while True:
+            fragments = []
+            for handler_status in handlers:
+                fragments.append(self.build_handler_status(handler_status,
+                                                           ext_statuses,
+                                                           timestamp,
+                                                           max_msg_len))
+            data = self.splice(timestamp, v1_ga_status, fragments)
+            #Escaped messages could be longer than estimated
+            if len(data) <= self.max_size or max_msg_len == 0:
+                break
+            max_msg_len = max_msg_len // 2
+        logger.verb("Truncate substatus messages to {0}", max_msg_len)
+        return data
 
 class StatusBlob(object):
     def __init__(self, client):
         self.vm_status = None
         self.ext_statuses = {}
         self.client = client
+        self.builder = StatusBuilder()
+        self.lock = threading.Lock()
 
     def set_vm_status(self, vm_status):
         validata_param("vmAgent", vm_status, VMStatus)
@@ -309,20 +488,38 @@ class StatusBlob(object):
     
     def set_ext_status(self, ext_handler_name, ext_status):
         validata_param("extensionStatus", ext_status, ExtensionStatus)
-        self.ext_statuses[ext_handler_name]= ext_status
+        self.lock.acquire()
+        try:
+            self.ext_statuses[ext_handler_name]= ext_status
+        finally:
+            self.lock.release()
+
+    def build(self, vm_status):
+        """
+        Return the blob of vm status and the current extension status
+        """
+        self.lock.acquire()
+        try:
+            return self.builder.build(vm_status, self.ext_statuses)
+        finally:
+            self.lock.release()
         
     def to_json(self):
-        report = vm_status_to_v1(self.vm_status, self.ext_statuses)
-        return json.dumps(report)
+        return self.build(self.vm_status)
 
     __storage_version__ = "2014-02-14"
 
-    def upload(self, url):
+    def upload(self, url, data=None):
+        """
+        Upload the blob built from the current status, or data if it's
+        built before
+        """
         #TODO upload extension only if content has changed
         logger.verb("Upload status blob")
         blob_type = self.get_blob_type(url)
 
-        data = self.to_json()
+        if data is None:
+            data = self.to_json()
         try:
             if blob_type == "BlockBlob":
                 self.put_block_blob(url, data)
@@ -430,64 +627,112 @@ class StatusBlob(object):
                                      "").format(resp.status))
             start = end
 
-def event_param_to_v1(param):
-    param_format = '<Param Name="{0}" Value={1} T="{2}" />'
-    param_type = type(param.value)
-    attr_type = ""
-    if param_type is int:
-        attr_type = 'mt:uint64'
-    elif param_type is str:
-        attr_type = 'mt:wstr'
-    elif ustr(param_type).count("'unicode'") > 0:
-        attr_type = 'mt:wstr'
-    elif param_type is bool:
-        attr_type = 'mt:bool'
-    elif param_type is float:
-        attr_type = 'mt:float64'
-    return param_format.format(param.name, saxutils.quoteattr(ustr(param.value)),
-                               attr_type)
-
-def event_to_v1(event):
-    params = ""
-    for param in event.parameters:
-        params += event_param_to_v1(param)
+def event_to_v1(event, common_params=""):
+    """
+    common_params is the encoded parameters shared by all the events, e.g.
+    system info, appended to the ones of the event.
+    """
+    params = event_params_to_v1(event.parameters)
+    return encoded_event_to_v1(event.eventId, params + common_params)
+
+def encoded_event_to_v1(event_id, params):
     event_str = ('<Event id="{0}">'
                  '<![CDATA[{1}]]>'
-                 '</Event>').format(event.eventId, params)
+                 '</Event>').format(event_id, params)
     return event_str
 
+class GoalStateSnapshot(object):
+    """
+    Goal state and the configs fetched with it. A published snapshot is
+    never modified, WireClient publishes a new one instead. So readers could
+    use it without locking and always see configs of the same goal state.
+    """
+    def __init__(self, goal_state=None, hosting_env=None, shared_conf=None,
+                 certs=None, ext_conf=None):
+        self.goal_state = goal_state
+        self.hosting_env = hosting_env
+        self.shared_conf = shared_conf
+        self.certs = certs
+        self.ext_conf = ext_conf
+
+    def replace(self, **kwargs):
+        """
+        Return a copy of the snapshot with some of the configs replaced
+        """
+        fields = {
+            "goal_state": self.goal_state,
+            "hosting_env": self.hosting_env,
+            "shared_conf": self.shared_conf,
+            "certs": self.certs,
+            "ext_conf": self.ext_conf
+        }
+        fields.update(kwargs)
+        return GoalStateSnapshot(**fields)
+
 class WireClient(object):
+    """
+    Client of wire server. It's shared by the agent threads.
+
+    The goal state is kept in a GoalStateSnapshot, readers get the current
+    one without locking. Only one thread updates the goal state at a time,
+    under update_lock, and the new snapshot is published with a single
+    assignment. Throttling counters are guarded by throttle_lock.
+    """
     def __init__(self, endpoint):
         logger.info("Wire server endpoint:{0}", endpoint)
         self.endpoint = endpoint
-        self.goal_state = None
+        self.snapshot = GoalStateSnapshot()
         self.updated = None
-        self.hosting_env = None
-        self.shared_conf = None
-        self.certs = None
-        self.ext_conf = None
+        self.update_lock = threading.RLock()
         self.last_request = 0
         self.req_count = 0
+        self.throttle_lock = threading.Lock()
         self.status_blob = StatusBlob(self)
+        #Common event parameters and their encoded form
+        self.common_params = None
+
+    @property
+    def goal_state(self):
+        return self.snapshot.goal_state
+
+    @property
+    def hosting_env(self):
+        return self.snapshot.hosting_env
+
+    @property
+    def shared_conf(self):
+        return self.snapshot.shared_conf
+
+    @property
+    def certs(self):
+        return self.snapshot.certs
+
+    @property
+    def ext_conf(self):
+        return self.snapshot.ext_conf
 
     def prevent_throttling(self):
         """
-        Try to avoid throttling of wire server
+        Try to avoid throttling of wire server. Callers are serialized, so
+        requests from all the threads are spaced out together.
         """
-        now = time.time()
-        if now - self.last_request < 1:
-            logger.verb("Last request issued less than 1 second ago")
-            logger.verb("Sleep {0} second to avoid throttling.", 
-                        SHORT_WAITING_INTERVAL)
-            time.sleep(SHORT_WAITING_INTERVAL)
-        self.last_request = now
-
-        self.req_count += 1
-        if self.req_count % 3 == 0:
-            logger.verb("Sleep {0} second to avoid throttling.", 
-                        SHORT_WAITING_INTERVAL)
-            time.sleep(SHORT_WAITING_INTERVAL)
-            self.req_count = 0
+        self.throttle_lock.acquire()
+        try:
+            if time.time() - self.last_request < 1:
+                logger.verb("Last request issued less than 1 second ago")
+                logger.verb("Sleep {0} second to avoid throttling.", 
+                            SHORT_WAITING_INTERVAL)
+                time.sleep(SHORT_WAITING_INTERVAL)
+
+            self.req_count += 1
+            if self.req_count % 3 == 0:
+                logger.verb("Sleep {0} second to avoid throttling.", 
+                            SHORT_WAITING_INTERVAL)
+                time.sleep(SHORT_WAITING_INTERVAL)
+                self.req_count = 0
+            self.last_request = time.time()
+        finally:
+            self.throttle_lock.release()
 
     def call_wireserver(self, http_req, *args, **kwargs):
         """
@@ -586,7 +831,7 @@ class WireClient(object):
         xml_text = self.fetch_config(goal_state.hosting_env_uri, 
                                      self.get_header())
         self.save_cache(local_file, xml_text)
-        self.hosting_env = HostingEnv(xml_text)
+        return HostingEnv(xml_text)
 
     def update_shared_conf(self, goal_state):
         if goal_state.shared_conf_uri is None:
@@ -595,30 +840,36 @@ class WireClient(object):
         xml_text = self.fetch_config(goal_state.shared_conf_uri, 
                                      self.get_header())
         self.save_cache(local_file, xml_text)
-        self.shared_conf = SharedConfig(xml_text)
+        return SharedConfig(xml_text)
 
     def update_certs(self, goal_state):
         if goal_state.certs_uri is None:
-            return
+            return None
         local_file = os.path.join(conf.get_lib_dir(), CERTS_FILE_NAME)
         xml_text = self.fetch_config(goal_state.certs_uri, 
                                      self.get_header_for_cert())
         self.save_cache(local_file, xml_text)
-        self.certs = Certificates(self, xml_text)
+        return Certificates(self, xml_text)
 
     def update_ext_conf(self, goal_state):
         if goal_state.ext_uri is None:
             logger.info("ExtensionsConfig.xml uri is empty")
-            self.ext_conf = ExtensionsConfig(None)
-            return
+            return ExtensionsConfig(None)
         incarnation = goal_state.incarnation
         local_file = os.path.join(conf.get_lib_dir(), 
                                  EXT_CONF_FILE_NAME.format(incarnation))
         xml_text = self.fetch_config(goal_state.ext_uri, self.get_header())
         self.save_cache(local_file, xml_text)
-        self.ext_conf = ExtensionsConfig(xml_text)
+        return ExtensionsConfig(xml_text)
     
     def update_goal_state(self, forced=False, max_retry=3):
+        self.update_lock.acquire()
+        try:
+            self._update_goal_state(forced, max_retry)
+        finally:
+            self.update_lock.release()
+
+    def _update_goal_state(self, forced, max_retry):
         uri = GOAL_STATE_URI.format(self.endpoint)
         xml_text = self.fetch_config(uri, self.get_header())
         goal_state = GoalState(xml_text)
@@ -639,15 +890,22 @@ class WireClient(object):
         #Start updating goalstate, retry on 410
         for retry in range(0, max_retry):
             try:
-                self.goal_state = goal_state
                 file_name = GOAL_STATE_FILE_NAME.format(goal_state.incarnation)
                 goal_state_file = os.path.join(conf.get_lib_dir(), file_name)
                 self.save_cache(goal_state_file, xml_text)
+                hosting_env = self.update_hosting_env(goal_state)
+                shared_conf = self.update_shared_conf(goal_state)
+                certs = self.update_certs(goal_state)
+                if certs is None:
+                    certs = self.snapshot.certs
+                ext_conf = self.update_ext_conf(goal_state)
+                #Incarnation is saved after all the configs are fetched, so
+                #that a failed update is retried on next call.
                 self.save_cache(incarnation_file, goal_state.incarnation)
-                self.update_hosting_env(goal_state)
-                self.update_shared_conf(goal_state)
-                self.update_certs(goal_state)
-                self.update_ext_conf(goal_state)
+                self.snapshot = GoalStateSnapshot(goal_state, hosting_env,
+                                                  shared_conf, certs,
+                                                  ext_conf)
+                self.updated = time.time()
                 return
             except WireProtocolResourceGone:
                 logger.info("Incarnation is out of date. Update goalstate.")
@@ -656,52 +914,93 @@ class WireClient(object):
 
         raise ProtocolError("Exceeded max retry updating goal state")
 
-    def get_goal_state(self):
-        if(self.goal_state is None):
-            incarnation_file = os.path.join(conf.get_lib_dir(), 
-                                            INCARNATION_FILE_NAME)
-            incarnation = self.fetch_cache(incarnation_file)
+    def get_cached(self, name, load):
+        """
+        Return config of the current snapshot. If it's not loaded yet, load
+        it from cache file and publish a new snapshot with it.
+        """
+        value = getattr(self.snapshot, name)
+        if value is not None:
+            return value
+        self.update_lock.acquire()
+        try:
+            value = getattr(self.snapshot, name)
+            if value is None:
+                value = load()
+                self.snapshot = self.snapshot.replace(**{name: value})
+            return value
+        finally:
+            self.update_lock.release()
+
+    def get_snapshot(self, *names):
+        """
+        Return the current snapshot with the named configs loaded. Configs
+        read from it are of the same goal state, even if a new one is
+        published meanwhile.
+        """
+        snapshot = self.snapshot
+        for name in names:
+            if getattr(snapshot, name) is None:
+                break
+        else:
+            return snapshot
+        #Goal state can't be updated while the missing configs are loaded
+        self.update_lock.acquire()
+        try:
+            for name in names:
+                self.get_cached(name, getattr(self, "load_" + name))
+            return self.snapshot
+        finally:
+            self.update_lock.release()
+
+    def load_goal_state(self):
+        incarnation_file = os.path.join(conf.get_lib_dir(), 
+                                        INCARNATION_FILE_NAME)
+        incarnation = self.fetch_cache(incarnation_file)
 
-            file_name = GOAL_STATE_FILE_NAME.format(incarnation)
-            goal_state_file = os.path.join(conf.get_lib_dir(), file_name)
-            xml_text = self.fetch_cache(goal_state_file)
-            self.goal_state = GoalState(xml_text)
-        return self.goal_state
+        file_name = GOAL_STATE_FILE_NAME.format(incarnation)
+        goal_state_file = os.path.join(conf.get_lib_dir(), file_name)
+        xml_text = self.fetch_cache(goal_state_file)
+        return GoalState(xml_text)
+
+    def load_hosting_env(self):
+        local_file = os.path.join(conf.get_lib_dir(), HOSTING_ENV_FILE_NAME)
+        xml_text = self.fetch_cache(local_file)
+        return HostingEnv(xml_text)
+
+    def load_shared_conf(self):
+        local_file = os.path.join(conf.get_lib_dir(), SHARED_CONF_FILE_NAME)
+        xml_text = self.fetch_cache(local_file)
+        return SharedConfig(xml_text)
+
+    def load_certs(self):
+        local_file = os.path.join(conf.get_lib_dir(), CERTS_FILE_NAME)
+        xml_text = self.fetch_cache(local_file)
+        return Certificates(self, xml_text)
+
+    def load_ext_conf(self):
+        goal_state = self.get_goal_state()
+        if goal_state.ext_uri is None:
+            return ExtensionsConfig(None)
+        local_file = EXT_CONF_FILE_NAME.format(goal_state.incarnation)
+        local_file = os.path.join(conf.get_lib_dir(), local_file)
+        xml_text = self.fetch_cache(local_file)
+        return ExtensionsConfig(xml_text)
+
+    def get_goal_state(self):
+        return self.get_cached("goal_state", self.load_goal_state)
 
     def get_hosting_env(self):
-        if(self.hosting_env is None):
-            local_file = os.path.join(conf.get_lib_dir(), HOSTING_ENV_FILE_NAME)
-            xml_text = self.fetch_cache(local_file)
-            self.hosting_env = HostingEnv(xml_text)
-        return self.hosting_env
+        return self.get_cached("hosting_env", self.load_hosting_env)
 
     def get_shared_conf(self):
-        if(self.shared_conf is None):
-            local_file = os.path.join(conf.get_lib_dir(), SHARED_CONF_FILE_NAME)
-            xml_text = self.fetch_cache(local_file)
-            self.shared_conf = SharedConfig(xml_text)
-        return self.shared_conf
+        return self.get_cached("shared_conf", self.load_shared_conf)
 
     def get_certs(self):
-        if(self.certs is None):
-            local_file = os.path.join(conf.get_lib_dir(), CERTS_FILE_NAME)
-            xml_text = self.fetch_cache(local_file)
-            self.certs = Certificates(self, xml_text)
-        if self.certs is None:
-            return None
-        return self.certs
+        return self.get_cached("certs", self.load_certs)
 
     def get_ext_conf(self):
-        if(self.ext_conf is None):
-            goal_state = self.get_goal_state()
-            if goal_state.ext_uri is None:
-                self.ext_conf = ExtensionsConfig(None)
-            else:
-                local_file = EXT_CONF_FILE_NAME.format(goal_state.incarnation)
-                local_file = os.path.join(conf.get_lib_dir(), local_file)
-                xml_text = self.fetch_cache(local_file)
-                self.ext_conf = ExtensionsConfig(xml_text)
-        return self.ext_conf
+        return self.get_cached("ext_conf", self.load_ext_conf)
 
     def get_ext_manifest(self, ext_handler, goal_state):
         local_file = MANIFEST_FILE_NAME.format(ext_handler.name,
@@ -727,10 +1026,10 @@ class WireClient(object):
                      "advised by Fabric.").format(PROTOCOL_VERSION)
             raise ProtocolNotFoundError(error)
    
-    def upload_status_blob(self):
+    def upload_status_blob(self, data=None):
         ext_conf = self.get_ext_conf()
         if ext_conf.status_upload_blob is not None:
-            self.status_blob.upload(ext_conf.status_upload_blob)
+            self.status_blob.upload(ext_conf.status_upload_blob, data)
 
     def report_role_prop(self, thumbprint):
         goal_state = self.get_goal_state()
@@ -789,25 +1088,55 @@ class WireClient(object):
             logger.verb(resp.read())
             raise ProtocolError("Failed to send events:{0}".format(resp.status))
 
+    def encode_common_params(self, params):
+        """
+        Encode the common event parameters, they are only encoded again
+        when changed.
+        """
+        key = tuple([(param.name, param.value) for param in params])
+        cached = self.common_params
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        params_str = event_params_to_v1(params)
+        self.common_params = (key, params_str)
+        return params_str
+
     def report_event(self, event_list):
+        """
+        Send the events. Return count of the ones dropped for being too
+        large.
+        """
         buf = {}
-        #Group events by providerId
+        dropped = 0
+        common_params = self.encode_common_params(event_list.common_params)
+        event_strs = []
         for event in event_list.events:
-            if event.providerId not in buf:
-                buf[event.providerId] = ""
-            event_str = event_to_v1(event)
+            event_strs.append((event.providerId,
+                               event_to_v1(event, common_params)))
+        #Encoded events are passed through as they are
+        for event_id, provider_id, params in event_list.encoded_events:
+            event_strs.append((provider_id,
+                               encoded_event_to_v1(event_id,
+                                                   params + common_params)))
+
+        #Group events by providerId
+        for provider_id, event_str in event_strs:
+            if provider_id not in buf:
+                buf[provider_id] = ""
             if len(event_str) >= 63 * 1024:
                 logger.warn("Single event too large: {0}", event_str[300:])
+                dropped += 1
                 continue
-            if len(buf[event.providerId] + event_str) >= 63 * 1024:
-                self.send_event(event.providerId, buf[event.providerId])
-                buf[event.providerId] = ""
-            buf[event.providerId] = buf[event.providerId] + event_str
+            if len(buf[provider_id] + event_str) >= 63 * 1024:
+                self.send_event(provider_id, buf[provider_id])
+                buf[provider_id] = ""
+            buf[provider_id] = buf[provider_id] + event_str
 
         #Send out all events left in buffer.
         for provider_id in list(buf.keys()):
             if len(buf[provider_id]) > 0:
                 self.send_event(provider_id, buf[provider_id])
+        return dropped
 
     def get_header(self):
         return {
@@ -60,6 +60,42 @@ def write_file(filepath, contents, asbin=False, encoding='utf-8', append=False):
     with open(filepath, mode) as out_file:
         out_file.write(data)
 
+def write_file_atomic(filepath, contents, asbin=False, encoding='utf-8'):
+    """
+    Write 'contents' to a temp file, fsync it and rename it to 'filepath'.
+    Readers see either the old or the new contents, even after a crash.
+    """
+    data = contents
+    if not asbin:
+        data = contents.encode(encoding)
+    dir_name = os.path.dirname(filepath)
+    handle, temp = tempfile.mkstemp(dir=dir_name, 
+                                    prefix=os.path.basename(filepath))
+    try:
+        try:
+            #os.write could write part of the data
+            written = 0
+            while written < len(data):
+                written += os.write(handle, data[written:])
+            os.fsync(handle)
+        finally:
+            os.close(handle)
+        os.rename(temp, filepath)
+    except (IOError, OSError):
+        if os.path.isfile(temp):
+            os.remove(temp)
+        raise
+
+    #Make the rename itself durable
+    try:
+        dir_fd = os.open(dir_name, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except (IOError, OSError):
+        pass
+
 def append_file(filepath, contents, asbin=False, encoding='utf-8'):
     """
     Append 'contents' to 'filepath'.
@@ -0,0 +1,146 @@
+# Microsoft Azure Linux Agent
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.4+ and Openssl 1.0+
+#
+
+"""
+Minimal inotify binding based on ctypes
+"""
+
+import os
+import errno
+import struct
+import azurelinuxagent.logger as logger
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+#Changes of files under a directory
+IN_DIR_CHANGES = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+                 IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+
+EVENT_HEADER = struct.Struct("iIII")
+
+def _load_libc():
+    try:
+        import ctypes
+        import ctypes.util
+        libc_name = ctypes.util.find_library("c")
+        if libc_name is None:
+            return None
+        libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            return None
+        return libc
+    except (ImportError, OSError, AttributeError):
+        return None
+
+class Inotify(object):
+    """
+    Non-blocking inotify instance. Use is_available() to check whether
+    inotify is supported on the platform.
+    """
+    def __init__(self):
+        self.fd = None
+        self.libc = _load_libc()
+        self.buf = b""
+        if self.libc is None:
+            return
+        fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0:
+            logger.warn("inotify_init1 failed: {0}", _get_errno())
+            return
+        self.fd = fd
+
+    def is_available(self):
+        return self.fd is not None
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask=IN_DIR_CHANGES):
+        """
+        Return watch descriptor, or None if path can't be watched
+        """
+        if self.fd is None:
+            return None
+        if not isinstance(path, bytes):
+            path = path.encode("utf-8")
+        wd = self.libc.inotify_add_watch(self.fd, path, mask | IN_ONLYDIR)
+        if wd < 0:
+            logger.verb("inotify_add_watch failed: {0}", _get_errno())
+            return None
+        return wd
+
+    def rm_watch(self, wd):
+        if self.fd is not None:
+            self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """
+        Read pending events without blocking.
+        Return list of (wd, mask, name)
+        """
+        events = []
+        if self.fd is None:
+            return events
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            if not data:
+                break
+            self.buf += data
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(self.buf):
+            wd, mask, cookie, name_len = EVENT_HEADER.unpack_from(self.buf,
+                                                                  offset)
+            end = offset + EVENT_HEADER.size + name_len
+            if end > len(self.buf):
+                break
+            name = self.buf[offset + EVENT_HEADER.size:end].rstrip(b"\0")
+            events.append((wd, mask, name.decode("utf-8", "ignore")))
+            offset = end
+        self.buf = self.buf[offset:]
+        return events
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+def _get_errno():
+    try:
+        import ctypes
+        return os.strerror(ctypes.get_errno())
+    except ImportError:
+        return "unknown"
@@ -0,0 +1,345 @@
+# Microsoft Azure Linux Agent
+#
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.4+ and Openssl 1.0+
+#
+
+"""
+Append-only spool of records in rotating segment files
+"""
+
+import os
+import errno
+import time
+import zlib
+import struct
+import threading
+import azurelinuxagent.logger as logger
+import azurelinuxagent.utils.fileutil as fileutil
+
+SEGMENT_SUFFIX = ".spool"
+CURSOR_FILE_NAME = "cursor"
+
+#Each record is prefixed with its length, crc32 and the time it's appended
+RECORD_HEADER = ">IId"
+RECORD_HEADER_SIZE = struct.calcsize(RECORD_HEADER)
+
+#Larger lengths are taken as corruption
+MAX_RECORD_SIZE = 1024 * 1024
+
+SEGMENT_SIZE = 256 * 1024
+SPOOL_MAX_SIZE = 4 * 1024 * 1024
+
+#Segments of other processes are taken as finished after being idle this long
+SEGMENT_IDLE_TIME = 60
+
+def _checksum(data, timestamp):
+    return zlib.crc32(struct.pack(">d", timestamp) + data) & 0xffffffff
+
+def encode_record(data, timestamp=None):
+    if timestamp is None:
+        timestamp = time.time()
+    return struct.pack(RECORD_HEADER, len(data), _checksum(data, timestamp),
+                       timestamp) + data
+
+class Spool(object):
+    """
+    Records are appended to the newest segment file under the spool dir,
+    named by an increasing sequence number. A new segment is started when
+    the current one is full, and each process writes its own segments.
+
+    Records are read from a cursor, i.e. segment sequence number and offset,
+    which is persisted by commit(). Segments before the committed cursor
+    are removed. A torn or corrupted record, e.g. left by a crash, ends its
+    segment, and reading goes on with the next one.
+    """
+    def __init__(self, path, segment_size=SEGMENT_SIZE,
+                 max_size=SPOOL_MAX_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        self.active = None
+        self.active_seq = None
+        self.active_size = 0
+        #Segments written and closed by this process
+        self.finished = set()
+        self.size = None
+        self.cursor = None
+
+    def get_segment_path(self, seq):
+        return os.path.join(self.path, "{0:016d}{1}".format(seq,
+                                                           SEGMENT_SUFFIX))
+
+    def list_segments(self):
+        seqs = []
+        for name in os.listdir(self.path):
+            if not name.endswith(SEGMENT_SUFFIX):
+                continue
+            try:
+                seqs.append(int(name[0: -len(SEGMENT_SUFFIX)]))
+            except ValueError:
+                continue
+        seqs.sort()
+        return seqs
+
+    def scan(self):
+        """
+        Return sequence numbers of segments and update total size
+        """
+        if not os.path.isdir(self.path):
+            fileutil.mkdir(self.path, mode=0o700)
+        seqs = self.list_segments()
+        size = 0
+        for seq in seqs:
+            try:
+                size += os.path.getsize(self.get_segment_path(seq))
+            except OSError:
+                pass
+        self.size = size
+        return seqs
+
+    def get_size(self):
+        self.lock.acquire()
+        try:
+            if self.size is None:
+                self.scan()
+            return self.size
+        finally:
+            self.lock.release()
+
+    def close_active(self):
+        if self.active is not None:
+            self.active.close()
+            self.finished.add(self.active_seq)
+        self.active = None
+        self.active_seq = None
+        self.active_size = 0
+
+    def open_active(self):
+        seqs = self.scan()
+        seq = 0
+        if len(seqs) > 0:
+            seq = seqs[-1] + 1
+        #Other processes could create the same segment meanwhile
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND
+        while True:
+            try:
+                fd = os.open(self.get_segment_path(seq), flags, 0o666)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                seq += 1
+        self.active = os.fdopen(fd, "ab")
+        self.active_seq = seq
+        self.active_size = 0
+
+    def is_active_removed(self):
+        return self.active is not None and \
+               os.fstat(self.active.fileno()).st_nlink == 0
+
+    def append(self, data):
+        """
+        Append a record of bytes. Return False if the spool is full.
+        """
+        record = encode_record(data)
+        self.lock.acquire()
+        try:
+            if self.active is None or self.is_active_removed():
+                self.close_active()
+                self.open_active()
+            if self.size + len(record) > self.max_size:
+                return False
+            self.active.write(record)
+            self.active.flush()
+            self.active_size += len(record)
+            self.size += len(record)
+            if self.active_size >= self.segment_size:
+                self.close_active()
+            return True
+        finally:
+            self.lock.release()
+
+    def load_cursor(self):
+        if self.cursor is not None:
+            return self.cursor
+        self.cursor = (0, 0)
+        cursor_file = os.path.join(self.path, CURSOR_FILE_NAME)
+        if os.path.isfile(cursor_file):
+            try:
+                seq, offset = fileutil.read_file(cursor_file).split()
+                self.cursor = (int(seq), int(offset))
+            except (IOError, ValueError) as e:
+                #Start over from the oldest segment
+                logger.warn("Failed to load spool cursor: {0}", e)
+        return self.cursor
+
+    def is_finished(self, seq, seqs):
+        """
+        Return True if no more records will be appended to the segment
+        """
+        if seq == seqs[-1]:
+            return False
+        if seq == self.active_seq:
+            #Let newer segments of other processes be read
+            self.close_active()
+        if seq in self.finished:
+            return True
+        try:
+            stat = os.stat(self.get_segment_path(seq))
+        except OSError:
+            return True
+        #Full segments are never appended to
+        return stat.st_size >= self.segment_size or \
+               time.time() - stat.st_mtime > SEGMENT_IDLE_TIME
+
+    def read_segment(self, seq, offset, records, max_bytes):
+        """
+        Read (time, data) of records from offset into the list till
+        max_bytes. Return the offset after the last record read, and if the
+        end of the segment is reached.
+        """
+        read_bytes = 0
+        seg_file = open(self.get_segment_path(seq), "rb")
+        try:
+            seg_file.seek(offset)
+            while read_bytes < max_bytes:
+                header = seg_file.read(RECORD_HEADER_SIZE)
+                if len(header) < RECORD_HEADER_SIZE:
+                    return offset, True
+                length, checksum, timestamp = struct.unpack(RECORD_HEADER,
+                                                            header)
+                if length > MAX_RECORD_SIZE:
+                    logger.warn("Corrupted record in spool: {0}@{1}", seq,
+                                offset)
+                    return -1, True
+                data = seg_file.read(length)
+                if len(data) < length:
+                    return offset, True
+                if _checksum(data, timestamp) != checksum:
+                    logger.warn("Corrupted record in spool: {0}@{1}", seq,
+                                offset)
+                    return -1, True
+                records.append((timestamp, data))
+                offset += RECORD_HEADER_SIZE + length
+                read_bytes += RECORD_HEADER_SIZE + length
+            return offset, False
+        finally:
+            seg_file.close()
+
+    def read(self, max_bytes=SEGMENT_SIZE, cursor=None):
+        """
+        Read records after the cursor, up to about max_bytes. If cursor is
+        None, read from the committed one. Return list of records and the
+        cursor after them, to be passed to commit() or next read().
+        """
+        records, cursor = self.read_records(max_bytes, cursor)
+        return [x[1] for x in records], cursor
+
+    def get_oldest_time(self):
+        """
+        Return the time the oldest uncommitted record is appended, or None
+        if there is none.
+        """
+        records, cursor = self.read_records(1)
+        if len(records) == 0:
+            return None
+        return records[0][0]
+
+    def get_pending_size(self):
+        """
+        Return size of the segments after the committed cursor
+        """
+        self.lock.acquire()
+        try:
+            seq, offset = self.load_cursor()
+            size = 0
+            for next_seq in self.scan():
+                if next_seq < seq:
+                    continue
+                try:
+                    size += os.path.getsize(self.get_segment_path(next_seq))
+                except OSError:
+                    continue
+                if next_seq == seq:
+                    size -= offset
+            return max(0, size)
+        finally:
+            self.lock.release()
+
+    def read_records(self, max_bytes, cursor=None):
+        self.lock.acquire()
+        try:
+            if cursor is None:
+                cursor = self.load_cursor()
+            seq, offset = cursor
+            records = []
+            read_bytes = 0
+            seqs = self.scan()
+            for next_seq in seqs:
+                if next_seq < seq:
+                    continue
+                if next_seq > seq:
+                    seq, offset = next_seq, 0
+                count = len(records)
+                try:
+                    end, at_end = self.read_segment(seq, offset, records,
+                                                    max_bytes - read_bytes)
+                except (IOError, OSError) as e:
+                    logger.warn("Failed to read spool: {0}", e)
+                    end, at_end = offset, True
+                for record in records[count:]:
+                    read_bytes += RECORD_HEADER_SIZE + len(record[1])
+                if end >= 0:
+                    offset = end
+                if not at_end:
+                    break
+                if end >= 0 and not self.is_finished(seq, seqs):
+                    break
+                #Move on to the next segment. A corrupted one is given up,
+                #even if it's still written to.
+                if seq == self.active_seq:
+                    self.close_active()
+                seq, offset = seq + 1, 0
+            return records, (seq, offset)
+        finally:
+            self.lock.release()
+
+    def commit(self, cursor):
+        """
+        Persist the cursor and remove segments before it
+        """
+        self.lock.acquire()
+        try:
+            seq, offset = cursor
+            cursor_file = os.path.join(self.path, CURSOR_FILE_NAME)
+            fileutil.write_file_atomic(cursor_file,
+                                       "{0} {1}".format(seq, offset))
+            self.cursor = cursor
+            for old_seq in self.list_segments():
+                if old_seq >= seq:
+                    break
+                if old_seq == self.active_seq:
+                    self.close_active()
+                self.finished.discard(old_seq)
+                try:
+                    os.remove(self.get_segment_path(old_seq))
+                except OSError as e:
+                    logger.warn("Failed to remove spool segment: {0}", e)
+            self.scan()
+        finally:
+            self.lock.release()
@@ -16,13 +16,13 @@
 #
 # Requires Python 2.4+ and Openssl 1.0+
 
+import re
 import crypt
 import random
 import string
 import struct
 import xml.dom.minidom as minidom
 import sys
-from distutils.version import LooseVersion
 
 def parse_doc(xml_text):
     """
@@ -231,6 +231,73 @@ def get_bytes_from_pem(pem_str):
             base64_bytes += line
     return base64_bytes
 
+VERSION_COMPONENT_RE = re.compile(r'(\d+|[a-zA-Z]+)')
 
-Version = LooseVersion
+#Parsed keys of version strings seen so far. Versions come from a small set
+#of manifests and distro names, so the cache stays small. It's cleared if
+#it ever grows past the limit.
+VERSION_KEY_CACHE_LIMIT = 8192
+_version_key_cache = {}
+
+def parse_version(vstring):
+    """
+    Return the sort key of a version string: a tuple with one item per
+    component. Numeric components are compared as integers, and always
+    sort before alphabetic ones.
+    """
+    key = _version_key_cache.get(vstring)
+    if key is not None:
+        return key
+    key = []
+    for comp in VERSION_COMPONENT_RE.findall(vstring):
+        if comp.isdigit():
+            key.append((0, int(comp)))
+        else:
+            key.append((1, comp))
+    key = tuple(key)
+    if len(_version_key_cache) >= VERSION_KEY_CACHE_LIMIT:
+        _version_key_cache.clear()
+    _version_key_cache[vstring] = key
+    return key
+
+class Version(object):
+    """
+    Loose version number like "1.2.3" or "7.2.1511". Compares with other
+    Version objects and with plain version strings.
+    """
+    def __init__(self, vstring):
+        self.vstring = vstring
+        self.key = parse_version(vstring)
+
+    def _key_of(self, other):
+        if isinstance(other, Version):
+            return other.key
+        return parse_version(other)
+
+    def __eq__(self, other):
+        return self.key == self._key_of(other)
+
+    def __ne__(self, other):
+        return self.key != self._key_of(other)
+
+    def __lt__(self, other):
+        return self.key < self._key_of(other)
+
+    def __le__(self, other):
+        return self.key <= self._key_of(other)
+
+    def __gt__(self, other):
+        return self.key > self._key_of(other)
+
+    def __ge__(self, other):
+        return self.key >= self._key_of(other)
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __str__(self):
+        return self.vstring
+
+    def __repr__(self):
+        return "Version('{0}')".format(self.vstring)
 
@@ -22,6 +22,7 @@ from tests.tools import *
 from azurelinuxagent.distro.loader import get_distro
 from azurelinuxagent.exception import *
 from azurelinuxagent.distro.default.daemon import *
+from azurelinuxagent.distro.default.statusReporter import STATUS_UPLOAD_TASK
 
 class MockDaemonCall(object):
     def __init__(self, daemon_handler, count):
@@ -59,6 +60,98 @@ class TestDaemon(AgentTestCase):
 
         distro.daemon_handler.check_pid()
         mock_exit.assert_any_call(0)
+
+    def test_warm_start(self, mock_sleep):
+        distro = get_distro()
+        daemon_handler = distro.daemon_handler
+        distro.task_scheduler = Mock()
+        distro.protocol_util.get_cached_protocol = Mock()
+        distro.ext_handlers_handler = Mock()
+        distro.ext_handlers_handler.warm_start = Mock(return_value=True)
+
+        daemon_handler.start_warm_start()
+        self.assertEquals(1, distro.task_scheduler.add_task.call_count)
+        args, kw = distro.task_scheduler.add_task.call_args
+        task = args[0]
+        self.assertEquals(WARM_START_TASK, task.name)
+
+        #Retry until status is reported
+        distro.ext_handlers_handler.report_status = Mock(return_value=False)
+        self.assertEquals(None, task.func())
+        distro.ext_handlers_handler.report_status = Mock(return_value=True)
+        self.assertEquals(TASK_DONE, task.func())
+
+        daemon_handler.stop_warm_start()
+        distro.task_scheduler.remove_task.assert_called_with(WARM_START_TASK)
+
+        #No cached goal state
+        distro.task_scheduler.add_task.reset_mock()
+        distro.ext_handlers_handler.warm_start = Mock(return_value=False)
+        daemon_handler.start_warm_start()
+        self.assertEquals(0, distro.task_scheduler.add_task.call_count)
+
+        #No cached protocol
+        distro.ext_handlers_handler.warm_start.reset_mock()
+        distro.protocol_util.get_cached_protocol = Mock(
+            side_effect=ProtocolError())
+        daemon_handler.start_warm_start()
+        self.assertEquals(0, distro.ext_handlers_handler.warm_start.call_count)
+
+    def test_start_ext_handlers(self, mock_sleep):
+        distro = get_distro()
+        daemon_handler = distro.daemon_handler
+        distro.task_scheduler = Mock()
+        distro.ext_handlers_handler = Mock()
+        distro.ext_handlers_handler.run = Mock(return_value=True)
+        distro.ext_handlers_handler.transitioning = False
+
+        daemon_handler.start_ext_handlers()
+        tasks = [args[0] for args, kw in 
+                 distro.task_scheduler.add_task.call_args_list]
+        self.assertEquals([EXT_HANDLERS_TASK, EXT_STATUS_TASK],
+                          [x.name for x in tasks])
+        #Both tasks work on extensions, they never run at the same time
+        self.assertEquals(tasks[0].lock, tasks[1].lock)
+        #Status is reported on its own cadence when polling backs off
+        self.assertEquals(STATUS_REPORT_INTERVAL, tasks[1].get_interval())
+
+        #Failure of extension handling restarts the daemon
+        self.assertTrue(tasks[0].critical)
+        self.assertFalse(tasks[1].critical)
+
+        #Poll fast after new goal state
+        self.assertTrue(tasks[0].func() < 5)
+
+        #Status change triggers status report
+        distro.ext_handlers_handler.status_listener()
+        distro.task_scheduler.trigger.assert_called_with(EXT_STATUS_TASK)
+
+    @patch("azurelinuxagent.distro.default.daemon.add_event")
+    def test_on_task_error(self, mock_add_event, mock_sleep):
+        daemon_handler = get_distro().daemon_handler
+        daemon_handler.on_task_error(Task("Task", None), "Mock traceback")
+        args, kw = mock_add_event.call_args
+        self.assertEquals(WALAEventOperation.UnhandledError, kw["op"])
+        self.assertEquals("Mock traceback", kw["message"])
+        self.assertFalse(kw["is_success"])
+
+        #Failed critical task is reported on daemon restart
+        mock_add_event.reset_mock()
+        daemon_handler.on_task_error(Task("Task", None, critical=True),
+                                     "Mock traceback")
+        self.assertEquals(0, mock_add_event.call_count)
+
+    def test_start_status_reporter(self, mock_sleep):
+        distro = get_distro()
+        daemon_handler = distro.daemon_handler
+        distro.task_scheduler = Mock()
+
+        daemon_handler.start_status_reporter()
+        args, kw = distro.task_scheduler.add_task.call_args
+        self.assertEquals(STATUS_UPLOAD_TASK, args[0].name)
+        #Status is uploaded in background
+        self.assertEquals(daemon_handler.status_reporter,
+                          distro.ext_handlers_handler.status_reporter)
    
 if __name__ == '__main__':
     unittest.main()
@@ -18,12 +18,21 @@
 # http://msdn.microsoft.com/en-us/library/cc227282%28PROT.10%29.aspx
 # http://msdn.microsoft.com/en-us/library/cc227259%28PROT.13%29.aspx
 
+import zipfile
 from tests.tools import *
 from tests.protocol.mockwiredata import *
 from azurelinuxagent.exception import *
 from azurelinuxagent.distro.loader import get_distro
-from azurelinuxagent.protocol.restapi import get_properties
+from azurelinuxagent.protocol.restapi import get_properties, ExtHandler, \
+                                             ExtHandlerList, ExtHandlerPackage, \
+                                             ExtHandlerPackageList
 from azurelinuxagent.protocol.wire import WireProtocol
+from azurelinuxagent.distro.default.extension import find_manifest, \
+                                                     unpack_ext_pkg, \
+                                                     ExtHandlerPackageIndex, \
+                                                     ExtHandlersHandler
+from azurelinuxagent.utils.textutil import Version
+import azurelinuxagent.utils.fileutil as fileutil
 
 @patch("time.sleep")
 @patch("azurelinuxagent.protocol.wire.CryptUtil")
@@ -118,6 +127,125 @@ class TestExtension(AgentTestCase):
         distro.ext_handlers_handler.run()
         self._assert_no_handler_status(protocol.report_vm_status)
 
+    def test_ext_handler_unchanged(self, *args):
+        test_data = WireProtocolData(DATA_FILE)
+        distro, protocol = self._create_mock(test_data, *args)
+        handler = distro.ext_handlers_handler
+        handler.run()
+        self._assert_handler_status(protocol.report_vm_status, "Ready", 1, "1.0")
+
+        #New incarnation without change to the handler is not dispatched
+        test_data.goal_state = test_data.goal_state.replace("<Incarnation>1<",
+                                                            "<Incarnation>2<")
+        with patch.object(handler, "handle_ext_handler") as mock_handle:
+            handler.run()
+            self.assertEquals(0, mock_handle.call_count)
+        self._assert_handler_status(protocol.report_vm_status, "Ready", 1, "1.0")
+
+        #Changed settings are
+        test_data.goal_state = test_data.goal_state.replace("<Incarnation>2<",
+                                                            "<Incarnation>3<")
+        test_data.ext_conf = test_data.ext_conf.replace("seqNo=\"0\"",
+                                                        "seqNo=\"1\"")
+        with patch.object(handler, "handle_ext_handler") as mock_handle:
+            handler.run()
+            self.assertEquals(1, mock_handle.call_count)
+
+    def test_ext_handler_restart(self, *args):
+        test_data = WireProtocolData(DATA_FILE)
+        distro, protocol = self._create_mock(test_data, *args)
+        distro.osutil.get_boot_id = Mock(return_value="boot0")
+        distro.ext_handlers_handler.run()
+        self._assert_handler_status(protocol.report_vm_status, "Ready", 1, "1.0")
+
+        #Restart with the same goal state goes straight to status report
+        handler = ExtHandlersHandler(distro)
+        with patch.object(handler, "handle_ext_handler") as mock_handle:
+            handler.run()
+            self.assertEquals(0, mock_handle.call_count)
+        self.assertEquals("1", handler.last_etag)
+        self._assert_handler_status(protocol.report_vm_status, "Ready", 1, "1.0")
+
+        #Reboot doesn't enable handlers again unless configured
+        distro.osutil.get_boot_id = Mock(return_value="boot1")
+        handler = ExtHandlersHandler(distro)
+        with patch.object(handler, "handle_ext_handler") as mock_handle:
+            handler.run()
+            self.assertEquals(0, mock_handle.call_count)
+
+        handler = ExtHandlersHandler(distro)
+        with patch("azurelinuxagent.conf.get_ext_enable_on_boot",
+                   return_value="OSTCExtensions.ExampleHandlerLinux"):
+            with patch.object(handler, "handle_ext_handler") as mock_handle:
+                handler.run()
+                self.assertEquals(1, mock_handle.call_count)
+
+    def test_ext_handler_warm_start(self, *args):
+        test_data = WireProtocolData(DATA_FILE)
+        distro, protocol = self._create_mock(test_data, *args)
+
+        #Nothing is handled yet
+        handler = ExtHandlersHandler(distro)
+        self.assertFalse(handler.warm_start(protocol))
+
+        distro.ext_handlers_handler.run()
+        protocol.report_vm_status.reset_mock()
+
+        #Status is reported with cached goal state after restart
+        handler = ExtHandlersHandler(distro)
+        cached_protocol = WireProtocol("foo.bar")
+        cached_protocol.report_vm_status = MagicMock()
+        with patch.object(cached_protocol.client, "update_goal_state") \
+                as mock_update:
+            self.assertTrue(handler.warm_start(cached_protocol))
+            self.assertTrue(handler.report_status())
+            self.assertEquals(0, mock_update.call_count)
+        self._assert_handler_status(cached_protocol.report_vm_status, "Ready",
+                                    1, "1.0")
+
+        #Fresh goal state is the same, nothing to handle
+        with patch.object(handler, "handle_ext_handler") as mock_handle:
+            handler.run()
+            self.assertEquals(0, mock_handle.call_count)
+        self._assert_handler_status(protocol.report_vm_status, "Ready", 1, "1.0")
+
+    def test_ext_handler_download_again(self, *args):
+        test_data = WireProtocolData(DATA_FILE)
+        distro, protocol = self._create_mock(test_data, *args)
+        handler = distro.ext_handlers_handler
+        handler.run()
+
+        ext_handler = handler.ext_handlers.extHandlers[0]
+        ext_handler_i = handler.registry.get(ext_handler, protocol)
+        base_dir = ext_handler_i.get_base_dir()
+        status_file = os.path.join(base_dir, "status", "0.status")
+        self.assertTrue(os.path.isfile(status_file))
+        #Files written by the extension
+        fileutil.write_file(os.path.join(base_dir, "mrseq"), "0")
+        fileutil.write_file(os.path.join(base_dir, "heartbeat.log"), "foo")
+        fileutil.mkdir(os.path.join(base_dir, "state"))
+        fileutil.write_file(os.path.join(base_dir, "state", "data"), "bar")
+        man_file = os.path.join(base_dir, "HandlerManifest.json")
+        man = fileutil.read_file(man_file)
+        fileutil.write_file(man_file, "modified")
+        ext_handler_i.decide_version()
+        ext_handler_i.download()
+
+        #Files not in the package are kept, and no old dir is left
+        self.assertTrue(os.path.isfile(status_file))
+        self.assertTrue(os.path.isfile(os.path.join(base_dir, "config",
+                                                    "0.settings")))
+        self.assertEquals("0", fileutil.read_file(os.path.join(base_dir,
+                                                               "mrseq")))
+        self.assertEquals("foo", fileutil.read_file(os.path.join(
+                                     base_dir, "heartbeat.log")))
+        self.assertEquals("bar", fileutil.read_file(os.path.join(
+                                     base_dir, "state", "data")))
+        #Files of the package are replaced
+        self.assertEquals(man, fileutil.read_file(man_file))
+        self.assertEquals([], [x for x in os.listdir(self.tmp_dir)
+                               if x.startswith(".")])
+
     def test_ext_handler_no_settings(self, *args):
         test_data = WireProtocolData(DATA_FILE_EXT_NO_SETTINGS)
         distro, protocol = self._create_mock(test_data, *args)
@@ -185,6 +313,145 @@ class TestExtension(AgentTestCase):
         self._assert_handler_status(protocol.report_vm_status, "Ready", 1, "1.0")
         self._assert_ext_status(protocol.report_ext_status, "error", 0)
 
+    def test_ext_handler_status_reporter(self, *args):
+        test_data = WireProtocolData(DATA_FILE)
+        distro, protocol = self._create_mock(test_data, *args)
+        status_reporter = Mock()
+        distro.ext_handlers_handler.status_reporter = status_reporter
+
+        #Status is posted to status reporter instead of uploaded
+        distro.ext_handlers_handler.run()
+        self.assertEquals(0, protocol.report_vm_status.call_count)
+        args, kw = status_reporter.post.call_args
+        self.assertEquals(protocol, args[0])
+        handler_status = args[1].vmAgent.extensionHandlers[0]
+        self.assertEquals("Ready", handler_status.status)
+        self.assertEquals(1, len(handler_status.extensions))
+
+    def test_ext_handler_registry(self, *args):
+        """Steady state status loop with 50 handlers"""
+        distro = get_distro()
+        protocol = Mock()
+        handler = distro.ext_handlers_handler
+        handler.protocol = protocol
+
+        ext_handlers = ExtHandlerList()
+        for i in range(0, 50):
+            ext_handler = ExtHandler(name="Handler{0}".format(i))
+            ext_handler.properties.version = "1.0"
+            ext_handler.properties.state = "enabled"
+            ext_handlers.extHandlers.append(ext_handler)
+            ext_handler_i = handler.registry.get(ext_handler, protocol)
+            ext_handler_i.set_handler_status(status="Ready")
+
+        with patch("azurelinuxagent.distro.default.extension.logger.Logger") \
+                as mock_logger:
+            with patch("azurelinuxagent.distro.default.extension.fileutil") \
+                    as mock_fileutil:
+                for i in range(0, 10):
+                    handler.report_ext_handlers_status(ext_handlers)
+                self.assertEquals(0, mock_logger.call_count)
+                self.assertEquals(0, mock_fileutil.mkdir.call_count)
+                self.assertEquals(0, mock_fileutil.read_file.call_count)
+
+        args, kw = protocol.report_vm_status.call_args
+        vm_status = args[0]
+        self.assertEquals(50, len(vm_status.vmAgent.extensionHandlers))
+
+        #Version change gets a new instance
+        ext_handler = ext_handlers.extHandlers[0]
+        old_ext_handler_i = handler.registry.get(ext_handler, protocol)
+        ext_handler.properties.version = "1.1"
+        ext_handler_i = handler.registry.get(ext_handler, protocol)
+        self.assertNotEquals(old_ext_handler_i, ext_handler_i)
+        self.assertEquals("Handler0-1.1", ext_handler_i.get_full_name())
+
+        old_ext_handler_i.logger.info("foo")
+        old_ext_handler_i.logger.flush()
+        appender = old_ext_handler_i.logger.appenders[-1]
+        self.assertNotEquals(None, appender.log_file)
+        handler.registry.retain(ext_handlers)
+        self.assertEquals(50, len(handler.registry.instances))
+        #Log file of the dropped version is closed
+        self.assertEquals(None, appender.log_file)
+
+    def test_decide_version(self, *args):
+        """Pick versions from a manifest with thousands of versions"""
+        pkg_list = ExtHandlerPackageList()
+        for major in range(1, 5):
+            for minor in range(0, 25):
+                for hotfix in range(0, 50):
+                    version = "{0}.{1}.{2}".format(major, minor, hotfix)
+                    pkg_list.versions.append(ExtHandlerPackage(version))
+        pkg_list.versions.append(ExtHandlerPackage("2.3"))
+
+        def get_newest(version, auto_upgrade):
+            #Prefix filter and sort used before the index
+            frag = version.split('.')
+            if auto_upgrade:
+                prefix = "{0}.".format(frag[0])
+            else:
+                prefix = "{0}.{1}.".format(frag[0], frag[1])
+            packages = [x for x in pkg_list.versions \
+                        if x.version.startswith(prefix) or \
+                           x.version == version]
+            packages = sorted(packages, key=lambda x: Version(x.version),
+                              reverse=True)
+            return packages[0] if len(packages) > 0 else None
+
+        index = ExtHandlerPackageIndex(pkg_list)
+        for version in ["1.0", "2.3", "2.3.7", "3.24.49", "4.10.0", "5.0"]:
+            for auto_upgrade in [True, False]:
+                self.assertEquals(get_newest(version, auto_upgrade),
+                                  index.get_newest(version, auto_upgrade))
+        self.assertEquals("2.3.49", index.get_newest("2.3").version)
+        self.assertEquals("4.24.49", index.get_newest("4.3", True).version)
+
+        distro = get_distro()
+        protocol = Mock()
+        protocol.get_ext_handler_pkgs = Mock(return_value=pkg_list)
+        ext_handler = ExtHandler(name="Handler")
+        ext_handler.properties.version = "1.0"
+        ext_handler.properties.upgradePolicy = "auto"
+        ext_handler_i = distro.ext_handlers_handler.registry.get(ext_handler,
+                                                                 protocol)
+        with patch("azurelinuxagent.distro.default.extension."
+                   "ExtHandlerPackageIndex",
+                   side_effect=ExtHandlerPackageIndex) as mock_index:
+            for i in range(0, 100):
+                ext_handler_i.decide_version()
+            #Index is only built once for an unchanged manifest
+            self.assertEquals(1, mock_index.call_count)
+        self.assertEquals("1.24.49", ext_handler_i.get_version())
+
+    def test_unpack_ext_pkg(self, *args):
+        pkg_file = os.path.join(self.tmp_dir, "pkg.zip")
+        pkg = zipfile.ZipFile(pkg_file, "w")
+        info = zipfile.ZipInfo("bin/install.sh")
+        info.create_system = 3
+        info.external_attr = 0o750 << 16
+        pkg.writestr(info, "#!/bin/sh")
+        #Created on windows, external_attr holds no unix mode
+        info = zipfile.ZipInfo("bin/enable.sh")
+        info.create_system = 0
+        info.external_attr = 0o777 << 16
+        pkg.writestr(info, "#!/bin/sh")
+        pkg.writestr("bin/HandlerManifest.json", "[]")
+        pkg.writestr("HandlerManifest.json", "[]")
+        pkg.close()
+
+        pkg = zipfile.ZipFile(pkg_file)
+        self.assertEquals("HandlerManifest.json", find_manifest(pkg))
+
+        target_dir = os.path.join(self.tmp_dir, "pkg")
+        unpack_ext_pkg(pkg, target_dir)
+        pkg.close()
+        mode = os.stat(os.path.join(target_dir, "bin/install.sh")).st_mode
+        self.assertEquals(0o750, mode & 0o777)
+        mode = os.stat(os.path.join(target_dir, "bin/enable.sh")).st_mode
+        self.assertEquals(0o744, mode & 0o777)
+        mode = os.stat(os.path.join(target_dir, "HandlerManifest.json")).st_mode
+        self.assertEquals(0o100, mode & 0o100)
 
 if __name__ == '__main__':
     unittest.main()
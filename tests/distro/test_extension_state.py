@@ -0,0 +1,113 @@
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.4+ and Openssl 1.0+
+#
+# Implements parts of RFC 2131, 1541, 1497 and
+# http://msdn.microsoft.com/en-us/library/cc227282%28PROT.10%29.aspx
+# http://msdn.microsoft.com/en-us/library/cc227259%28PROT.13%29.aspx
+
+
+from tests.tools import *
+import json
+import azurelinuxagent.utils.fileutil as fileutil
+from azurelinuxagent.distro.default.extensionState import *
+
+class TestExtHandlerStateStore(AgentTestCase):
+    def test_persist_on_change(self):
+        store = ExtHandlerStateStore()
+        snapshot_file = store.get_snapshot_file()
+        store.set_handler_state("Foo-1.0", "Enabled")
+        store.set_handler_status("Foo-1.0", {"status": "Ready"})
+        self.assertFalse(os.path.isfile(snapshot_file))
+        store.flush()
+        self.assertTrue(os.path.isfile(snapshot_file))
+
+        #Nothing changed, snapshot is not written again
+        with patch.object(fileutil, "write_file_atomic") as mock_write:
+            store.set_handler_state("Foo-1.0", "Enabled")
+            store.flush()
+            self.assertEquals(0, mock_write.call_count)
+
+        store = ExtHandlerStateStore()
+        self.assertEquals("Enabled", store.get_handler_state("Foo-1.0"))
+        self.assertEquals("Ready", 
+                          store.get_handler_status("Foo-1.0")["status"])
+
+        store.remove_handler("Foo-1.0")
+        store.flush()
+        store = ExtHandlerStateStore()
+        self.assertEquals(None, store.get_handler_state("Foo-1.0"))
+
+    def test_load_legacy_state(self):
+        state_dir = os.path.join(self.tmp_dir, "handler_state", "Foo-1.0")
+        fileutil.mkdir(state_dir)
+        fileutil.write_file(os.path.join(state_dir, "state"), "Installed")
+        fileutil.write_file(os.path.join(state_dir, "status"), 
+                            json.dumps({"status": "NotReady"}))
+
+        store = ExtHandlerStateStore()
+        self.assertEquals("Installed", store.get_handler_state("Foo-1.0"))
+        self.assertEquals("NotReady", 
+                          store.get_handler_status("Foo-1.0")["status"])
+        store.flush()
+        self.assertTrue(os.path.isfile(store.get_snapshot_file()))
+
+    def test_installed_inventory(self):
+        fileutil.mkdir(os.path.join(self.tmp_dir, "Foo-1.9"))
+        fileutil.mkdir(os.path.join(self.tmp_dir, "Foo-1.10"))
+        fileutil.mkdir(os.path.join(self.tmp_dir, "Foo.Bar-2.0"))
+        fileutil.write_file(os.path.join(self.tmp_dir, "Foo-3.0.zip"), "")
+        fileutil.mkdir(os.path.join(self.tmp_dir, ".Foo-1.11.tmp"))
+        fileutil.mkdir(os.path.join(self.tmp_dir, ".Foo-1.8"))
+        fileutil.mkdir(os.path.join(self.tmp_dir, "Foo-backup"))
+
+        #Inventory is built from lib dir when missing
+        store = ExtHandlerStateStore()
+        self.assertEquals(["1.9", "1.10"], store.get_installed_versions("Foo"))
+        self.assertEquals(["2.0"], store.get_installed_versions("Foo.Bar"))
+
+        store.add_installed("Foo", "1.11")
+        store.remove_installed("Foo.Bar", "2.0")
+        store.flush()
+
+        #Loaded from snapshot without scanning lib dir
+        with patch("azurelinuxagent.distro.default.extensionState."
+                   "scan_installed_handlers") as mock_scan:
+            store = ExtHandlerStateStore()
+            self.assertEquals(["1.9", "1.10", "1.11"], 
+                              store.get_installed_versions("Foo"))
+            self.assertEquals([], store.get_installed_versions("Foo.Bar"))
+            self.assertEquals(0, mock_scan.call_count)
+
+    def test_malformed_snapshot(self):
+        store = ExtHandlerStateStore()
+        fileutil.write_file(store.get_snapshot_file(), "{bad json")
+        self.assertEquals(None, store.get_handler_state("Foo-1.0"))
+
+    def test_malformed_installed_inventory(self):
+        fileutil.mkdir(os.path.join(self.tmp_dir, "Foo-1.0"))
+        store = ExtHandlerStateStore()
+        fileutil.write_file(store.get_snapshot_file(), json.dumps({
+            "handlers": {"Foo-1.0": {"state": "Enabled"}},
+            "installed": ["Foo-1.0"],
+            "goal_state": {"incarnation": "1"}
+        }))
+        #Handler state and goal state are kept, inventory is rebuilt
+        self.assertEquals("Enabled", store.get_handler_state("Foo-1.0"))
+        self.assertEquals({"incarnation": "1"}, store.get_goal_state())
+        self.assertEquals(["1.0"], store.get_installed_versions("Foo"))
+
+if __name__ == '__main__':
+    unittest.main()
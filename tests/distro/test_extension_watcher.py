@@ -0,0 +1,106 @@
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.4+ and Openssl 1.0+
+#
+# Implements parts of RFC 2131, 1541, 1497 and
+# http://msdn.microsoft.com/en-us/library/cc227282%28PROT.10%29.aspx
+# http://msdn.microsoft.com/en-us/library/cc227259%28PROT.13%29.aspx
+
+
+from tests.tools import *
+import json
+import threading
+import azurelinuxagent.utils.fileutil as fileutil
+import azurelinuxagent.distro.default.extensionWatcher as extensionWatcher
+from azurelinuxagent.distro.default.extensionWatcher import ExtStatusWatcher
+
+class TestExtStatusWatcher(AgentTestCase):
+    def _write_status(self, path, status):
+        fileutil.write_file(path, json.dumps([{"status": {"status": status}}]))
+
+    def _test_read_json(self, watcher):
+        status_dir = os.path.join(self.tmp_dir, "status")
+        fileutil.mkdir(status_dir)
+        status_file = os.path.join(status_dir, "0.status")
+        self._write_status(status_file, "transitioning")
+        watcher.watch(status_dir, notify=True)
+
+        data = watcher.read_json(status_file)
+        self.assertEquals("transitioning", data[0]["status"]["status"])
+
+        #Not changed, file is not read again
+        with patch.object(fileutil, "read_file") as mock_read:
+            watcher.read_json(status_file)
+            self.assertEquals(0, mock_read.call_count)
+
+        self._write_status(status_file, "success")
+        #Make sure the stamp is different on coarse timestamps
+        os.utime(status_file, (0, 0))
+        data = watcher.read_json(status_file)
+        self.assertEquals("success", data[0]["status"]["status"])
+
+        os.remove(status_file)
+        self.assertRaises(IOError, watcher.read_json, status_file)
+
+    @patch("azurelinuxagent.distro.default.extensionWatcher.RACY_INTERVAL", -1)
+    def test_read_json_inotify(self):
+        watcher = ExtStatusWatcher()
+        if not watcher.get_inotify().is_available():
+            self.skipTest("inotify is not available")
+        self._test_read_json(watcher)
+
+    @patch("azurelinuxagent.distro.default.extensionWatcher.RACY_INTERVAL", -1)
+    def test_read_json_polling(self):
+        watcher = ExtStatusWatcher()
+        watcher.inotify = Mock()
+        watcher.inotify.is_available = Mock(return_value=False)
+        self._test_read_json(watcher)
+
+    @patch("azurelinuxagent.distro.default.extensionWatcher.RACY_INTERVAL", -1)
+    def test_get_dir_value(self):
+        conf_dir = os.path.join(self.tmp_dir, "config")
+        fileutil.mkdir(conf_dir)
+        watcher = ExtStatusWatcher()
+        compute = Mock(side_effect=lambda path: len(os.listdir(path)))
+
+        self.assertEquals(0, watcher.get_dir_value(conf_dir, compute))
+        self.assertEquals(0, watcher.get_dir_value(conf_dir, compute))
+        self.assertEquals(1, compute.call_count)
+
+        fileutil.write_file(os.path.join(conf_dir, "0.settings"), "")
+        os.utime(conf_dir, (0, 0))
+        self.assertEquals(1, watcher.get_dir_value(conf_dir, compute))
+        self.assertEquals(2, compute.call_count)
+
+    @patch("azurelinuxagent.distro.default.extensionWatcher.POLL_INTERVAL", 0.1)
+    @patch("azurelinuxagent.distro.default.extensionWatcher.DEBOUNCE_INTERVAL",
+           0.1)
+    def test_notify_on_change(self):
+        status_dir = os.path.join(self.tmp_dir, "status")
+        fileutil.mkdir(status_dir)
+        changed = threading.Event()
+        watcher = ExtStatusWatcher(changed.set)
+        watcher.watch(status_dir, notify=True)
+        watcher.start()
+        try:
+            self._write_status(os.path.join(status_dir, "0.status"), 
+                               "success")
+            changed.wait(5)
+            self.assertTrue(changed.isSet())
+        finally:
+            watcher.stop()
+
+if __name__ == '__main__':
+    unittest.main()
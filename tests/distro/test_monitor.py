@@ -21,6 +21,11 @@
 from tests.tools import *
 from azurelinuxagent.exception import *
 from azurelinuxagent.distro.default.monitor import *
+from azurelinuxagent.distro.loader import get_distro
+from azurelinuxagent.protocol.restapi import VMInfo
+import azurelinuxagent.event as event
+import azurelinuxagent.metrics as metrics
+import datetime
 
 class TestMonitor(AgentTestCase):
     def test_parse_xml_event(self):
@@ -30,3 +35,175 @@ class TestMonitor(AgentTestCase):
         self.assertNotEquals(0, event.parameters)
         self.assertNotEquals(None, event.parameters[0])
 
+    def _mock_monitor(self):
+        event_dir = os.path.join(self.tmp_dir, "events")
+        self.reporter = event.EventLogger()
+        event.init_event_logger(event_dir, reporter=self.reporter)
+        for msg in ["msg_a", "msg_b", "msg_c"]:
+            event.add_event("Test", message=msg,
+                            reporter=self.reporter)
+        #Event file of previous agent
+        with open(os.path.join(event_dir, "1.tld"), "w") as evt_file:
+            evt_file.write(load_data('ext/event.xml'))
+
+        distro = get_distro()
+        self.protocol = Mock()
+        self.protocol.report_event = Mock(return_value=0)
+        distro.protocol_util.get_protocol = Mock(return_value=self.protocol)
+        distro.task_timing.jitter = lambda x : x
+        return MonitorHandler(distro)
+
+    def _get_sent_events(self):
+        events = []
+        for args, kw in self.protocol.report_event.call_args_list:
+            events.extend(args[0].encoded_events)
+            events.extend(args[0].events)
+        return events
+
+    def test_collect_and_send_events(self):
+        monitor = self._mock_monitor()
+        event_dir = self.reporter.event_dir
+        with patch("azurelinuxagent.distro.default.monitor.get_event_spool",
+                   return_value=self.reporter.get_spool()):
+            self.assertTrue(monitor.collect_and_send_events())
+            events = self._get_sent_events()
+            self.assertEquals(4, len(events))
+            #Spooled events are passed through encoded
+            event_id, provider_id, params = events[2]
+            self.assertEquals("69B669B9-4AF8-4C50-BDC4-6006FA76E975",
+                              provider_id)
+            self.assertTrue('<Param Name="Message" Value="msg_c" T="mt:wstr" />'
+                            in params)
+            #Events of previous agent are parsed
+            self.assertTrue(isinstance(events[3], TelemetryEvent))
+
+            #Events are consumed
+            self.protocol.report_event.reset_mock()
+            self.assertTrue(monitor.collect_and_send_events())
+            self.assertEquals(0, self.protocol.report_event.call_count)
+            self.assertEquals(["cursor"], [x for x in os.listdir(event_dir)
+                                           if not x.endswith(".spool")])
+
+    def test_send_events_retry(self):
+        metrics.__metrics__.reset()
+        monitor = self._mock_monitor()
+        monitor.sysinfo_initialized = True
+        monitor.last_heartbeat = datetime.datetime.now()
+        monitor.heartbeat_period = datetime.timedelta(seconds=3600)
+        self.protocol.report_event = Mock(side_effect=ProtocolError())
+        with patch("azurelinuxagent.distro.default.monitor.get_event_spool",
+                   return_value=self.reporter.get_spool()):
+            #Retry with backoff, events are kept
+            self.assertEquals(EVENT_RETRY_INTERVAL, monitor.send_events())
+            self.assertEquals(EVENT_RETRY_INTERVAL * 2, monitor.send_events())
+            gauges = metrics.get_metrics()["gauges"]
+            self.assertTrue(gauges["event.spool_depth"] > 0)
+            self.assertTrue(gauges["event.oldest_age"] >= 0)
+
+            self.protocol.report_event = Mock(return_value=0)
+            self.assertEquals(None, monitor.send_events())
+            self.assertEquals(4, len(self._get_sent_events()))
+            self.assertEquals(0, monitor.send_failures)
+
+        data = metrics.get_metrics()
+        self.assertEquals(4, data["counters"]["event.delivered"])
+        self.assertEquals(2, data["counters"]["event.send_failures"])
+        self.assertEquals(0, data["gauges"]["event.spool_depth"])
+        self.assertEquals(0, data["gauges"]["event.oldest_age"])
+
+    def test_send_events_rejected(self):
+        metrics.__metrics__.reset()
+        monitor = self._mock_monitor()
+        spool = self.reporter.get_spool()
+        #The server never accepts msg_b
+        def report_event(event_list):
+            for event_id, provider_id, params in event_list.encoded_events:
+                if "msg_b" in params:
+                    raise ProtocolError()
+            return 0
+        self.protocol.report_event = Mock(side_effect=report_event)
+        attempts = 0
+        while not monitor.send_spooled_events(self.protocol, spool):
+            attempts += 1
+            self.assertTrue(attempts < 100)
+        #Split till the rejected event is alone, then it's dropped
+        self.assertEquals(EVENT_BATCH_MAX_ATTEMPTS * 3 - 1, attempts)
+        self.assertEquals(EVENT_BATCH_SIZE, monitor.batch_size)
+        self.assertEquals(0, spool.get_pending_size())
+        sent = [x for x in self._get_sent_events() if "msg_b" not in x[2]]
+        self.assertEquals(2, len(set([x[2] for x in sent])))
+        data = metrics.get_metrics()
+        self.assertEquals(1, data["counters"]["event.dropped"])
+
+    def test_send_events_too_large(self):
+        metrics.__metrics__.reset()
+        monitor = self._mock_monitor()
+        self.protocol.report_event = Mock(return_value=1)
+        with patch("azurelinuxagent.distro.default.monitor.get_event_spool",
+                   return_value=self.reporter.get_spool()):
+            self.assertTrue(monitor.collect_and_send_events())
+        data = metrics.get_metrics()
+        self.assertEquals(2, data["counters"]["event.dropped"])
+        self.assertEquals(2, data["counters"]["event.delivered"])
+
+    def test_report_metrics(self):
+        metrics.__metrics__.reset()
+        metrics.inc_counter("goal_state.changes", 3)
+        metrics.observe("goal_state.poll_interval", 5)
+        monitor = self._mock_monitor()
+        monitor.sysinfo_initialized = True
+        monitor.last_heartbeat = datetime.datetime.now()
+        monitor.heartbeat_period = datetime.timedelta(seconds=3600)
+        with patch("azurelinuxagent.distro.default.monitor.add_event") \
+                as mock_add_event:
+            #Not published before the period is over
+            monitor.send_events()
+            self.assertEquals(0, mock_add_event.call_count)
+
+            period = datetime.timedelta(seconds=METRICS_PERIOD + 1)
+            monitor.last_metrics_report -= period
+            monitor.send_events()
+            args, kw = mock_add_event.call_args
+            self.assertEquals(WALAEventOperation.Metrics, kw["op"])
+            summary = json.loads(kw["message"])
+            self.assertEquals(3, summary["counters"]["goal_state.changes"])
+            self.assertEquals({"count": 1, "sum": 5, "min": 5, "max": 5},
+                              summary["histograms"]["goal_state.poll_interval"])
+
+    def test_update_sysinfo(self):
+        monitor = self._mock_monitor()
+        vminfo = VMInfo(vmName="vm", containerId="c1", roleName="role",
+                        roleInstanceName="role_0", tenantName="tenant")
+        self.protocol.get_vminfo = Mock(return_value=vminfo)
+        monitor.init_sysinfo()
+        monitor.update_sysinfo()
+        sysinfo = monitor.sysinfo
+        self.assertEquals(["vm", "tenant", "role", "role_0", "c1"],
+                          [x.value for x in sysinfo[-5:]])
+        self.assertEquals(sysinfo, monitor.new_event_list().common_params)
+
+        #Not rebuilt unless vm info is changed
+        monitor.update_sysinfo()
+        self.assertTrue(sysinfo is monitor.sysinfo)
+        vminfo.containerId = "c2"
+        monitor.update_sysinfo()
+        self.assertEquals("c2", monitor.sysinfo[-1].value)
+        self.assertEquals("c1", sysinfo[-1].value)
+
+    def test_wake(self):
+        metrics.__metrics__.reset()
+        monitor = self._mock_monitor()
+        monitor.distro.task_scheduler = Mock()
+        monitor.wake()
+        monitor.distro.task_scheduler.trigger.assert_called_with(MONITOR_TASK)
+
+        #Not woken while backing off
+        monitor.distro.task_scheduler.reset_mock()
+        monitor.send_failures = 1
+        monitor.wake()
+        self.assertEquals(0, monitor.distro.task_scheduler.trigger.call_count)
+        self.assertEquals(1,
+                          metrics.get_metrics()["counters"]["event.early_flush"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -83,6 +83,24 @@ class TestProtocolUtil(AgentTestCase):
         protocol_util._detect_metadata_protocol.assert_any_call()
         protocol_util._detect_wire_protocol.assert_not_called()
 
+    @distros()
+    def test_get_cached_protocol(self, distro_name, distro_version,
+                                 distro_full_name, _):
+        distro = get_distro(distro_name, distro_version, distro_full_name)
+        protocol_util = distro.protocol_util
+        self.assertRaises(ProtocolError, protocol_util.get_cached_protocol)
+
+        endpoint_file = os.path.join(self.tmp_dir, ENDPOINT_FILE_NAME)
+        with open(endpoint_file, "w+") as endpoint_fd:
+            endpoint_fd.write("foo.bar")
+        protocol = protocol_util.get_cached_protocol()
+        self.assertEquals("foo.bar", protocol.endpoint)
+
+        #Metadata protocol doesn't cache goal state
+        tag_file = os.path.join(self.tmp_dir, TAG_FILE_NAME)
+        with open(tag_file, "w+") as tag_fd:
+            tag_fd.write("")
+        self.assertRaises(ProtocolError, protocol_util.get_cached_protocol)
 
 if __name__ == '__main__':
     unittest.main()
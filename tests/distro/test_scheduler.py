@@ -0,0 +1,294 @@
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.4+ and Openssl 1.0+
+#
+# Implements parts of RFC 2131, 1541, 1497 and
+# http://msdn.microsoft.com/en-us/library/cc227282%28PROT.10%29.aspx
+# http://msdn.microsoft.com/en-us/library/cc227259%28PROT.13%29.aspx
+
+
+from tests.tools import *
+import azurelinuxagent.metrics as metrics
+import time
+import threading
+from azurelinuxagent.distro.default.scheduler import GoalStatePollScheduler, \
+                                                    TaskTiming, TaskScheduler, \
+                                                    Task, TASK_DONE
+
+class TestGoalStatePollScheduler(AgentTestCase):
+    def test_next_interval(self):
+        metrics.__metrics__.reset()
+        scheduler = GoalStatePollScheduler(min_interval=3, max_interval=120,
+                                           fast_window=60, jitter=0,
+                                           rand=lambda : 0.5)
+        now = 1000
+        #Poll fast after goal state is changed
+        self.assertEquals(3, scheduler.next_interval(True, False, now=now))
+        now += 30
+        self.assertEquals(3, scheduler.next_interval(False, False, now=now))
+
+        #Back off exponentially when idle, up to the ceiling
+        now += 31
+        intervals = []
+        for i in range(0, 8):
+            intervals.append(scheduler.next_interval(False, False, now=now))
+            now += intervals[-1]
+        self.assertEquals([6, 12, 24, 48, 96, 120, 120, 120], intervals)
+
+        #Poll fast while handlers are transitioning
+        self.assertEquals(3, scheduler.next_interval(False, True, now=now))
+        now += 3
+        self.assertEquals(6, scheduler.next_interval(False, False, now=now))
+
+        #Reaction latency is the time since last poll
+        now += 6
+        scheduler.next_interval(True, False, now=now)
+        self.assertEquals(6, scheduler.reaction_latency)
+
+        data = metrics.get_metrics()
+        self.assertEquals(3, data["gauges"]["goal_state.poll_interval"])
+        histogram = data["histograms"]["goal_state.reaction_latency"]
+        self.assertEquals(1, histogram["count"])
+
+    def test_jitter(self):
+        scheduler = GoalStatePollScheduler(min_interval=3, max_interval=120,
+                                           jitter=0.1, rand=lambda : 1)
+        scheduler.base_interval = 50
+        interval = scheduler.next_interval(False, False, now=1000)
+        self.assertEquals(110, interval)
+        #Never polls slower than max interval
+        interval = scheduler.next_interval(False, False, now=1110)
+        self.assertEquals(120, interval)
+
+        scheduler = GoalStatePollScheduler(min_interval=3, max_interval=120,
+                                           jitter=0.1, rand=lambda : 0)
+        #Never polls faster than min interval
+        self.assertEquals(3, scheduler.next_interval(True, False, now=1000))
+
+def simulate_peak_rate(timings, period, duration, spread):
+    """
+    Agents of timings start at the same time and poll every period.
+    Return the max number of requests within one second.
+    """
+    requests = {}
+    for timing in timings:
+        now = timing.get_phase_offset(spread) if spread > 0 else 0
+        while now < duration:
+            second = int(now)
+            requests[second] = requests.get(second, 0) + 1
+            now += timing.jitter(period) if spread > 0 else period
+    return max(requests.values())
+
+class TestTaskTiming(AgentTestCase):
+    def test_phase_offset(self):
+        timing = TaskTiming(vm_id="container/role_IN_0")
+        offset = timing.get_phase_offset(60)
+        self.assertTrue(0 <= offset < 60)
+
+        #Stable for the same VM, different across VMs
+        self.assertEquals(offset, TaskTiming(vm_id="container/role_IN_0")
+                                  .get_phase_offset(60))
+        offsets = set()
+        for i in range(0, 100):
+            timing = TaskTiming(vm_id="container/role_IN_{0}".format(i))
+            offsets.add(int(timing.get_phase_offset(60)))
+        self.assertTrue(len(offsets) > 30)
+
+    def test_jitter(self):
+        timing = TaskTiming(vm_id="vm", jitter=0.1)
+        for i in range(0, 1000):
+            interval = timing.jitter(60)
+            self.assertTrue(54 <= interval <= 66)
+
+    def test_fleet_peak_rate(self):
+        """Peak wire server request rate of 200 co-located agents"""
+        timings = [TaskTiming(vm_id="container/role_IN_{0}".format(i))
+                   for i in range(0, 200)]
+        lock_step = simulate_peak_rate(timings, 25, 3600, 0)
+        spread = simulate_peak_rate(timings, 25, 3600, 25)
+        self.assertEquals(200, lock_step)
+        self.assertTrue(spread <= 40, spread)
+
+class TestTaskScheduler(AgentTestCase):
+    def setUp(self):
+        AgentTestCase.setUp(self)
+        metrics.__metrics__.reset()
+        self.scheduler = TaskScheduler(workers=2, coalesce=0.01)
+        self.scheduler.start()
+
+    def tearDown(self):
+        self.scheduler.stop()
+        AgentTestCase.tearDown(self)
+
+    def test_periodic_task(self):
+        done = threading.Event()
+        runs = []
+        def func():
+            runs.append(1)
+            if len(runs) == 3:
+                done.set()
+                return TASK_DONE
+        self.scheduler.add_task(Task("Periodic", func, interval=0.01))
+        done.wait(5)
+        self.assertEquals(3, len(runs))
+        self.assertFalse("Periodic" in self.scheduler.tasks)
+
+        data = metrics.get_metrics()
+        histogram = data["histograms"]["scheduler.Periodic.delay"]
+        self.assertEquals(3, histogram["count"])
+        histogram = data["histograms"]["scheduler.Periodic.duration"]
+        self.assertEquals(3, histogram["count"])
+
+    def test_trigger(self):
+        done = threading.Event()
+        task = Task("Triggered", done.set, offload=True)
+        self.scheduler.add_task(task)
+        done.wait(5)
+        done.clear()
+
+        #Only runs again when triggered
+        done.wait(0.1)
+        self.assertFalse(done.isSet())
+        self.scheduler.trigger("Triggered")
+        done.wait(5)
+        self.assertTrue(done.isSet())
+
+    def test_shared_lock(self):
+        lock = threading.Lock()
+        state = {"running": 0, "overlap": False, "runs": 0}
+        done = threading.Event()
+        def func():
+            state["running"] += 1
+            if state["running"] > 1:
+                state["overlap"] = True
+            threading.Event().wait(0.01)
+            state["running"] -= 1
+            state["runs"] += 1
+            if state["runs"] >= 10:
+                done.set()
+        self.scheduler.add_task(Task("Task1", func, interval=0, offload=True,
+                                     lock=lock))
+        self.scheduler.add_task(Task("Task2", func, interval=0, offload=True,
+                                     lock=lock))
+        done.wait(5)
+        self.scheduler.stop()
+        self.assertTrue(state["runs"] >= 10)
+        self.assertFalse(state["overlap"])
+
+    @patch("azurelinuxagent.distro.default.scheduler.LOCK_RETRY_INTERVAL",
+           0.01)
+    def test_lock_held(self):
+        lock = threading.Lock()
+        locked_runs = []
+        done = threading.Event()
+        lock.acquire()
+        try:
+            for i in range(0, 2):
+                self.scheduler.add_task(Task("Locked{0}".format(i),
+                                             lambda: locked_runs.append(1),
+                                             offload=True, lock=lock))
+            #Workers are not held up by the tasks waiting for the lock
+            self.scheduler.add_task(Task("Free", done.set, offload=True))
+            done.wait(5)
+            self.assertTrue(done.isSet())
+            self.assertEquals(0, len(locked_runs))
+        finally:
+            lock.release()
+        #Tried again once released
+        for i in range(0, 500):
+            if len(locked_runs) == 2:
+                break
+            threading.Event().wait(0.01)
+        self.assertEquals(2, len(locked_runs))
+
+    def test_remove_task(self):
+        started = threading.Event()
+        release = threading.Event()
+        def func():
+            started.set()
+            release.wait(5)
+        self.scheduler.add_task(Task("Blocking", func, interval=0,
+                                     offload=True))
+        started.wait(5)
+        threading.Timer(0.05, release.set).start()
+        #Waits for the running task
+        self.scheduler.remove_task("Blocking")
+        self.assertTrue(release.isSet())
+
+    def test_coalesce(self):
+        scheduler = TaskScheduler(coalesce=1)
+        now = time.time()
+        tasks = [Task("Task{0}".format(i), None) for i in range(0, 3)]
+        scheduler.cond.acquire()
+        try:
+            scheduler._push(tasks[0], now)
+            scheduler._push(tasks[1], now + 0.5)
+            scheduler._push(tasks[2], now + 10)
+
+            #Tasks due within the window run in one wakeup
+            due_tasks = scheduler._pop_due()
+            wait = scheduler._pop_due()
+        finally:
+            scheduler.cond.release()
+        self.assertEquals([tasks[0], tasks[1]], [x[0] for x in due_tasks])
+        self.assertTrue(8 < wait <= 10)
+
+    def test_task_error(self):
+        errors = []
+        done = threading.Event()
+        def on_error(task, err_msg):
+            errors.append((task.name, err_msg))
+            done.set()
+        def func():
+            raise Exception("Mock task error")
+        self.scheduler.error_listener = on_error
+        self.scheduler.add_task(Task("Failing", func, interval=60))
+        done.wait(5)
+        self.assertEquals("Failing", errors[0][0])
+        self.assertTrue("Mock task error" in errors[0][1])
+        data = metrics.get_metrics()
+        self.assertEquals(1, data["counters"]["scheduler.Failing.failures"])
+
+        #Non-critical task failure keeps the scheduler running
+        self.assertTrue(self.scheduler.is_running())
+        self.assertEquals(None, self.scheduler.error)
+
+    def test_critical_task_error(self):
+        def func():
+            raise Exception("Mock critical error")
+        self.scheduler.add_task(Task("Critical", func, interval=60,
+                                     offload=True, critical=True))
+        self.scheduler.join(5)
+        self.assertFalse(self.scheduler.is_running())
+        self.assertTrue("Mock critical error" in self.scheduler.error)
+
+        #Restart clears the error
+        self.scheduler.stop()
+        self.scheduler.start()
+        self.assertTrue(self.scheduler.is_running())
+        self.assertEquals(None, self.scheduler.error)
+
+    def test_stop(self):
+        runs = []
+        self.scheduler.add_task(Task("Task", lambda : runs.append(1),
+                                     interval=0.01))
+        self.scheduler.stop()
+        count = len(runs)
+        self.assertFalse(self.scheduler.is_running())
+        threading.Event().wait(0.05)
+        self.assertEquals(count, len(runs))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,116 @@
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.4+ and Openssl 1.0+
+#
+# Implements parts of RFC 2131, 1541, 1497 and
+# http://msdn.microsoft.com/en-us/library/cc227282%28PROT.10%29.aspx
+# http://msdn.microsoft.com/en-us/library/cc227259%28PROT.13%29.aspx
+
+
+from tests.tools import *
+import azurelinuxagent.metrics as metrics
+import threading
+from azurelinuxagent.exception import ProtocolError
+from azurelinuxagent.distro.default.scheduler import TaskScheduler
+from azurelinuxagent.distro.default.statusReporter import StatusReporter, \
+                                                         STATUS_UPLOAD_TASK, \
+                                                         STATUS_RETRY_INTERVAL
+
+def _mock_protocol():
+    protocol = Mock()
+    protocol.get_vm_status_report = Mock(side_effect=lambda x: x)
+    return protocol
+
+class TestStatusReporter(AgentTestCase):
+    def setUp(self):
+        AgentTestCase.setUp(self)
+        metrics.__metrics__.reset()
+
+    def test_latest_wins(self):
+        task_scheduler = Mock()
+        reporter = StatusReporter(task_scheduler)
+        protocol = _mock_protocol()
+        reporter.post(protocol, "status1")
+        reporter.post(protocol, "status2")
+        task_scheduler.trigger.assert_called_with(STATUS_UPLOAD_TASK)
+
+        self.assertEquals(None, reporter.upload())
+        protocol.upload_vm_status_report.assert_called_once_with("status2")
+
+        #Nothing to upload
+        self.assertEquals(None, reporter.upload())
+        self.assertEquals(1, protocol.upload_vm_status_report.call_count)
+
+        data = metrics.get_metrics()
+        self.assertEquals(1, data["counters"]["status.coalesced"])
+        self.assertEquals(1, data["histograms"]["status.upload_latency"]["count"])
+        self.assertEquals(1, data["histograms"]["status.queue_age"]["count"])
+
+    @patch("azurelinuxagent.distro.default.statusReporter.add_event")
+    def test_retry(self, _):
+        reporter = StatusReporter(Mock())
+        protocol = _mock_protocol()
+        protocol.upload_vm_status_report = Mock(side_effect=ProtocolError())
+        reporter.post(protocol, "status1")
+
+        #Failed status is kept for retry
+        self.assertEquals(STATUS_RETRY_INTERVAL, reporter.upload())
+        self.assertEquals("status1", reporter.pending[1])
+
+        #Unless newer status is posted during upload
+        def upload(report):
+            reporter.post(protocol, "status2")
+            raise ProtocolError()
+        protocol.upload_vm_status_report = Mock(side_effect=upload)
+        self.assertEquals(None, reporter.upload())
+        self.assertEquals("status2", reporter.pending[1])
+        self.assertEquals(2, metrics.get_metrics()["counters"]["status.upload_failures"])
+
+    def test_background_upload(self):
+        task_scheduler = TaskScheduler()
+        task_scheduler.start()
+        reporter = StatusReporter(task_scheduler)
+        reporter.start()
+
+        uploading = threading.Event()
+        release = threading.Event()
+        uploaded = []
+        def upload(report):
+            uploading.set()
+            release.wait(5)
+            uploaded.append(report)
+
+        protocol = _mock_protocol()
+        protocol.upload_vm_status_report = Mock(side_effect=upload)
+        try:
+            reporter.post(protocol, "status0")
+            uploading.wait(5)
+
+            #Posting never waits for the slow upload, and a burst of status
+            #is uploaded once with the latest one
+            for i in range(1, 10):
+                reporter.post(protocol, "status{0}".format(i))
+            self.assertEquals([], uploaded)
+            release.set()
+            for i in range(0, 100):
+                if len(uploaded) == 2:
+                    break
+                threading.Event().wait(0.05)
+        finally:
+            task_scheduler.stop()
+        self.assertEquals(["status0", "status9"], uploaded)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -24,12 +24,19 @@ import uuid
 import unittest
 import os
 import time
+import threading
+import json
 from azurelinuxagent.utils.restutil import httpclient
 from azurelinuxagent.utils.cryptutil import CryptUtil
+import azurelinuxagent.utils.fileutil as fileutil
 from azurelinuxagent.protocol.restapi import *
 from azurelinuxagent.protocol.wire import WireClient, WireProtocol, \
                                           TRANSPORT_PRV_FILE_NAME, \
-                                          TRANSPORT_CERT_FILE_NAME
+                                          TRANSPORT_CERT_FILE_NAME, \
+                                          INCARNATION_FILE_NAME, \
+                                          StatusBuilder, vm_status_to_v1, \
+                                          ext_handler_status_to_v1, \
+                                          GoalState, GoalStateSnapshot
 
 data_with_bom = b'\xef\xbb\xbfhehe'
 
@@ -81,5 +88,326 @@ class TestWireProtocolGetters(AgentTestCase):
         test_data = WireProtocolData(DATA_FILE_EXT_NO_PUBLIC)
         self._test_getters(test_data, *args)
 
+@patch("time.sleep")
+class TestWireClient(AgentTestCase):
+
+    def _mock_client(self):
+        client = WireClient("foo.bar")
+        goal_state_xml = load_data("wire/goal_state.xml")
+        self.incarnation = 1
+
+        def fetch_config(uri, headers):
+            return goal_state_xml.replace("<Incarnation>1<",
+                                          "<Incarnation>{0}<".format(
+                                              self.incarnation))
+        client.fetch_config = fetch_config
+        #Tag each config with incarnation of the goal state it's fetched for
+        client.update_hosting_env = lambda gs: gs.incarnation
+        client.update_shared_conf = lambda gs: gs.incarnation
+        client.update_certs = lambda gs: gs.incarnation
+        client.update_ext_conf = lambda gs: gs.incarnation
+        return client
+
+    def test_update_goal_state(self, _):
+        client = self._mock_client()
+        client.update_goal_state()
+        self.assertEquals("1", client.get_goal_state().incarnation)
+        self.assertEquals("1", client.get_ext_conf())
+
+        #Not changed, snapshot is kept
+        snapshot = client.snapshot
+        client.update_goal_state()
+        self.assertTrue(snapshot is client.snapshot)
+
+        self.incarnation = 2
+        client.update_goal_state()
+        self.assertEquals("2", client.goal_state.incarnation)
+        self.assertEquals("2", client.hosting_env)
+        #The old snapshot is not modified
+        self.assertEquals("1", snapshot.goal_state.incarnation)
+        self.assertEquals("1", snapshot.ext_conf)
+
+    def test_get_snapshot(self, _):
+        client = self._mock_client()
+        client.update_goal_state()
+        snapshot = client.snapshot
+        self.assertTrue(snapshot is client.get_snapshot("goal_state",
+                                                        "ext_conf"))
+
+        #Missing configs are loaded from cache into a new snapshot
+        client.snapshot = snapshot.replace(hosting_env=None)
+        client.load_hosting_env = Mock(return_value="cached")
+        snapshot = client.get_snapshot("goal_state", "hosting_env")
+        self.assertEquals("cached", snapshot.hosting_env)
+        self.assertTrue(snapshot is client.snapshot)
+
+    def test_get_ext_handlers_consistent(self, _):
+        client = self._mock_client()
+        client.update_goal_state()
+        self.incarnation = 2
+        new_snapshot = client.snapshot.replace(
+            goal_state=GoalState(client.fetch_config(None, None)),
+            ext_conf=Mock(ext_handlers="ext_handlers_2"))
+
+        #New goal state is published right after the old one is read
+        class SwappedSnapshot(GoalStateSnapshot):
+            def __getattribute__(self, name):
+                if name == "goal_state":
+                    client.snapshot = new_snapshot
+                return GoalStateSnapshot.__getattribute__(self, name)
+        old_snapshot = client.snapshot
+        client.snapshot = SwappedSnapshot(
+            goal_state=old_snapshot.goal_state,
+            ext_conf=Mock(ext_handlers="ext_handlers_1"))
+        protocol = WireProtocol("foo.bar")
+        protocol.client = client
+        self.assertEquals(("ext_handlers_1", "1"),
+                          protocol.get_cached_ext_handlers())
+
+    def test_update_goal_state_failed(self, _):
+        client = self._mock_client()
+        client.update_goal_state()
+        snapshot = client.snapshot
+
+        self.incarnation = 2
+        client.update_ext_conf = Mock(side_effect=ProtocolError("foo"))
+        self.assertRaises(ProtocolError, client.update_goal_state)
+        self.assertTrue(snapshot is client.snapshot)
+        incarnation_file = os.path.join(self.tmp_dir, INCARNATION_FILE_NAME)
+        self.assertEquals("1", fileutil.read_file(incarnation_file))
+
+        #Failed update is retried on next call
+        client.update_ext_conf = lambda gs: gs.incarnation
+        client.update_goal_state()
+        self.assertEquals("2", client.ext_conf)
+
+    def test_concurrent_update(self, _):
+        client = self._mock_client()
+        client.update_goal_state()
+        errors = []
+        done = threading.Event()
+
+        def read():
+            #Bounded, so that readers don't starve the writer
+            for i in range(0, 500):
+                if done.is_set():
+                    break
+                snapshot = client.snapshot
+                incarnation = snapshot.goal_state.incarnation
+                for config in (snapshot.hosting_env, snapshot.shared_conf,
+                               snapshot.certs, snapshot.ext_conf):
+                    if config != incarnation:
+                        errors.append((incarnation, config))
+
+        readers = [threading.Thread(target=read) for i in range(0, 4)]
+        for reader in readers:
+            reader.start()
+        for i in range(2, 200):
+            self.incarnation = i
+            client.update_goal_state()
+        done.set()
+        for reader in readers:
+            reader.join()
+
+        self.assertEquals([], errors)
+        self.assertEquals("199", client.get_goal_state().incarnation)
+
+    def test_prevent_throttling(self, mock_sleep):
+        client = WireClient("foo.bar")
+
+        def request():
+            for i in range(0, 30):
+                client.prevent_throttling()
+
+        threads = [threading.Thread(target=request) for i in range(0, 4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        #Every third request sleeps, and so does each one following another
+        #within a second.
+        self.assertEquals(0, client.req_count)
+        self.assertEquals(40 + 119, mock_sleep.call_count)
+
+    def test_report_event(self, _):
+        client = WireClient("foo.bar")
+        client.send_event = Mock()
+        event_list = TelemetryEventList()
+        event_list.common_params.append(TelemetryEventParam("VMName", "vm"))
+        event_list.common_params.append(TelemetryEventParam("RAM", 1024))
+        for msg in ["foo", "bar"]:
+            event = TelemetryEvent(1, "provider")
+            event.parameters.append(TelemetryEventParam("Message", msg))
+            event.parameters.append(TelemetryEventParam("IsSuccess", True))
+            event_list.events.append(event)
+
+        with patch("azurelinuxagent.protocol.restapi.event_param_to_v1",
+                   side_effect=event_param_to_v1) as mock_to_v1:
+            client.report_event(event_list)
+            client.report_event(event_list)
+            #Common parameters are only encoded once
+            self.assertEquals(2 + 4 * 2, mock_to_v1.call_count)
+
+        common = ('<Param Name="VMName" Value="vm" T="mt:wstr" />'
+                  '<Param Name="RAM" Value="1024" T="mt:uint64" />')
+        self.assertEquals(('<Event id="1"><![CDATA['
+                           '<Param Name="Message" Value="foo" T="mt:wstr" />'
+                           '<Param Name="IsSuccess" Value="True" '
+                           'T="mt:bool" />{0}]]></Event>'
+                           '<Event id="1"><![CDATA['
+                           '<Param Name="Message" Value="bar" T="mt:wstr" />'
+                           '<Param Name="IsSuccess" Value="True" '
+                           'T="mt:bool" />{0}]]></Event>').format(common),
+                          client.send_event.call_args[0][1])
+
+        #Encoded events are passed through
+        event_list.events = []
+        event_list.encoded_events.append(("2", "provider",
+                                          '<Param Name="Message" Value="baz" '
+                                          'T="mt:wstr" />'))
+        client.report_event(event_list)
+        self.assertEquals(('<Event id="2"><![CDATA['
+                           '<Param Name="Message" Value="baz" T="mt:wstr" />'
+                           '{0}]]></Event>').format(common),
+                          client.send_event.call_args[0][1])
+
+        #Encoded again when changed
+        event_list.common_params[0].value = "vm2"
+        client.report_event(event_list)
+        self.assertTrue('Value="vm2"' in client.send_event.call_args[0][1])
+
+        #Events too large are dropped and counted
+        event_list.encoded_events.append(("2", "provider",
+                                          '<Param Name="Message" Value="{0}" '
+                                          'T="mt:wstr" />'.format("x" * 65536)))
+        self.assertEquals(1, client.report_event(event_list))
+
+def _mock_vm_status(handler_count=2, msg="foo"):
+    vm_status = VMStatus()
+    vm_status.vmAgent.version = "2.1"
+    vm_status.vmAgent.status = "Ready"
+    vm_status.vmAgent.message = "Guest Agent is running"
+    ext_statuses = {}
+    for i in range(0, handler_count):
+        name = "Handler{0}".format(i)
+        handler_status = ExtHandlerStatus(name=name, version="1.0",
+                                          status="Ready")
+        handler_status.extensions.append(name)
+        vm_status.vmAgent.extensionHandlers.append(handler_status)
+        ext_status = ExtensionStatus(status="success", seq_no=0,
+                                     message="bar")
+        ext_status.substatusList.append(ExtensionSubStatus(name="sub",
+                                                           status="success",
+                                                           message=msg))
+        ext_statuses[name] = ext_status
+    return vm_status, ext_statuses
+
+@patch("time.strftime", return_value="2016-01-01T00:00:00Z")
+class TestStatusBuilder(AgentTestCase):
+
+    def test_build(self, *args):
+        vm_status, ext_statuses = _mock_vm_status()
+        builder = StatusBuilder()
+        data = json.loads(builder.build(vm_status, ext_statuses))
+        expected = vm_status_to_v1(vm_status, ext_statuses)
+        self.assertEquals(expected, data)
+
+    def test_build_timestamp(self, mock_strftime):
+        vm_status, ext_statuses = _mock_vm_status()
+        builder = StatusBuilder()
+        builder.build(vm_status, ext_statuses)
+
+        #Cached fragment gets the timestamp of the build
+        mock_strftime.return_value = "2016-01-01T00:00:25Z"
+        data = json.loads(builder.build(vm_status, ext_statuses))
+        self.assertEquals("2016-01-01T00:00:25Z", data["timestampUTC"])
+        handlers = data["aggregateStatus"]["handlerAggregateStatus"]
+        settings_status = handlers[0]["runtimeSettingsStatus"]["settingsStatus"]
+        self.assertEquals("2016-01-01T00:00:25Z", settings_status["timestampUTC"])
+
+        #Quoted field in a message is kept as it is
+        msg = '"timestampUTC": "@timestampUTC@"'
+        ext_statuses["Handler0"].substatusList[0].message = msg
+        data = json.loads(builder.build(vm_status, ext_statuses))
+        handlers = data["aggregateStatus"]["handlerAggregateStatus"]
+        settings_status = handlers[0]["runtimeSettingsStatus"]["settingsStatus"]
+        self.assertEquals(msg,
+                          settings_status["substatus"][0]["formattedMessage"]["message"])
+
+    @patch("azurelinuxagent.protocol.wire.ext_handler_status_to_v1",
+           wraps=ext_handler_status_to_v1)
+    def test_build_incremental(self, mock_to_v1, *args):
+        vm_status, ext_statuses = _mock_vm_status(handler_count=3)
+        builder = StatusBuilder()
+        builder.build(vm_status, ext_statuses)
+        self.assertEquals(3, mock_to_v1.call_count)
+
+        #Nothing changed, all the fragments are reused
+        builder.build(vm_status, ext_statuses)
+        self.assertEquals(3, mock_to_v1.call_count)
+
+        #Only the changed one is rebuilt
+        ext_statuses["Handler1"].substatusList[0].message = "baz"
+        data = json.loads(builder.build(vm_status, ext_statuses))
+        self.assertEquals(4, mock_to_v1.call_count)
+        handlers = data["aggregateStatus"]["handlerAggregateStatus"]
+        settings_status = handlers[1]["runtimeSettingsStatus"]["settingsStatus"]
+        self.assertEquals("baz",
+                          settings_status["substatus"][0]["formattedMessage"]["message"])
+
+        #Fragments of removed handlers are dropped
+        vm_status.vmAgent.extensionHandlers.pop()
+        builder.build(vm_status, ext_statuses)
+        self.assertEquals(2, len(builder.fragments))
+
+    def test_vm_status_report(self, *args):
+        vm_status, ext_statuses = _mock_vm_status()
+        protocol = WireProtocol("foo.bar")
+        for name, ext_status in ext_statuses.items():
+            protocol.report_ext_status(name, name, ext_status)
+        report = protocol.get_vm_status_report(vm_status)
+
+        #Later extension status is not in the report taken before
+        ext_status = ExtensionStatus(status="error", seq_no=1, message="baz")
+        protocol.report_ext_status("Handler0", "Handler0", ext_status)
+        protocol.client.upload_status_blob = Mock()
+        protocol.upload_vm_status_report(report)
+        data = protocol.client.upload_status_blob.call_args[0][0]
+        self.assertEquals(report, data)
+        handlers = json.loads(data)["aggregateStatus"]["handlerAggregateStatus"]
+        settings_status = handlers[0]["runtimeSettingsStatus"]["settingsStatus"]
+        self.assertEquals("success", settings_status["status"]["status"])
+
+    def test_truncate(self, *args):
+        vm_status, ext_statuses = _mock_vm_status(handler_count=4,
+                                                  msg="x" * 10000)
+        ext_statuses["Handler0"].substatusList[0].message = "short"
+        builder = StatusBuilder(max_size=16 * 1024)
+        data = builder.build(vm_status, ext_statuses)
+        self.assertTrue(len(data) <= 16 * 1024)
+
+        handlers = json.loads(data)["aggregateStatus"]["handlerAggregateStatus"]
+        msgs = []
+        for handler in handlers:
+            settings_status = handler["runtimeSettingsStatus"]["settingsStatus"]
+            msgs.append(settings_status["substatus"][0]["formattedMessage"]["message"])
+        self.assertEquals("short", msgs[0])
+        self.assertTrue(msgs[1].endswith("..."))
+        self.assertTrue(len(msgs[1]) > 3000)
+        self.assertEquals(msgs[1], msgs[2])
+        self.assertEquals(msgs[1], msgs[3])
+
+        #Truncation is deterministic
+        other = StatusBuilder(max_size=16 * 1024)
+        self.assertEquals(data, other.build(vm_status, ext_statuses))
+
+        #Messages are kept once they fit in again
+        for name in ext_statuses:
+            ext_statuses[name].substatusList[0].message = "short"
+        data = json.loads(builder.build(vm_status, ext_statuses))
+        expected = vm_status_to_v1(vm_status, ext_statuses)
+        self.assertEquals(expected, data)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,183 @@
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.4+ and Openssl 1.0+
+#
+# Implements parts of RFC 2131, 1541, 1497 and
+# http://msdn.microsoft.com/en-us/library/cc227282%28PROT.10%29.aspx
+# http://msdn.microsoft.com/en-us/library/cc227259%28PROT.13%29.aspx
+
+
+from tests.tools import *
+import time
+from azurelinuxagent.utils.textutil import parse_doc, findall, getattrib
+import azurelinuxagent.metrics as metrics
+import azurelinuxagent.event as event
+from azurelinuxagent.event import EventLogger, EventAggregator, TokenBucket
+
+class TestEvent(AgentTestCase):
+    def setUp(self):
+        AgentTestCase.setUp(self)
+        metrics.__metrics__.reset()
+        self.reporter = EventLogger()
+        event.init_event_logger(os.path.join(self.tmp_dir, "events"),
+                                reporter=self.reporter)
+
+    def _read_events(self):
+        spool = self.reporter.get_spool()
+        records, cursor = spool.read(max_bytes=1024 * 1024)
+        spool.commit(cursor)
+        events = []
+        for record in records:
+            event_id, provider_id, params_str = \
+                    event.parse_event_record(record.decode("utf-8"))
+            params = {}
+            xml_doc = parse_doc("<Event>{0}</Event>".format(params_str))
+            for param_node in findall(xml_doc, "Param"):
+                params[getattrib(param_node, "Name")] = \
+                        getattrib(param_node, "Value")
+            events.append(params)
+        return events
+
+    def _add_event(self, message, now, name="WALA", op=""):
+        kwargs = {
+            "name": name,
+            "op": op,
+            "is_success": False,
+            "duration": 0,
+            "version": "1.0",
+            "message": message,
+            "evt_type": "",
+            "is_internal": False
+        }
+        self.reporter.flush_events(now)
+        if self.reporter.aggregator.accept(kwargs, now):
+            self.reporter.write_event(**kwargs)
+
+    def test_coalesce(self):
+        now = 1000
+        for i in range(0, 10):
+            self._add_event("Failed to fetch goal state: {0}".format(i), now)
+            self._add_event("Other error", now, op="Download")
+            now += 25
+        events = self._read_events()
+        self.assertEquals(["Failed to fetch goal state: 0", "Other error"],
+                          [x["Message"] for x in events])
+
+        #Summary is written when the window ends
+        now = 1000 + event.EVENT_AGGREGATION_WINDOW
+        self.reporter.flush_events(now)
+        events = self._read_events()
+        self.assertEquals(2, len(events))
+        self.assertEquals("Failed to fetch goal state: 0 [repeated 9 times "
+                          "from 1970-01-01T00:16:40Z to "
+                          "1970-01-01T00:20:25Z]", events[0]["Message"])
+        self.assertEquals("9", events[0]["Count"])
+        self.assertEquals("1970-01-01T00:16:40Z", events[0]["FirstTime"])
+        self.assertEquals("1970-01-01T00:20:25Z", events[0]["LastTime"])
+        self.assertEquals(18,
+                          metrics.get_metrics()["counters"]["event.coalesced"])
+
+        #Written again after the window
+        self._add_event("Failed to fetch goal state: 11", now)
+        self.assertEquals(1, len(self._read_events()))
+
+    def test_rate_limit(self):
+        now = 1000
+        for i in range(0, 100):
+            self._add_event("Error {0}".format("x" * i), now, name="Ext1")
+        self._add_event("Error", now, name="Ext2")
+        events = self._read_events()
+        #Sources are limited separately
+        self.assertEquals(event.EVENT_BURST + 1, len(events))
+        self.assertEquals(100 - event.EVENT_BURST,
+                          metrics.get_metrics()["counters"]["event.suppressed"])
+
+        self.reporter.flush_events(now, force=True)
+        events = self._read_events()
+        self.assertEquals(1, len(events))
+        self.assertEquals("Ext1", events[0]["Name"])
+        self.assertEquals(event.WALAEventOperation.EventSuppressed,
+                          events[0]["Operation"])
+        self.assertEquals("Suppressed 50 events over rate limit",
+                          events[0]["Message"])
+        self.assertEquals("50", events[0]["Count"])
+        self.assertEquals("", events[0]["SuppressedOperation"])
+        self.assertEquals("1970-01-01T00:16:40Z", events[0]["FirstTime"])
+
+    def test_rate_limit_by_op(self):
+        now = 1000
+        for i in range(0, event.EVENT_BURST + 10):
+            self._add_event("Error {0}".format("x" * i), now, op="Download")
+        #Other operations of the same source are not limited
+        self._add_event("Error", now, op="Install")
+        for i in range(0, 3):
+            self._add_event("Beat {0}".format("x" * i), now,
+                            op=event.WALAEventOperation.HeartBeat)
+            self._add_event("Done {0}".format("x" * i), now,
+                            op=event.WALAEventOperation.Provision)
+        #Exempt operations pass even without any token
+        aggregator = EventAggregator(burst=0)
+        kwargs = {"name": "WALA", "op": event.WALAEventOperation.HeartBeat,
+                  "is_success": True, "message": ""}
+        self.assertTrue(aggregator.accept(kwargs, now))
+        events = self._read_events()
+        self.assertEquals(event.EVENT_BURST + 7, len(events))
+
+        self.reporter.flush_events(now, force=True)
+        events = self._read_events()
+        self.assertEquals(1, len(events))
+        self.assertEquals("Download", events[0]["SuppressedOperation"])
+        self.assertEquals("10", events[0]["Count"])
+
+    def test_token_bucket(self):
+        bucket = TokenBucket(0.5, 2, 0)
+        self.assertEquals([True, True, False],
+                          [bucket.consume(0) for i in range(0, 3)])
+        self.assertFalse(bucket.consume(1))
+        self.assertTrue(bucket.consume(2))
+        self.assertFalse(bucket.consume(2))
+
+    def test_flush_listener(self):
+        listener = Mock()
+        event.set_flush_listener(listener, reporter=self.reporter)
+        spool = self.reporter.get_spool()
+        size = spool.get_size()
+        self._add_event("foo", 1000)
+        self.assertEquals(0, listener.call_count)
+
+        #Woken by size of events
+        with patch("azurelinuxagent.event.EVENT_FLUSH_SIZE", 4096):
+            for i in range(0, 100):
+                self._add_event("x" * 100, 1000, op="Op{0}".format(i))
+                if listener.call_count > 0:
+                    break
+        self.assertEquals(1, listener.call_count)
+        self.assertTrue(spool.get_size() - size >= 4096)
+        self.assertTrue(spool.get_size() - size < 4096 + 1024)
+
+        #Woken by age of events
+        self._add_event("bar", 1000)
+        with patch("time.time", return_value=time.time() +
+                   event.EVENT_FLUSH_AGE):
+            self._add_event("baz", 1000)
+        self.assertEquals(2, listener.call_count)
+
+        #Woken by spool pressure
+        spool.max_size = spool.get_size() + 1024
+        self._add_event("qux", 1000)
+        self.assertEquals(3, listener.call_count)
+
+if __name__ == '__main__':
+    unittest.main()
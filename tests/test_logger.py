@@ -0,0 +1,386 @@
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.4+ and Openssl 1.0+
+#
+# Implements parts of RFC 2131, 1541, 1497 and
+# http://msdn.microsoft.com/en-us/library/cc227282%28PROT.10%29.aspx
+# http://msdn.microsoft.com/en-us/library/cc227259%28PROT.13%29.aspx
+
+
+from tests.tools import *
+import azurelinuxagent.logger as logger
+import gzip
+import json
+import threading
+from azurelinuxagent.logger import Logger, FileAppender, LogLevel, \
+                                   JsonFileAppender, AppenderType, \
+                                   LogWriter, OverflowPolicy, get_rotated_path
+
+class TestLogger(AgentTestCase):
+    def _read_log(self, path):
+        with open(path) as log_file:
+            return log_file.read()
+
+    def test_file_appender(self):
+        path = os.path.join(self.tmp_dir, "test.log")
+        appender = FileAppender(LogLevel.VERBOSE, path)
+        appender.write(LogLevel.INFO, "foo\n")
+        log_file = appender.log_file
+        self.assertEquals("foo\n", self._read_log(path))
+
+        #Verbose lines are buffered till the next flush
+        with patch("time.time", return_value=appender.last_flush):
+            appender.write(LogLevel.VERBOSE, "bar\n")
+        self.assertEquals("foo\n", self._read_log(path))
+        appender.write(LogLevel.WARNING, "baz\n")
+        self.assertEquals("foo\nbar\nbaz\n", self._read_log(path))
+        self.assertTrue(log_file is appender.log_file)
+
+        #Opened again after rotated
+        os.rename(path, path + ".1")
+        appender.write(LogLevel.INFO, "qux\n")
+        self.assertEquals("foo\nbar\nbaz\nqux\n",
+                          self._read_log(path + ".1"))
+        appender.write(LogLevel.INFO, "quux\n")
+        self.assertEquals("quux\n", self._read_log(path))
+        appender.close()
+
+    def test_rotate(self):
+        path = os.path.join(self.tmp_dir, "test.log")
+        appender = FileAppender(LogLevel.INFO, path, max_size=100,
+                                backup_count=2)
+        for i in range(0, 4):
+            appender.write(LogLevel.INFO, "{0}\n".format(i) * 50)
+            appender.wait_compressed()
+        appender.write(LogLevel.INFO, "foo\n")
+        appender.close()
+
+        self.assertEquals(["test.log", "test.log.1.gz", "test.log.2.gz"],
+                          sorted(os.listdir(self.tmp_dir)))
+        self.assertEquals("foo\n", self._read_log(path))
+        for index, content in [(1, "3\n"), (2, "2\n")]:
+            rotated = gzip.open(get_rotated_path(path, index), "rb")
+            try:
+                self.assertEquals(content * 50,
+                                  rotated.read().decode("ascii"))
+            finally:
+                rotated.close()
+
+    def test_rotate_in_background(self):
+        path = os.path.join(self.tmp_dir, "test.log")
+        appender = FileAppender(LogLevel.INFO, path, max_size=100,
+                                backup_count=3)
+        release = threading.Event()
+        compress_file = logger.compress_file
+        def slow_compress_file(rotated_path):
+            release.wait(5)
+            return compress_file(rotated_path)
+        with patch("azurelinuxagent.logger.compress_file",
+                   side_effect=slow_compress_file):
+            #Writes go on while the rotated files wait for compression
+            for i in range(0, 3):
+                appender.write(LogLevel.INFO, "{0}\n".format(i) * 50)
+            self.assertEquals(3, len([x for x in os.listdir(self.tmp_dir)
+                                      if x.startswith("test.log.1.")]))
+            release.set()
+            appender.wait_compressed()
+        appender.close()
+
+        #Compressed in the order of rotation
+        self.assertEquals(["test.log.1.gz", "test.log.2.gz", "test.log.3.gz"],
+                          sorted(os.listdir(self.tmp_dir)))
+        for index, content in [(1, "2\n"), (2, "1\n"), (3, "0\n")]:
+            rotated = gzip.open(get_rotated_path(path, index), "rb")
+            try:
+                self.assertEquals(content * 50,
+                                  rotated.read().decode("ascii"))
+            finally:
+                rotated.close()
+
+    def test_rotate_compress_failed(self):
+        path = os.path.join(self.tmp_dir, "test.log")
+        appender = FileAppender(LogLevel.INFO, path, max_size=100,
+                                backup_count=2)
+        with patch("azurelinuxagent.logger.compress_file",
+                   return_value=False):
+            appender.write(LogLevel.INFO, "0\n" * 50)
+            appender.wait_compressed()
+        appender.close()
+
+        #Rotated file is kept uncompressed
+        rotated = os.listdir(self.tmp_dir)
+        self.assertEquals(1, len(rotated))
+        self.assertTrue(rotated[0].startswith("test.log.1."))
+        self.assertEquals("0\n" * 50,
+                          self._read_log(os.path.join(self.tmp_dir,
+                                                      rotated[0])))
+
+    def test_rotate_compress_failed_pruned(self):
+        path = os.path.join(self.tmp_dir, "test.log")
+        appender = FileAppender(LogLevel.INFO, path, max_size=100,
+                                backup_count=2)
+        with patch("azurelinuxagent.logger.compress_file",
+                   return_value=False):
+            for i in range(0, 4):
+                appender.write(LogLevel.INFO, "{0}\n".format(i) * 50)
+                appender.wait_compressed()
+        appender.close()
+
+        #Rotated files kept uncompressed are counted as backups
+        rotated = sorted(os.listdir(self.tmp_dir))
+        self.assertEquals(2, len(rotated))
+        for name, content in zip(rotated, ["2\n", "3\n"]):
+            self.assertEquals(content * 50,
+                              self._read_log(os.path.join(self.tmp_dir,
+                                                          name)))
+
+    def test_rotate_left_over(self):
+        path = os.path.join(self.tmp_dir, "test.log")
+        with open(path + ".1.100", "w") as left_over:
+            left_over.write("0\n" * 50)
+        with open(path + ".1.200", "w") as left_over:
+            left_over.write("1\n" * 50)
+        with open(path + ".1.200.gz.tmp", "w") as left_over:
+            left_over.write("1\n")
+        appender = FileAppender(LogLevel.INFO, path, max_size=100,
+                                backup_count=3)
+        appender.write(LogLevel.INFO, "foo\n")
+        appender.wait_compressed()
+        appender.close()
+
+        #Compressed in the order of rotation once opened
+        self.assertEquals(["test.log", "test.log.1.gz", "test.log.2.gz"],
+                          sorted(os.listdir(self.tmp_dir)))
+        for index, content in [(1, "1\n"), (2, "0\n")]:
+            rotated = gzip.open(get_rotated_path(path, index), "rb")
+            try:
+                self.assertEquals(content * 50,
+                                  rotated.read().decode("ascii"))
+            finally:
+                rotated.close()
+
+    def test_shared_file_appender(self):
+        path = os.path.join(self.tmp_dir, "test.log")
+        logger1 = Logger()
+        logger1.add_appender(AppenderType.FILE, LogLevel.INFO, path)
+        logger2 = Logger()
+        logger2.add_appender(AppenderType.FILE, LogLevel.INFO, path)
+        self.assertTrue(logger1.appenders[0] is logger2.appenders[0])
+
+    def test_file_appender_eviction(self):
+        paths = [os.path.join(self.tmp_dir, "test{0}.log".format(i))
+                 for i in range(0, 3)]
+        with patch("azurelinuxagent.logger.MAX_FILE_APPENDERS", 2):
+            appenders = []
+            for path in paths:
+                test_logger = Logger()
+                test_logger.add_appender(AppenderType.FILE, LogLevel.INFO,
+                                         path)
+                appender = test_logger.appenders[0]
+                appenders.append(appender)
+            appenders[0].write(LogLevel.INFO, "foo\n")
+            appenders[1].write(LogLevel.INFO, "foo\n")
+            appenders[0].write(LogLevel.INFO, "foo\n")
+            appenders[2].write(LogLevel.INFO, "foo\n")
+            #The least recently written one is closed
+            self.assertNotEquals(None, appenders[0].log_file)
+            self.assertEquals(None, appenders[1].log_file)
+            self.assertNotEquals(None, appenders[2].log_file)
+
+            #But kept, so that the file has a single appender
+            test_logger = Logger()
+            test_logger.add_appender(AppenderType.FILE, LogLevel.INFO,
+                                     paths[1])
+            self.assertTrue(test_logger.appenders[0] is appenders[1])
+            appenders[1].write(LogLevel.INFO, "bar\n")
+            self.assertEquals(None, appenders[0].log_file)
+            self.assertEquals("foo\nbar\n", self._read_log(paths[1]))
+
+        #Closed when its owner is dropped
+        logger.close_file_appenders(paths[2])
+        self.assertEquals(None, appenders[2].log_file)
+        keys = [x for x in logger.FILE_APPENDERS if x[1] in paths]
+        self.assertEquals(2, len(keys))
+
+        #Written again after closed
+        appenders[2].write(LogLevel.INFO, "bar\n")
+        for appender in appenders:
+            appender.close()
+        self.assertEquals("foo\nbar\n", self._read_log(paths[2]))
+        for path in paths:
+            logger.close_file_appenders(path)
+
+    def test_skip_formatting(self):
+        test_logger = Logger()
+        path = os.path.join(self.tmp_dir, "test.log")
+        test_logger.add_appender(AppenderType.FILE, LogLevel.INFO, path)
+        arg = Mock()
+        arg.__format__ = Mock(return_value="foo")
+        test_logger.verb("{0}", arg)
+        self.assertEquals(0, arg.__format__.call_count)
+        test_logger.info("{0}", arg)
+        self.assertEquals(1, arg.__format__.call_count)
+        test_logger.flush()
+        self.assertTrue(self._read_log(path).endswith("INFO foo\n"))
+
+    def test_async(self):
+        writer = LogWriter()
+        appender = Mock()
+        appender.level = LogLevel.VERBOSE
+        writer.start()
+        try:
+            for i in range(0, 10):
+                msg = "{0}\n".format(i)
+                self.assertTrue(writer.put([(appender, msg)], LogLevel.INFO))
+            writer.wait_drained()
+            self.assertEquals(10, appender.write.call_count)
+            self.assertEquals((LogLevel.INFO, "9\n"),
+                              appender.write.call_args[0])
+        finally:
+            writer.stop()
+        self.assertTrue(appender.flush.call_count > 0)
+        #Written by callers after stopped
+        self.assertFalse(writer.put([(appender, "foo\n")], LogLevel.INFO))
+
+    @patch("azurelinuxagent.logger.LOG_FLUSH_INTERVAL", 0.01)
+    def test_async_idle(self):
+        writer = LogWriter()
+        appender = Mock()
+        writer.start()
+        try:
+            writer.put([(appender, "foo\n")], LogLevel.INFO)
+            writer.wait_drained()
+            self.assertEquals(1, appender.flush.call_count)
+            #Not flushed again till written
+            threading.Event().wait(0.1)
+            self.assertEquals(1, appender.flush.call_count)
+        finally:
+            writer.stop()
+
+    def test_async_invalid_config(self):
+        writer = LogWriter()
+        appender = Mock()
+        writer.start(queue_size=0, overflow_policy="foo")
+        try:
+            self.assertEquals(1, writer.queue_size)
+            self.assertEquals(OverflowPolicy.DROP_VERBOSE,
+                              writer.overflow_policy)
+            for i in range(0, 3):
+                writer.put([(appender, "foo\n")], LogLevel.INFO)
+            writer.wait_drained()
+            self.assertEquals(3, appender.write.call_count)
+        finally:
+            writer.stop()
+
+    def test_overflow(self):
+        writer = LogWriter()
+        #Running without the thread, so that the queue is never drained
+        writer.running = True
+        writer.queue_size = 2
+        appender = Mock()
+        self.assertTrue(writer.put([(appender, "foo\n")], LogLevel.INFO))
+        self.assertTrue(writer.put([(appender, "bar\n")], LogLevel.INFO))
+
+        #Verbose lines are dropped
+        self.assertTrue(writer.put([(appender, "baz\n")],
+                                   LogLevel.VERBOSE))
+        self.assertEquals(2, len(writer.queue))
+        self.assertEquals(1, writer.dropped)
+
+        #The others wait for room
+        thread = threading.Thread(target=writer.put,
+                                  args=([(appender, "qux\n")],
+                                        LogLevel.ERROR))
+        thread.start()
+        thread.join(0.1)
+        self.assertTrue(thread.is_alive())
+        self.assertEquals(2, len(writer.take()))
+        thread.join()
+        self.assertEquals([[(appender, "qux\n")]],
+                          [x[0] for x in writer.queue])
+
+        writer.overflow_policy = OverflowPolicy.DROP
+        writer.queue_size = 1
+        self.assertTrue(writer.put([(appender, "quux\n")], LogLevel.ERROR))
+        self.assertEquals(1, len(writer.queue))
+        self.assertEquals(2, writer.dropped)
+
+    def test_dropped_record(self):
+        text_path = os.path.join(self.tmp_dir, "test.log")
+        json_path = os.path.join(self.tmp_dir, "test.json")
+        text_appender = FileAppender(LogLevel.INFO, text_path)
+        json_appender = JsonFileAppender(LogLevel.INFO, json_path)
+        writer = LogWriter()
+        writer.queue.append(([(text_appender, "foo\n"),
+                              (json_appender, '{"message": "foo"}\n')],
+                             LogLevel.INFO))
+        writer.dropped = 3
+        #Not running, so it returns once the queue is drained
+        writer.run()
+        text_appender.close()
+        json_appender.close()
+
+        #Written in the format of each appender
+        lines = self._read_log(text_path).splitlines()
+        self.assertTrue(lines[-1].endswith("WARNING Dropped 3 log lines"))
+        records = [json.loads(x) for x in
+                   self._read_log(json_path).splitlines()]
+        self.assertEquals("Dropped 3 log lines", records[-1]["message"])
+        self.assertEquals("WARNING", records[-1]["level"])
+
+    def test_json_file_appender(self):
+        path = os.path.join(self.tmp_dir, "test.json")
+        parent = Logger()
+        parent.add_appender(AppenderType.JSON_FILE, LogLevel.INFO, path)
+        parent.set_context(component="WALA", incarnation="1")
+        child = Logger(parent, "[foo-1.0]")
+        child.set_context(handler="foo", version="1.0")
+        child.set_context(operation="Enable")
+        child.info("Enable {0}", "extension")
+        child.with_context(duration=1.5).info("Done")
+        parent.set_context(incarnation="2")
+        child.set_context(operation=None)
+        child.verb("Not logged")
+        child.info("Bar")
+        parent.flush()
+
+        with open(path) as log_file:
+            records = [json.loads(line) for line in log_file]
+        self.assertEquals(3, len(records))
+        for record in records:
+            self.assertEquals("INFO", record.pop("level"))
+            self.assertTrue("timestamp" in record)
+            record.pop("timestamp")
+        expected = {
+            "component": "WALA",
+            "incarnation": "1",
+            "handler": "foo",
+            "version": "1.0",
+            "operation": "Enable",
+            "message": "Enable extension"
+        }
+        self.assertEquals(expected, records[0])
+        expected["duration"] = 1.5
+        expected["message"] = "Done"
+        self.assertEquals(expected, records[1])
+        #Changes of context are picked up
+        del expected["duration"]
+        del expected["operation"]
+        expected["incarnation"] = "2"
+        expected["message"] = "Bar"
+        self.assertEquals(expected, records[2])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -62,6 +62,27 @@ class TestFileOperations(AgentTestCase):
 
         os.remove(test_file)
 
+    def test_write_file_atomic(self):
+        test_file=os.path.join(self.tmp_dir, 'test_file')
+        fileutil.write_file(test_file, u"old")
+        content = ustr(uuid.uuid4())
+        fileutil.write_file_atomic(test_file, content)
+
+        content_read = fileutil.read_file(test_file)
+        self.assertEquals(content, content_read)
+        #No temp file is left behind
+        self.assertEquals(['test_file'], os.listdir(self.tmp_dir))
+
+    def test_write_file_atomic_short_write(self):
+        test_file=os.path.join(self.tmp_dir, 'test_file')
+        content = ustr(uuid.uuid4())
+        write = os.write
+        #Write at most 5 bytes each time
+        short_write = lambda fd, data: write(fd, data[0:5])
+        with patch("os.write", side_effect=short_write):
+            fileutil.write_file_atomic(test_file, content)
+        self.assertEquals(content, fileutil.read_file(test_file))
+
     def test_get_last_path_element(self):
         filepath = '/tmp/abc.def'
         filename = fileutil.base_name(filepath)
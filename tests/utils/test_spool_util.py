@@ -0,0 +1,173 @@
+# Copyright 2014 Microsoft Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+# Requires Python 2.4+ and Openssl 1.0+
+#
+# Implements parts of RFC 2131, 1541, 1497 and
+# http://msdn.microsoft.com/en-us/library/cc227282%28PROT.10%29.aspx
+# http://msdn.microsoft.com/en-us/library/cc227259%28PROT.13%29.aspx
+
+
+from tests.tools import *
+import os
+import time
+import struct
+import azurelinuxagent.utils.spoolutil as spoolutil
+from azurelinuxagent.utils.spoolutil import Spool, encode_record
+
+class TestSpool(AgentTestCase):
+    def setUp(self):
+        AgentTestCase.setUp(self)
+        self.spool_dir = os.path.join(self.tmp_dir, "events")
+
+    def _records(self, count, size=100):
+        return [("{0:04d}".format(i) * (size // 4)).encode("utf-8")
+                for i in range(0, count)]
+
+    def _segments(self):
+        return [x for x in os.listdir(self.spool_dir) if x.endswith(".spool")]
+
+    def test_append_read(self):
+        spool = Spool(self.spool_dir, segment_size=1024)
+        records = self._records(50)
+        for record in records:
+            self.assertTrue(spool.append(record))
+        #Far fewer files than events
+        self.assertEquals(6, len(self._segments()))
+
+        read, cursor = spool.read(max_bytes=2000)
+        self.assertEquals(records[0: 18], read)
+
+        #Nothing is removed till commit
+        read, cursor = spool.read(max_bytes=100000)
+        self.assertEquals(records, read)
+        spool.commit(cursor)
+        self.assertEquals(1, len(self._segments()))
+        self.assertEquals(([], cursor), spool.read())
+
+        #Cursor is persisted
+        spool.append(b"foo")
+        spool = Spool(self.spool_dir, segment_size=1024)
+        self.assertEquals([b"foo"], spool.read()[0])
+
+    def test_read_ahead(self):
+        spool = Spool(self.spool_dir, segment_size=1024)
+        self.assertEquals(None, spool.get_oldest_time())
+        self.assertEquals(0, spool.get_pending_size())
+        records = self._records(20)
+        start = time.time()
+        for record in records:
+            spool.append(record)
+
+        #Batches are read ahead of the committed cursor
+        read, cursor = spool.read(max_bytes=500)
+        self.assertEquals(records[0: 5], read)
+        read, cursor = spool.read(max_bytes=500, cursor=cursor)
+        self.assertEquals(records[5: 10], read)
+        self.assertEquals(20 * 116, spool.get_pending_size())
+        self.assertTrue(spool.get_oldest_time() >= start - 1)
+
+        #Uncommitted batches are read again
+        read, cursor = spool.read(max_bytes=500)
+        self.assertEquals(records[0: 5], read)
+        spool.commit(cursor)
+        self.assertEquals(15 * 116, spool.get_pending_size())
+
+    def test_max_size(self):
+        spool = Spool(self.spool_dir, segment_size=1024, max_size=2048)
+        records = self._records(30)
+        saved = [spool.append(x) for x in records]
+        self.assertEquals(17, saved.count(True))
+        self.assertFalse(spool.append(records[0]))
+
+        #Space is freed when records are consumed
+        read, cursor = spool.read(max_bytes=100000)
+        self.assertEquals(records[0: 17], read)
+        spool.commit(cursor)
+        self.assertTrue(spool.append(b"foo"))
+
+    def _write_segment(self, seq, data):
+        path = os.path.join(self.spool_dir,
+                            "{0:016d}.spool".format(seq))
+        with open(path, "wb") as seg_file:
+            seg_file.write(data)
+        #Left by a process that is gone
+        mtime = time.time() - spoolutil.SEGMENT_IDLE_TIME - 1
+        os.utime(path, (mtime, mtime))
+
+    def test_crash_recovery(self):
+        os.makedirs(self.spool_dir)
+        #Torn record at the end
+        self._write_segment(0, encode_record(b"foo") + encode_record(b"bar")[0: 10])
+        #Corrupted record in the middle
+        corrupted = encode_record(b"baz")[0: -1] + b"X"
+        self._write_segment(1, encode_record(b"foo1") + corrupted + 
+                               encode_record(b"bar1"))
+        #Bogus length
+        self._write_segment(2, struct.pack(">IId", 0xffffffff, 0, 0) + b"foo")
+        #Cursor file is broken
+        with open(os.path.join(self.spool_dir, "cursor"), "w") as cursor_file:
+            cursor_file.write("foo")
+
+        spool = Spool(self.spool_dir)
+        spool.append(b"foo3")
+        read, cursor = spool.read()
+        self.assertEquals([b"foo", b"foo1", b"foo3"], read)
+        spool.commit(cursor)
+        self.assertEquals(1, len(self._segments()))
+
+    def test_segment_of_other_process(self):
+        os.makedirs(self.spool_dir)
+        spool = Spool(self.spool_dir)
+        spool.append(b"foo")
+
+        #Another process is writing to a newer segment
+        other = Spool(self.spool_dir)
+        other.append(b"bar")
+        read, cursor = spool.read()
+        self.assertEquals([b"foo", b"bar"], read)
+        spool.commit(cursor)
+
+        #The reader rotated its own segment, so it's removed
+        self.assertEquals(1, len(self._segments()))
+        spool.append(b"foo1")
+        other.append(b"bar1")
+        read, cursor = spool.read()
+        #Other process' segment is not finished yet
+        self.assertEquals([b"bar1"], read)
+
+    def test_segment_created_concurrently(self):
+        os.makedirs(self.spool_dir)
+        other = Spool(self.spool_dir)
+        other.append(b"bar")
+        size = os.path.getsize(other.get_segment_path(0))
+
+        #Segment of the other process is created after the scan
+        spool = Spool(self.spool_dir)
+        spool.list_segments = Mock(return_value=[])
+        spool.append(b"foo")
+        self.assertEquals(1, spool.active_seq)
+        self.assertEquals(2, len(self._segments()))
+        self.assertEquals(size, os.path.getsize(other.get_segment_path(0)))
+
+    def test_active_segment_removed(self):
+        spool = Spool(self.spool_dir)
+        spool.append(b"foo")
+        for name in self._segments():
+            os.remove(os.path.join(self.spool_dir, name))
+        spool.append(b"bar")
+        self.assertEquals([b"bar"], spool.read()[0])
+
+if __name__ == '__main__':
+    unittest.main()
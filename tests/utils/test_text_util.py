@@ -58,6 +58,19 @@ class TestTextUtil(AgentTestCase):
         self.assertTrue(Version("1.0") >= Version("1.0"))
         self.assertTrue(Version("1.0") <= Version("1.0"))
 
+        #Compare with plain strings
+        self.assertTrue(Version("1.9") < "1.10")
+        self.assertTrue(Version("1.0") == "1.0")
+        self.assertTrue(Version("1.0.0") > "1.0")
+
+        #Numeric components sort before alphabetic ones
+        self.assertTrue(Version("1.0.a") > Version("1.0.9"))
+        self.assertTrue(Version("1.0rc1") < Version("1.0rc2"))
+
+        versions = ["1.10", "1.2", "1.9.1", "1.9"]
+        self.assertEquals(["1.2", "1.9", "1.9.1", "1.10"],
+                          sorted(versions, key=Version))
+
         self.assertTrue(Version("1.9") < "1.10")
         self.assertTrue("1.9" < Version("1.10"))
 